@@ -1,9 +1,29 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime
+from plotly.subplots import make_subplots
 import numpy as np
+import os
+import tempfile
+import threading
+import dataclasses
+
+from funnel_cache import DiskCache
+from funnel_core import (
+    NO_DAY, days_to_dates, cube_lookup, conversion_rates, total_conversion, funnel_stats, conversion_matrix, branch_conversion,
+    date_range_positions, range_lookup, resample_funnels, compare_branches, rolling_funnels, funnel_chunks,
+    table_rows, sort_rows, table_page_frame, trend_series, downsample_minmax, period_starts, build_row_index
+)
+from funnel_io import load_merged, directory_sources, source_fingerprint, dataset_key, LoadProgress, LoadCancelled
+from funnel_export import EXPORT_FORMATS, raw_chunks, write_export, export_file_name, export_mime
+from funnel_schema import DEFAULT_SCHEMA_PATH, load_schema
+from funnel_quality import QUALITY_CHECKS, validate, branch_summary, issue_rows_frame, outliers_frame, non_monotone_frame
+from funnel_profile import RerunProfile, DEFAULT_ENABLED, DEFAULT_LOG_PATH, DEFAULT_TEXTFILE_PATH
+from funnel_store import FunnelStore, DEFAULT_STORE_PATH
+from funnel_registry import DatasetRegistry
+
+# Постоянный кэш разобранных файлов (каталог и лимит задаются FUNNEL_CACHE_DIR / FUNNEL_CACHE_MAX_MB)
+disk_cache = DiskCache()
 
 # Заголовок приложения
 st.set_page_config(page_title="Воронка продаж", layout="wide")
@@ -11,86 +31,544 @@ st.title("📊 Анализ воронки продаж")
 st.markdown("---")
 
 
-# Функция для загрузки и обработки данных
-@st.cache_data
-def load_data(uploaded_file):
-    # Чтение Excel файла
-    df = pd.read_excel(uploaded_file, header=None)
+# Легкое оформление вместо шаблона plotly_white: шаблон целиком попадает в JSON каждого графика
+LIGHT_LAYOUT = dict(
+    template='none',
+    paper_bgcolor='white',
+    plot_bgcolor='white',
+    xaxis=dict(gridcolor='#EBF0F8', zerolinecolor='#EBF0F8', automargin=True),
+    yaxis=dict(gridcolor='#EBF0F8', zerolinecolor='#EBF0F8', automargin=True),
+)
+
+
+# Построение графика воронки. Результат кэшируется по значениям и настройкам отображения,
+# поэтому переключение других виджетов не пересобирает фигуру.
+@st.cache_data(max_entries=256)
+def build_funnel_figure(stages, values, metric, orientation, colors, show_values, show_percentage, title):
+    values = np.asarray(values, dtype=np.float64)
+    value_text = np.char.mod('%.1f', values)
+    bar_colors = [colors[i % len(colors)] for i in range(len(values))]
+
+    if orientation == 'Горизонтальная':
+        # ГОРИЗОНТАЛЬНАЯ ВОРОНКА - один столбчатый трейс на все этапы
+        first_value = values[0]
+        from_initial = values / first_value * 100 if first_value > 0 else np.zeros_like(values)
+
+        # Текст для отображения - процент от НАЧАЛЬНОГО значения (для первого этапа - только значение)
+        if show_values:
+            if show_percentage:
+                percent_text = np.char.mod(' (%.1f%%)', from_initial) if first_value > 0 else ' (0%)'
+                text = np.char.add(value_text, percent_text)
+                text[0] = value_text[0]
+            else:
+                text = value_text
+        else:
+            text = None
+
+        # Доля от начального значения в подсказке для всех этапов, кроме первого
+        hover_extra = np.char.mod('<br>От начального: %.1f%%', from_initial)
+        if first_value <= 0:
+            hover_extra[:] = ''
+        hover_extra[0] = ''
+
+        fig = go.Figure(go.Bar(
+            y=list(stages),
+            x=values,
+            orientation='h',
+            marker=dict(color=bar_colors, line=dict(width=1, color='white')),
+            text=text,
+            textposition='inside',
+            textfont=dict(size=14, color='white'),
+            customdata=hover_extra,
+            hovertemplate=f"<b>%{{y}}</b><br>{metric}: %{{x:.1f}}%{{customdata}}<extra></extra>"
+        ))
+
+        fig.update_layout(LIGHT_LAYOUT)
+        fig.update_layout(
+            title=title,
+            height=550,  # Увеличили высоту
+            showlegend=False,
+            font=dict(
+                size=16,  # УВЕЛИЧИЛИ основной шрифт
+                family="Arial, sans-serif"
+            ),
+            title_font=dict(
+                size=22,  # УВЕЛИЧИЛИ заголовок
+                family="Arial, sans-serif",
+                color='#1f77b4'
+            ),
+            margin=dict(t=120, l=200, r=60, b=100),  # Увеличили отступы
+            xaxis_title=metric,
+            yaxis_title="Этап продаж",
+            yaxis=dict(
+                autorange="reversed",
+                title_font=dict(size=18),  # УВЕЛИЧИЛИ шрифт заголовка оси Y
+                tickfont=dict(size=16)  # УВЕЛИЧИЛИ шрифт меток оси Y
+            ),
+            xaxis=dict(
+                title_font=dict(size=18),  # УВЕЛИЧИЛИ шрифт заголовка оси X
+                tickfont=dict(size=16)  # УВЕЛИЧИЛИ шрифт меток оси X
+            ),
+            plot_bgcolor='rgba(240, 240, 240, 0.1)'
+        )
+        return fig
+
+    # ВЕРТИКАЛЬНАЯ ВОРОНКА
+    fig = go.Figure(go.Funnel(
+        y=list(stages),
+        x=values,
+        textposition="inside",
+        textinfo="value+percent initial" if show_values else "none",
+        marker=dict(
+            color=bar_colors[:len(values)],
+            line=dict(width=1, color='white')
+        ),
+        opacity=0.8
+    ))
+
+    # Добавляем кастомные проценты если нужно (процент от предыдущего этапа)
+    if show_values and show_percentage:
+        previous = values[:-1]
+        percent = np.where(previous > 0, np.char.mod('%.1f%%', conversion_rates(values)), '0%')
+        text_labels = np.concatenate([value_text[:1], np.char.add(np.char.add(value_text[1:], '<br>('), np.char.add(percent, ')'))])
+
+        fig.update_traces(
+            text=text_labels,
+            textposition="inside",
+            textfont=dict(size=12, color='white')
+        )
+
+    fig.update_layout(LIGHT_LAYOUT)
+    fig.update_layout(
+        title=title,
+        height=600,  # Увеличили высоту
+        showlegend=False,
+        font=dict(
+            size=14,  # Увеличили основной шрифт
+            family="Arial, sans-serif"
+        ),
+        title_font=dict(
+            size=20,  # Увеличили заголовок
+            family="Arial, sans-serif",
+            color='#1f77b4'
+        ),
+        margin=dict(t=100, l=80, r=50, b=80),  # Увеличили отступы
+        xaxis_title=metric,
+        yaxis_title="Этап продаж",
+    )
+    return fig
+
+
+# Сравнение филиалов: малые воронки в сетке с общей шкалой или наложенные линии по этапам.
+# Все филиалы - трейсы одной фигуры; фигура кэшируется по значениям, как и основная воронка.
+@st.cache_data(max_entries=64)
+def build_comparison_figure(stages, branches, values, metric, mode, colors, title):
+    values = np.asarray(values, dtype=np.float64).reshape(len(branches), len(stages))
+    x_max = float(values.max()) * 1.05 if values.size and values.max() > 0 else 1.0
+
+    if mode == 'Малые воронки':
+        n_cols = min(4, len(branches))
+        n_rows = -(-len(branches) // n_cols)
+        fig = make_subplots(
+            rows=n_rows, cols=n_cols, subplot_titles=list(branches), shared_yaxes=True,
+            horizontal_spacing=0.03, vertical_spacing=min(0.08, 0.3 / n_rows)
+        )
+        bar_colors = [colors[i % len(colors)] for i in range(len(stages))]
+        for i, branch in enumerate(branches):
+            fig.add_trace(go.Bar(
+                y=list(stages),
+                x=values[i],
+                orientation='h',
+                marker=dict(color=bar_colors),
+                name=branch,
+                hovertemplate=f"<b>{branch}</b><br>%{{y}}: %{{x:.1f}}<extra></extra>"
+            ), row=i // n_cols + 1, col=i % n_cols + 1)
+        fig.update_layout(LIGHT_LAYOUT)
+        # Общая шкала: одинаковый диапазон по оси значений во всех ячейках
+        fig.update_xaxes(range=[0, x_max], gridcolor='#EBF0F8')
+        fig.update_yaxes(autorange="reversed")
+        fig.update_layout(
+            title=title,
+            height=max(300, 220 * n_rows + 80),
+            showlegend=False,
+            margin=dict(t=80, l=120, r=30, b=40),
+        )
+        return fig
+
+    # Наложенные воронки: линия на филиал по этапам
+    fig = go.Figure([
+        go.Scatter(
+            x=list(stages),
+            y=values[i],
+            mode='lines+markers',
+            name=branch,
+            line=dict(color=colors[i % len(colors)]),
+            hovertemplate=f"<b>{branch}</b><br>%{{x}}: %{{y:.1f}}<extra></extra>"
+        )
+        for i, branch in enumerate(branches)
+    ])
+    fig.update_layout(LIGHT_LAYOUT)
+    fig.update_layout(
+        title=title,
+        height=550,
+        yaxis=dict(title=metric, range=[0, x_max], gridcolor='#EBF0F8'),
+        xaxis_title="Этап продаж",
+        legend=dict(font=dict(size=11)),
+        margin=dict(t=80, l=80, r=30, b=80),
+    )
+    return fig
+
+
+# Точек на линию графика динамики: длинные дневные ряды прореживаются до этого числа
+TREND_MAX_POINTS = 1500
+
+
+# Линии динамики: по одной на столбец series (периоды, линии), каждая прорежена до max_points точек
+@st.cache_data(max_entries=32)
+def build_trend_figure(dates, series, names, y_title, colors, max_points):
+    fig = go.Figure()
+    for i, name in enumerate(names):
+        keep = downsample_minmax(series[:, i], max_points)
+        fig.add_trace(go.Scatter(
+            x=dates[keep],
+            y=series[keep, i],
+            mode='lines',
+            name=name,
+            line=dict(color=colors[i % len(colors)], width=2),
+            hovertemplate=f"<b>{name}</b><br>%{{x|%Y-%m-%d}}: %{{y:.1f}}<extra></extra>"
+        ))
+    fig.update_layout(LIGHT_LAYOUT)
+    fig.update_layout(
+        height=420,
+        yaxis_title=y_title,
+        hovermode='x unified',
+        legend=dict(orientation='h', y=-0.15),
+        margin=dict(t=30, l=80, r=30, b=60),
+    )
+    return fig
+
+
+# История этапов-целей по периодам и прогноз на следующий период (пунктир от последнего факта)
+@st.cache_data(max_entries=32)
+def build_forecast_figure(dates, history, target_date, forecast, names, y_title, colors):
+    fig = go.Figure()
+    for i, name in enumerate(names):
+        color = colors[i % len(colors)]
+        fig.add_trace(go.Scatter(
+            x=dates,
+            y=history[:, i],
+            mode='lines+markers',
+            name=name,
+            line=dict(color=color, width=2),
+            hovertemplate=f"<b>{name}</b><br>%{{x|%Y-%m-%d}}: %{{y:.1f}}<extra></extra>"
+        ))
+        fig.add_trace(go.Scatter(
+            x=[dates[-1], target_date],
+            y=[history[-1, i], forecast[i]],
+            mode='lines+markers',
+            name=f"{name}, прогноз",
+            line=dict(color=color, width=2, dash='dash'),
+            hovertemplate=f"<b>{name}, прогноз</b><br>%{{x|%Y-%m-%d}}: %{{y:.1f}}<extra></extra>"
+        ))
+    fig.update_layout(LIGHT_LAYOUT)
+    fig.update_layout(
+        height=420,
+        yaxis_title=y_title,
+        hovermode='x unified',
+        legend=dict(orientation='h', y=-0.15),
+        margin=dict(t=30, l=80, r=30, b=60),
+    )
+    return fig
 
-    # Установка правильных заголовков
-    # Первые 2 строки - это заголовки
-    df.columns = range(df.shape[1])
 
-    # Создание мультииндекса для столбцов
-    new_columns = []
-    for i in range(df.shape[1]):
-        if i == 0:
-            new_columns.append(('Дата', ''))
-        elif i == 1:
-            new_columns.append(('Филиал', ''))
-        else:
-            # Определяем этап воронки
-            stage_idx = (i - 2) // 2
-            stages = ['Холодный', 'Встреча', 'КП', 'Согласование', 'Договор', 'Поставка']
-            stage = stages[stage_idx] if stage_idx < len(stages) else f'Этап_{stage_idx}'
+# Прогноз по всем филиалам кэшируется по ключу набора (хэш содержимого файлов) и параметрам:
+# перезапуски и другие сессии с теми же файлами модель не переобучают.
+# Модуль прогноза импортируется только при первом открытии раздела.
+@st.cache_data(max_entries=32)
+def forecast_cached(dataset_key, metric, freq, targets, _cube):
+    from funnel_forecast import forecast_branches
+    return forecast_branches(_cube, metric, freq, targets=targets)
 
-            # Определяем тип данных (Кол-во или Тонн)
-            data_type = 'Кол-во' if (i - 2) % 2 == 0 else 'Тонн'
 
-            new_columns.append((stage, data_type))
+# Общий на процесс реестр наборов данных: сессии с одинаковыми файлами получают одну копию
+# таблицы и куба (только для чтения) вместо собственной
+@st.cache_resource
+def dataset_registry():
+    return DatasetRegistry()
 
-    # Применяем мультииндекс
-    df.columns = pd.MultiIndex.from_tuples(new_columns)
 
-    # Удаляем первые две строки (старые заголовки)
-    df = df.iloc[2:].reset_index(drop=True)
+# Период обновления хода фоновой загрузки, секунды
+LOAD_POLL_SECONDS = 0.5
 
-    # Преобразуем даты
-    df[('Дата', '')] = pd.to_datetime(df[('Дата', '')])
+# Строк выбранной проверки в разделе качества данных
+QUALITY_PREVIEW_ROWS = 1000
 
-    # Преобразуем числовые столбцы
-    for col in df.columns:
-        if col[1] in ['Кол-во', 'Тонн']:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
 
-    # Заполняем NaN нулями
-    for col in df.columns:
-        if col[1] in ['Кол-во', 'Тонн']:
-            df[col] = df[col].fillna(0)
+# Фоновая загрузка набора: разбор идет в отдельном потоке, страница тем временем работает
+# с прежним набором. Задание хранится в сессии: отпечатки файлов, ход загрузки (LoadProgress),
+# поток и результат - ссылка на набор в реестре или исключение (в том числе LoadCancelled).
+def start_loading(sources, streaming, schema, fingerprints, dataset, registry):
+    progress = LoadProgress(len(sources))
+    job = {'fingerprints': fingerprints, 'progress': progress, 'lease': None, 'appended': {}, 'error': None}
 
-    return df
+    def loader(keys):
+        if dataset is not None and keys[:len(dataset['lease'].key)] == dataset['lease'].key:
+            # Файлы только добавились: разбираем новые и дописываем их к готовой таблице и кубу
+            base = dataset['lease']
+            progress.n_files = len(sources) - len(base.key)
+            table, cube = load_merged(
+                sources[len(base.key):], streaming=streaming, cache=disk_cache, schema=schema, progress=progress,
+                keys=keys[len(base.key):], base=(base.table, base.cube)
+            )
+            # Строки добавленных файлов идут после строк прежней таблицы
+            added_days = table.days[len(base.table):]
+            added_days = added_days[added_days != NO_DAY]
+            if len(added_days):
+                # Первая дата добавленных данных: ряды динамики до нее не пересчитываются
+                job['appended'].update(previous=base.key, changed_from=days_to_dates([added_days.min()])[0])
+        else:
+            # Набор файлов изменился: собираем заново (уже разобранные файлы берутся из постоянного кэша).
+            # Ключи реестра и есть ключи постоянного кэша: файлы не хэшируются второй раз
+            table, cube = load_merged(sources, streaming=streaming, cache=disk_cache, schema=schema, progress=progress,
+                                      keys=keys)
+        # Индекс строк по филиалам и датам строится один раз на набор: выборки строк для просмотра
+        # и выгрузки - двоичным поиском, без прохода по всей таблице
+        progress.current = 'индекс строк'
+        table = dataclasses.replace(table, row_index=build_row_index(table))
+        # Проверка данных - операции над массивами таблицы и куба, один раз на набор
+        progress.current = 'проверка данных'
+        return table, cube, validate(table, cube)
+
+    def run():
+        try:
+            # Ключ в реестре - содержимое файлов и схема: одна и та же выгрузка в разных сессиях дает один ключ
+            progress.current = 'проверка содержимого файлов'
+            keys = tuple(dataset_key(source, schema) for source in sources)
+            job['lease'] = registry.lease(keys, lambda: loader(keys))
+        except Exception as e:
+            job['error'] = e
+
+    job['thread'] = threading.Thread(target=run, name='funnel-load', daemon=True)
+    job['thread'].start()
+    return job
+
+
+# Готовый набор данных сессии. Если выбраны другие файлы, запускается фоновая загрузка, а до ее
+# окончания возвращается прежний набор (None, если его нет); ход загрузки - в st.session_state['loading'].
+def load_data(sources, streaming=True, schema_path=None):
+    # Набор данных сессии хранится вместе с отпечатками схемы и файлов, из которых он собран
+    schema = load_schema(schema_path) if schema_path else None
+    fingerprints = [schema.key() if schema is not None else None] + [source_fingerprint(source) for source in sources]
+    dataset = st.session_state.get('dataset')
+    job = st.session_state.get('loading')
+    if dataset is not None and dataset['fingerprints'] == fingerprints:
+        # Вернулись к уже загруженным файлам - начатая загрузка больше не нужна
+        if job is not None:
+            cancel_loading()
+        return dataset
+
+    if job is None or job['fingerprints'] != fingerprints:
+        if job is not None:
+            job['progress'].cancel()
+        job = start_loading(sources, streaming, schema, fingerprints, dataset, dataset_registry())
+        st.session_state['loading'] = job
+
+    if job['thread'].is_alive() or job['lease'] is None:
+        return dataset
+
+    # Загрузка завершилась: новый набор подменяет прежний
+    if dataset is not None:
+        dataset['lease'].release()
+    del st.session_state['loading']
+    # В сессии хранится только ссылка на набор в реестре; с концом сессии ссылка снимается
+    dataset = {'fingerprints': fingerprints, 'lease': job['lease'], 'appended': job['appended']}
+    st.session_state['dataset'] = dataset
+    return dataset
+
+
+def cancel_loading():
+    job = st.session_state.pop('loading', None)
+    if job is not None:
+        job['progress'].cancel()
+
+
+# Строка хода загрузки: файлы и разобранные строки
+def show_loading_progress(job):
+    progress = job['progress']
+    fraction = progress.files_done / progress.n_files if progress.n_files else 0.0
+    rows = f'{progress.rows:,}'.replace(',', ' ')
+    text = f"Файлов готово: {progress.files_done} из {progress.n_files}, строк разобрано: {rows}"
+    if progress.cancelled:
+        text += " - отмена..."
+    elif progress.current:
+        text += f" ({progress.current})"
+    st.progress(min(fraction, 1.0), text=text)
+
+
+# Ход загрузки, пока на странице прежний набор: фрагмент обновляется сам, не перезапуская страницу.
+# Когда загрузка завершилась, перезапускается вся страница - на ней появляется новый набор.
+@st.fragment(run_every=LOAD_POLL_SECONDS)
+def loading_status():
+    job = st.session_state.get('loading')
+    if job is None or not job['thread'].is_alive():
+        st.rerun()
+    st.info("⏳ Загружаются новые файлы; пока показаны прежние данные")
+    show_loading_progress(job)
+    st.button("Отменить загрузку", on_click=job['progress'].cancel, disabled=job['progress'].cancelled)
+
+
+# Первая загрузка: показывать еще нечего, поэтому перезапуск ждет окончания загрузки, обновляя ход.
+# Нажатие «Отменить» перезапускает страницу, обработчик отменяет разбор, и ожидание быстро заканчивается.
+def wait_for_loading(job):
+    st.button("Отменить загрузку", on_click=job['progress'].cancel)
+    placeholder = st.empty()
+    while job['thread'].is_alive():
+        with placeholder.container():
+            show_loading_progress(job)
+        job['thread'].join(LOAD_POLL_SECONDS)
+    st.rerun()
+
+
+# Хранилище для данных больше памяти открывается один раз на сессию; пересобранное хранилище
+# (другое время изменения meta.json) открывается заново
+def open_store(directory):
+    stamp = os.stat(os.path.join(directory, 'meta.json')).st_mtime_ns
+    opened = st.session_state.get('store')
+    if opened is None or opened['key'] != (directory, stamp):
+        opened = {'key': (directory, stamp), 'store': FunnelStore(directory)}
+        st.session_state['store'] = opened
+    return opened['store']
+
+
+# Воронка из хранилища: читаются только блоки, подходящие по индексу min/max дат и филиалов
+@st.cache_data(max_entries=256)
+def store_query(store_key, date_from, date_to, branch, _store):
+    return _store.query(date_from, date_to, branch)
 
 
 # Сайдбар для фильтров
 with st.sidebar:
     st.header("⚙️ Настройки фильтров")
 
-    # Загрузка файла
-    uploaded_file = st.file_uploader("Загрузите файл Excel", type=['xlsx'])
+    # Загрузка файлов: несколько выгрузок или каталог на сервере
+    uploaded_files = st.file_uploader(
+        "Загрузите файлы Excel или CSV",
+        type=['xlsx', 'csv'],
+        accept_multiple_files=True,
+        help="Файлы объединяются; при добавлении файла разбирается только он"
+    )
+    source_dir = st.text_input(
+        "Или каталог с файлами на сервере:",
+        help="Все .xlsx и .csv из каталога; повторно разбираются только новые и измененные файлы"
+    )
+    store_path = st.text_input(
+        "Или хранилище для больших данных:",
+        value=DEFAULT_STORE_PATH or '',
+        help="Каталог, собранный командой python funnel_store.py build; используется, если файлы не выбраны"
+    )
+    schema_path = st.text_input(
+        "Файл схемы этапов (JSON, необязательно):",
+        value=DEFAULT_SCHEMA_PATH or '',
+        help="Этапы и метрики по столбцам файла; без схемы они читаются из двух строк заголовков"
+    )
+    streaming = st.checkbox(
+        "Потоковая загрузка",
+        value=True,
+        help="Читать лист построчно в типизированные массивы: меньше пиковой памяти на больших файлах"
+    )
+    profile_enabled = st.checkbox(
+        "Замеры производительности",
+        value=DEFAULT_ENABLED,
+        help="Время и пиковая память каждой фазы перезапуска - в панели внизу боковой панели"
+    )
+
+    # Замеры фаз перезапуска: profile.lap(фаза) закрывает фазу, начатую предыдущим вызовом
+    profile = RerunProfile(profile_enabled)
 
-    if uploaded_file is None:
+    try:
+        sources = list(uploaded_files or [])
+        if source_dir:
+            sources += directory_sources(source_dir)
+    except OSError as e:
+        st.error(f"❌ Не удалось прочитать каталог: {str(e)}")
+        st.stop()
+
+    store = None
+    if not sources and not store_path:
+        cancel_loading()
         st.warning("⚠️ Пожалуйста, загрузите файл Excel для анализа")
         st.info("Формат файла должен соответствовать предоставленной таблице")
         st.stop()
 
     try:
-        df = load_data(uploaded_file)
-        st.success(f"✅ Файл успешно загружен! Записей: {len(df)}")
+        # axes - даты, филиалы, этапы и метрики данных: куб в памяти или хранилище на диске
+        if sources:
+            dataset = load_data(sources, streaming, schema_path)
+            job = st.session_state.get('loading')
+            if job is not None and job['thread'].is_alive():
+                if dataset is None:
+                    wait_for_loading(job)
+                loading_status()
+            elif job is not None:
+                if job['error'] is None:
+                    # Загрузка завершилась между проверками - набор подменится при перезапуске
+                    st.rerun()
+                if isinstance(job['error'], LoadCancelled):
+                    st.warning("⚠️ Загрузка отменена" + ("; показаны прежние данные" if dataset is not None else ""))
+                else:
+                    st.error(f"❌ Ошибка при загрузке файла: {str(job['error'])}")
+                st.button("Загрузить снова", on_click=cancel_loading)
+                if dataset is None:
+                    st.stop()
+            table, cube, quality = dataset['lease'].table, dataset['lease'].cube, dataset['lease'].quality
+            st.success(f"✅ Файлов загружено: {len(dataset['fingerprints']) - 1}. Записей: {len(table)}")
+            if any(quality.counts.values()):
+                found = ', '.join(
+                    f"{QUALITY_CHECKS[check].lower()}: {n}" for check, n in quality.counts.items() if n
+                )
+                st.warning(f"⚠️ Проверка данных: {found}. Подробности - «Показать качество данных»")
+            axes = cube
+        else:
+            # Данные не загружаются в память: запросы идут в хранилище на диске
+            cancel_loading()
+            table = cube = quality = None
+            store = open_store(store_path)
+            st.success(f"✅ Хранилище открыто. Записей: {len(store)}")
+            axes = store
+        first_date, last_date = pd.Timestamp(axes.dates[0]).date(), pd.Timestamp(axes.dates[-1]).date()
 
         # Информация о данных
         with st.expander("📊 Информация о данных"):
-            st.write(f"**Диапазон дат:** {df[('Дата', '')].min().date()} - {df[('Дата', '')].max().date()}")
-            st.write(f"**Филиалы:** {', '.join(df[('Филиал', '')].unique())}")
-            st.write(f"**Этапы воронки:** Холодный, Встреча, КП, Согласование, Договор, Поставка")
+            st.write(f"**Диапазон дат:** {first_date} - {last_date}")
+            st.write(f"**Филиалы:** {', '.join(table.branch_names if store is None else store.branch_names)}")
+            st.write(f"**Этапы воронки:** {', '.join(axes.stages)}")
+            st.write(f"**Метрики:** {', '.join(axes.metrics)}")
+            if store is None:
+                st.write(
+                    f"**Память:** таблица {table.nbytes / 2 ** 20:.1f} МБ "
+                    f"({table.nbytes / max(len(table), 1):.0f} байт на строку), "
+                    f"агрегаты {cube.nbytes / 2 ** 20:.1f} МБ"
+                )
+                n_datasets, registry_bytes, n_leases = dataset_registry().stats()
+                st.write(
+                    f"**Общий кэш наборов:** {n_datasets} шт., {registry_bytes / 2 ** 20:.1f} МБ, "
+                    f"открыт в сессиях: {n_leases}"
+                )
+            else:
+                st.write(
+                    f"**Хранилище:** {store.directory}, блоков {len(store.chunk_rows)}, "
+                    f"{store.nbytes / 2 ** 20:.1f} МБ на диске"
+                )
 
     except Exception as e:
         st.error(f"❌ Ошибка при загрузке файла: {str(e)}")
         st.stop()
+    profile.lap('load')
 
     # Выбор метрики
     metric = st.radio(
         "Выберите метрику для анализа:",
-        ['Кол-во', 'Тонн'],
+        axes.metrics,
         index=0,
         help="Анализировать по количеству сделок или по тоннажу"
     )
@@ -98,12 +576,14 @@ with st.sidebar:
     # Выбор периода
     period_option = st.radio(
         "Выберите период:",
-        ['За весь период', 'Конкретная дата'],
+        ['За весь период', 'Конкретная дата', 'Диапазон дат'],
         index=1
     )
+    date_from = date_to = None
 
     if period_option == 'Конкретная дата':
-        available_dates = sorted(df[('Дата', '')].dt.date.unique())
+        # Даты для списка - прямо из отсортированной оси дат, одним преобразованием массива
+        available_dates = axes.dates.astype('datetime64[D]').tolist()
         selected_date = st.selectbox(
             "Выберите дату:",
             available_dates,
@@ -112,13 +592,27 @@ with st.sidebar:
         )
         selected_date_dt = pd.to_datetime(selected_date)
         period_label = selected_date
+    elif period_option == 'Диапазон дат':
+        min_date, max_date = first_date, last_date
+        date_range = st.date_input(
+            "Выберите диапазон дат:",
+            value=(min_date, max_date),
+            min_value=min_date,
+            max_value=max_date,
+            help="Любой диапазон считается по префиксным суммам - одинаково быстро для дня и для нескольких лет"
+        )
+        # Пока выбрана только начальная дата, диапазон состоит из одного дня
+        date_from, date_to = (date_range[0], date_range[-1]) if date_range else (min_date, max_date)
+        selected_date = f"{date_from:%Y-%m-%d}_{date_to:%Y-%m-%d}"
+        selected_date_dt = None
+        period_label = f"{date_from:%Y-%m-%d} - {date_to:%Y-%m-%d}"
     else:
         selected_date = "За весь период"
         selected_date_dt = None
-        period_label = f"Весь период ({df[('Дата', '')].min().date()} - {df[('Дата', '')].max().date()})"
+        period_label = f"Весь период ({first_date} - {last_date})"
 
     # Выбор филиала
-    available_branches = sorted(df[('Филиал', '')].unique())
+    available_branches = axes.branches
     selected_branch = st.selectbox(
         "Выберите филиал:",
         ['Все филиалы'] + list(available_branches),
@@ -155,16 +649,71 @@ with st.sidebar:
 
     # Дополнительные настройки
     st.header("📈 Дополнительные опции")
-    show_table = st.checkbox("Показать исходные данные", value=False)
+    # Разрезы по всем датам и филиалам считаются по кубу в памяти - для хранилища они недоступны
+    in_memory = store is None
+    show_table = st.checkbox("Показать исходные данные", value=False, disabled=not in_memory)
     normalize_values = st.checkbox("Нормализовать значения (для сравнения)", value=False)
+    show_periods = st.checkbox(
+        "Показать воронку по периодам",
+        value=False,
+        disabled=not in_memory,
+        help="Воронки по неделям, месяцам, кварталам или скользящему окну"
+    )
+    show_trend = st.checkbox(
+        "Показать динамику воронки",
+        value=False,
+        disabled=not in_memory,
+        help="Объемы этапов и конверсия между этапами по дням, неделям или месяцам"
+    )
+    show_branch_conversion = st.checkbox(
+        "Показать конверсию по всем филиалам",
+        value=False,
+        disabled=not in_memory,
+        help="Тепловая карта и таблица конверсии сразу для всех филиалов"
+    )
+    show_comparison = st.checkbox(
+        "Сравнить филиалы",
+        value=False,
+        disabled=not in_memory,
+        help="Воронки нескольких филиалов рядом с общей шкалой"
+    )
+    show_forecast = st.checkbox(
+        "Прогноз на следующий период",
+        value=False,
+        disabled=not in_memory,
+        help="Прогноз последних этапов по каждому филиалу по объемам всех этапов за предыдущие периоды"
+    )
+    show_quality = st.checkbox(
+        "Показать качество данных",
+        value=False,
+        disabled=not in_memory,
+        help="Нечисловые ячейки, повторы дата+филиал, немонотонные воронки и дни-выбросы по филиалам"
+    )
+    if not in_memory:
+        st.caption("Для хранилища доступны воронка за период, детализация и выгрузка исходных строк")
+    profile.lap('sidebar')
 
 # Основная область
-if uploaded_file is not None and df is not None:
-    # Получаем этапы воронки из данных
-    stages = []
-    for col in df.columns:
-        if col[0] not in ['Дата', 'Филиал'] and col[1] == metric and col[0] not in stages:
-            stages.append(col[0])
+if axes is not None:
+    # Этапы воронки берутся из куба (или хранилища) в порядке столбцов файла
+    stages = axes.stages
+    metric_idx = axes.metrics.index(metric)
+
+    # Срез куба для выбранных периода и филиала: O(этапов) вместо сканирования таблицы
+    branch_filter = selected_branch if selected_branch != 'Все филиалы' else None
+    if store is not None:
+        if period_option == 'Конкретная дата':
+            query_from = query_to = selected_date_dt
+        else:
+            query_from, query_to = date_from, date_to
+        slice_values, slice_rows = store_query(
+            st.session_state['store']['key'], query_from, query_to, branch_filter, store
+        )
+    elif period_option == 'Диапазон дат':
+        slice_values, slice_rows = range_lookup(cube, date_from, date_to, branch=branch_filter)
+    else:
+        slice_values, slice_rows = cube_lookup(cube, date=selected_date_dt, branch=branch_filter)
+    profile.lap('slice')
 
     col1, col2 = st.columns([2, 1])
 
@@ -172,65 +721,21 @@ if uploaded_file is not None and df is not None:
         st.subheader(f"📊 Воронка продаж - {metric}")
 
         # Подготовка данных для воронки
-        if period_option == 'За весь период':
-            # Агрегируем данные за весь период
+        if period_option == 'Конкретная дата' and slice_rows == 0:
             if selected_branch != 'Все филиалы':
-                filtered_by_branch = df[df[('Филиал', '')] == selected_branch]
-                values = []
-                for stage in stages:
-                    total = filtered_by_branch[(stage, metric)].sum()
-                    values.append(float(total))
-
-                funnel_data = pd.DataFrame({
-                    'Этап': stages,
-                    'Значение': values
-                })
+                st.warning(f"Нет данных для филиала '{selected_branch}' на дату {selected_date}")
             else:
-                # Все филиалы за весь период
-                values = []
-                for stage in stages:
-                    total = df[(stage, metric)].sum()
-                    values.append(float(total))
-
-                funnel_data = pd.DataFrame({
-                    'Этап': stages,
-                    'Значение': values
-                })
-        else:
-            # Конкретная дата
+                st.warning(f"Нет данных на дату {selected_date}")
+        elif period_option == 'Диапазон дат' and slice_rows == 0:
             if selected_branch != 'Все филиалы':
-                filtered_data = df[(df[('Дата', '')] == selected_date_dt) &
-                                   (df[('Филиал', '')] == selected_branch)]
-
-                if not filtered_data.empty:
-                    values = []
-                    for stage in stages:
-                        value = filtered_data.iloc[0][(stage, metric)]
-                        values.append(float(value))
-
-                    funnel_data = pd.DataFrame({
-                        'Этап': stages,
-                        'Значение': values
-                    })
-                else:
-                    st.warning(f"Нет данных для филиала '{selected_branch}' на дату {selected_date}")
-                    funnel_data = pd.DataFrame({'Этап': stages, 'Значение': [0] * len(stages)})
+                st.warning(f"Нет данных для филиала '{selected_branch}' за период {period_label}")
             else:
-                filtered_by_date = df[df[('Дата', '')] == selected_date_dt]
-
-                if not filtered_by_date.empty:
-                    values = []
-                    for stage in stages:
-                        total = filtered_by_date[(stage, metric)].sum()
-                        values.append(float(total))
-
-                    funnel_data = pd.DataFrame({
-                        'Этап': stages,
-                        'Значение': values
-                    })
-                else:
-                    st.warning(f"Нет данных на дату {selected_date}")
-                    funnel_data = pd.DataFrame({'Этап': stages, 'Значение': [0] * len(stages)})
+                st.warning(f"Нет данных за период {period_label}")
+
+        funnel_data = pd.DataFrame({
+            'Этап': stages,
+            'Значение': slice_values[:, metric_idx].astype(float)
+        })
 
         # Нормализация если выбрана
         if normalize_values and not funnel_data.empty:
@@ -240,141 +745,20 @@ if uploaded_file is not None and df is not None:
 
         # Создание воронки
         if not funnel_data.empty:
-            colors = color_options[selected_color]
-
-            if funnel_orientation == 'Горизонтальная':
-                # ГОРИЗОНТАЛЬНАЯ ВОРОНКА
-                fig = go.Figure()
-
-                # Получаем начальное значение (первый этап)
-                first_value = funnel_data['Значение'].iloc[0]
-
-                # Создаем горизонтальные столбцы для каждого этапа
-                for i, (stage, value) in enumerate(zip(funnel_data['Этап'], funnel_data['Значение'])):
-                    # Текст для отображения - процент от НАЧАЛЬНОГО значения
-                    if show_values:
-                        if i == 0:
-                            # Первый этап - только значение
-                            display_text = f"{value:.1f}"
-                        else:
-                            # Для остальных этапов считаем процент от НАЧАЛЬНОГО значения
-                            if first_value > 0:
-                                percent = (value / first_value) * 100
-                                if show_percentage:
-                                    display_text = f"{value:.1f} ({percent:.1f}%)"
-                                else:
-                                    display_text = f"{value:.1f}"
-                            else:
-                                if show_percentage:
-                                    display_text = f"{value:.1f} (0%)"
-                                else:
-                                    display_text = f"{value:.1f}"
-                    else:
-                        display_text = None
-
-                    fig.add_trace(go.Bar(
-                        y=[stage],
-                        x=[value],
-                        name=stage,
-                        orientation='h',
-                        marker=dict(
-                            color=colors[i % len(colors)],
-                            line=dict(width=1, color='white')
-                        ),
-                        text=[display_text] if display_text else None,
-                        textposition='inside',
-                        textfont=dict(size=14, color='white'),
-                        hovertemplate=f"<b>{stage}</b><br>{metric}: {value:.1f}" +
-                                      (
-                                          f"<br>От начального: {(value / first_value * 100):.1f}%" if i > 0 and first_value > 0 else "") +
-                                      "<extra></extra>"
-                    ))
-
-                fig.update_layout(
-                    title=f"Воронка продаж - {period_label} - {selected_branch if selected_branch != 'Все филиалы' else 'Все филиалы'}",
-                    height=550,  # Увеличили высоту
-                    barmode='group',
-                    showlegend=False,
-                    template='plotly_white',
-                    font=dict(
-                        size=16,  # УВЕЛИЧИЛИ основной шрифт
-                        family="Arial, sans-serif"
-                    ),
-                    title_font=dict(
-                        size=22,  # УВЕЛИЧИЛИ заголовок
-                        family="Arial, sans-serif",
-                        color='#1f77b4'
-                    ),
-                    margin=dict(t=120, l=200, r=60, b=100),  # Увеличили отступы
-                    xaxis_title=metric,
-                    yaxis_title="Этап продаж",
-                    yaxis=dict(
-                        autorange="reversed",
-                        title_font=dict(size=18),  # УВЕЛИЧИЛИ шрифт заголовка оси Y
-                        tickfont=dict(size=16)  # УВЕЛИЧИЛИ шрифт меток оси Y
-                    ),
-                    xaxis=dict(
-                        title_font=dict(size=18),  # УВЕЛИЧИЛИ шрифт заголовка оси X
-                        tickfont=dict(size=16)  # УВЕЛИЧИЛИ шрифт меток оси X
-                    ),
-                    plot_bgcolor='rgba(240, 240, 240, 0.1)'
-                )
-            else:
-                # ВЕРТИКАЛЬНАЯ ВОРОНКА
-                fig = go.Figure(go.Funnel(
-                    y=funnel_data['Этап'],
-                    x=funnel_data['Значение'],
-                    textposition="inside",
-                    textinfo="value+percent initial" if show_values else "none",
-                    marker=dict(
-                        color=colors[:len(funnel_data)],
-                        line=dict(width=1, color='white')
-                    ),
-                    opacity=0.8
-                ))
-
-                # Добавляем кастомные проценты если нужно
-                if show_values and show_percentage:
-                    values = funnel_data['Значение'].tolist()
-                    text_labels = []
-                    for i in range(len(values)):
-                        if i == 0:
-                            text_labels.append(f"{values[i]:.1f}")
-                        else:
-                            if values[i - 1] > 0:
-                                percent = (values[i] / values[i - 1]) * 100.0
-                                text_labels.append(f"{values[i]:.1f}<br>({percent:.1f}%)")
-                            else:
-                                text_labels.append(f"{values[i]:.1f}<br>(0%)")
-
-                    fig.update_traces(
-                        text=text_labels,
-                        textposition="inside",
-                        textfont=dict(size=12, color='white')
-                    )
-
-                fig.update_layout(
-                    title=f"Воронка продаж - {period_label} - {selected_branch if selected_branch != 'Все филиалы' else 'Все филиалы'}",
-                    height=600,  # Увеличили высоту
-                    showlegend=False,
-                    template='plotly_white',
-                    font=dict(
-                        size=14,  # Увеличили основной шрифт
-                        family="Arial, sans-serif"
-                    ),
-                    title_font=dict(
-                        size=20,  # Увеличили заголовок
-                        family="Arial, sans-serif",
-                        color='#1f77b4'
-                    ),
-                    margin=dict(t=100, l=80, r=50, b=80),  # Увеличили отступы
-                    xaxis_title=metric,
-                    yaxis_title="Этап продаж",
-                )
-
+            fig = build_funnel_figure(
+                tuple(funnel_data['Этап']),
+                tuple(funnel_data['Значение'].tolist()),
+                metric,
+                funnel_orientation,
+                tuple(color_options[selected_color]),
+                show_values,
+                show_percentage,
+                f"Воронка продаж - {period_label} - {selected_branch if selected_branch != 'Все филиалы' else 'Все филиалы'}"
+            )
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("Нет данных для построения воронки")
+    profile.lap('funnel_chart')
 
     with col2:
         st.subheader("📈 Конверсия между этапами")
@@ -383,22 +767,12 @@ if uploaded_file is not None and df is not None:
             values = funnel_data['Значение'].tolist()
 
             if len(values) >= 2:
-                conversion_rates = []
-                for i in range(len(values) - 1):
-                    if values[i] > 0:
-                        rate = (values[i + 1] / values[i]) * 100
-                        conversion_rates.append({
-                            'Переход': f"{stages[i]} → {stages[i + 1]}",
-                            'Конверсия': round(rate, 1)
-                        })
-                    else:
-                        conversion_rates.append({
-                            'Переход': f"{stages[i]} → {stages[i + 1]}",
-                            'Конверсия': 0.0
-                        })
+                conversion_df = pd.DataFrame({
+                    'Переход': [f"{stages[i]} → {stages[i + 1]}" for i in range(len(values) - 1)],
+                    'Конверсия': conversion_rates(values).round(1)
+                })
 
-                if conversion_rates:
-                    conversion_df = pd.DataFrame(conversion_rates)
+                if not conversion_df.empty:
 
                     # Создаем стилизованную таблицу
                     st.dataframe(
@@ -416,11 +790,9 @@ if uploaded_file is not None and df is not None:
                     )
 
                     # ИТОГОВАЯ конверсия (от первого к последнему этапу)
-                    if values[0] > 0 and values[-1] > 0:
-                        total_conversion = (values[-1] / values[0]) * 100
-                        st.metric("Итоговая конверсия", f"{total_conversion:.1f}%")
-                    elif values[0] > 0:
-                        st.metric("Итоговая конверсия", "0%")
+                    total_rate = float(total_conversion(values))
+                    if total_rate > 0:
+                        st.metric("Итоговая конверсия", f"{total_rate:.1f}%")
                     else:
                         st.metric("Итоговая конверсия", "0%")
                 else:
@@ -429,6 +801,7 @@ if uploaded_file is not None and df is not None:
                 st.info("Недостаточно этапов для расчета конверсии")
         else:
             st.info("Загрузите данные для просмотра конверсии")
+    profile.lap('conversion')
 
     # Детализированные данные
     st.markdown("---")
@@ -438,74 +811,23 @@ if uploaded_file is not None and df is not None:
     with col1:
         st.subheader("📋 Детализированные данные")
 
+        # Обе метрики берутся из того же среза куба, без повторного сканирования
+        detail_df = pd.DataFrame({'Этап': stages})
+        for m, data_type in enumerate(axes.metrics):
+            detail_df[data_type] = slice_values[:, m].astype(float)
+
         if selected_branch != 'Все филиалы':
-            if period_option == 'За весь период':
-                # Данные за весь период для конкретного филиала
-                filtered_by_branch = df[df[('Филиал', '')] == selected_branch]
-                display_data = []
-
-                for stage in stages:
-                    total_count = filtered_by_branch[(stage, 'Кол-во')].sum()
-                    total_tonnage = filtered_by_branch[(stage, 'Тонн')].sum()
-
-                    display_data.append({
-                        'Этап': stage,
-                        'Кол-во': float(total_count),
-                        'Тонн': float(total_tonnage)
-                    })
-
-                display_df = pd.DataFrame(display_data)
+            if period_option == 'За весь период' or slice_rows > 0:
+                display_df = detail_df
                 st.dataframe(display_df, use_container_width=True, hide_index=True)
             else:
-                if 'filtered_data' in locals() and not filtered_data.empty:
-                    display_data = []
-
-                    for stage in stages:
-                        display_data.append({
-                            'Этап': stage,
-                            'Кол-во': float(filtered_data.iloc[0][(stage, 'Кол-во')]),
-                            'Тонн': float(filtered_data.iloc[0][(stage, 'Тонн')])
-                        })
-
-                    display_df = pd.DataFrame(display_data)
-                    st.dataframe(display_df, use_container_width=True, hide_index=True)
-                else:
-                    st.info("Нет данных для выбранного филиала")
+                st.info("Нет данных для выбранного филиала")
         else:
-            # Для всех филиалов
-            if period_option == 'За весь период':
-                aggregated_data = []
-
-                for stage in stages:
-                    total_count = df[(stage, 'Кол-во')].sum()
-                    total_tonnage = df[(stage, 'Тонн')].sum()
-
-                    aggregated_data.append({
-                        'Этап': stage,
-                        'Кол-во': float(total_count),
-                        'Тонн': float(total_tonnage)
-                    })
-
-                aggregated_df = pd.DataFrame(aggregated_data)
+            if period_option == 'За весь период' or slice_rows > 0:
+                aggregated_df = detail_df
                 st.dataframe(aggregated_df, use_container_width=True, hide_index=True)
             else:
-                if 'filtered_by_date' in locals() and not filtered_by_date.empty:
-                    aggregated_data = []
-
-                    for stage in stages:
-                        total_count = filtered_by_date[(stage, 'Кол-во')].sum()
-                        total_tonnage = filtered_by_date[(stage, 'Тонн')].sum()
-
-                        aggregated_data.append({
-                            'Этап': stage,
-                            'Кол-во': float(total_count),
-                            'Тонн': float(total_tonnage)
-                        })
-
-                    aggregated_df = pd.DataFrame(aggregated_data)
-                    st.dataframe(aggregated_df, use_container_width=True, hide_index=True)
-                else:
-                    st.info("Нет данных для выбранной даты")
+                st.info("Нет данных для выбранной даты")
 
     with col2:
         st.subheader("📊 Статистика")
@@ -514,41 +836,44 @@ if uploaded_file is not None and df is not None:
             values = funnel_data['Значение'].tolist()
 
             if values:
+                # Для всего периода и диапазона дат дополнительно считается среднедневной результат
+                if period_option != 'Конкретная дата':
+                    range_lo, range_hi = date_range_positions(axes, date_from, date_to)
+                    days_count = range_hi - range_lo
+                else:
+                    days_count = None
+                stats = funnel_stats(values, days_count=days_count)
                 col1_stats, col2_stats = st.columns(2)
 
                 with col1_stats:
                     st.metric(
                         "Начальный этап",
-                        f"{values[0]:.1f}",
+                        f"{stats['initial']:.1f}",
                         help="Количество на первом этапе воронки"
                     )
 
                 with col2_stats:
-                    if values[-1] > 0:
+                    if stats['final'] > 0:
                         st.metric(
                             "Конечный этап",
-                            f"{values[-1]:.1f}",
+                            f"{stats['final']:.1f}",
                             help="Количество на последнем этапе воронки"
                         )
 
                 # Общая конверсия
-                if values[0] > 0 and values[-1] > 0:
-                    total_conversion = (values[-1] / values[0]) * 100
-                    st.metric("Общая конверсия", f"{total_conversion:.1f}%")
+                if stats['conversion'] > 0:
+                    st.metric("Общая конверсия", f"{stats['conversion']:.1f}%")
 
                 # Потери
-                losses = values[0] - values[-1]
-                st.metric("Общие потери", f"{losses:.1f}")
-
-                # Дополнительная статистика для всего периода
-                if period_option == 'За весь период':
-                    days_count = len(df[('Дата', '')].unique())
-                    if days_count > 0:
-                        avg_per_day = values[-1] / days_count
-                        st.metric(
-                            "Среднедневной результат",
-                            f"{avg_per_day:.1f}"
-                        )
+                st.metric("Общие потери", f"{stats['losses']:.1f}")
+
+                if 'per_day' in stats:
+                    st.metric(
+                        "Среднедневной результат",
+                        f"{stats['per_day']:.1f}"
+                    )
+
+    profile.lap('details')
 
     # Кнопка скачивания данных
     st.markdown("---")
@@ -574,34 +899,471 @@ if uploaded_file is not None and df is not None:
                 use_container_width=True
             )
 
-    # Показ исходных данных если выбран
-    if show_table:
+    # Полная выгрузка: воронки всех дат × филиалов или исходные строки текущего фильтра.
+    # Файл пишется блоками во временный файл по кнопке и не пересобирается на каждом перезапуске.
+    with st.expander("📦 Полная выгрузка"):
+        export_content = st.radio(
+            "Содержимое:",
+            ['Воронки по всем датам и филиалам', 'Исходные строки выбранного периода и филиала'],
+            index=0 if in_memory else 1,
+            disabled=not in_memory,
+            horizontal=True
+        )
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            export_format = st.selectbox("Формат:", list(EXPORT_FORMATS), format_func=str.upper)
+        with col2:
+            export_gzip = st.checkbox("Сжать gzip", value=False, disabled=export_format == 'xlsx')
+        with col3:
+            export_totals = st.checkbox(
+                "Итоги", value=True, disabled=export_content != 'Воронки по всем датам и филиалам'
+            )
+
+        if period_option == 'Конкретная дата':
+            export_from = export_to = selected_date
+        else:
+            export_from, export_to = date_from, date_to
+        export_raw = export_content != 'Воронки по всем датам и филиалам'
+        export_key = (
+            str(st.session_state['dataset']['fingerprints'] if in_memory else st.session_state['store']['key']), export_raw, export_format,
+            export_gzip and export_format != 'xlsx', export_totals,
+            (str(export_from), str(export_to), branch_filter) if export_raw else None
+        )
+
+        if st.button("Подготовить файл"):
+            previous = st.session_state.pop('export', None)
+            if previous is not None and os.path.exists(previous['path']):
+                os.remove(previous['path'])
+            if export_raw:
+                if in_memory:
+                    chunks = raw_chunks(table, export_from, export_to, branch_filter)
+                else:
+                    # Из хранилища читаются только блоки периода и филиала, по одному за раз
+                    chunks = (
+                        chunk
+                        for part in store.table_chunks(export_from, export_to, branch_filter)
+                        for chunk in raw_chunks(part)
+                    )
+                stem = f"строки_{selected_branch}_{'весь_период' if period_option == 'За весь период' else selected_date}"
+            else:
+                chunks = funnel_chunks(cube, totals=export_totals)
+                stem = "воронки_дата_филиал"
+            compress = export_gzip and export_format != 'xlsx'
+            fd, path = tempfile.mkstemp(prefix='funnel_export_', suffix=export_file_name('', export_format, compress))
+            os.close(fd)
+            try:
+                with st.spinner("Выгрузка..."):
+                    n_rows = write_export(chunks, path, export_format, compress=compress)
+                st.session_state['export'] = {
+                    'key': export_key,
+                    'path': path,
+                    'file_name': export_file_name(stem, export_format, compress),
+                    'mime': export_mime(export_format, compress),
+                    'rows': n_rows,
+                }
+            except (ValueError, RuntimeError, OSError) as e:
+                os.remove(path)
+                st.error(f"❌ Не удалось подготовить выгрузку: {str(e)}")
+
+        export = st.session_state.get('export')
+        if export is not None and export['key'] == export_key and os.path.exists(export['path']):
+            st.caption(f"Строк: {export['rows']}, размер: {os.path.getsize(export['path']) / 2 ** 20:.1f} МБ")
+            with open(export['path'], 'rb') as f:
+                st.download_button(
+                    label=f"📥 Скачать {export['file_name']}",
+                    data=f,
+                    file_name=export['file_name'],
+                    mime=export['mime'],
+                )
+
+    profile.lap('download')
+
+    # Воронки по календарным периодам и скользящему окну (разности префиксных сумм по оси дат)
+    if show_periods:
         st.markdown("---")
-        st.subheader("📄 Исходные данные")
+        st.subheader(f"📆 Воронка по периодам - {metric}")
+
+        frequencies = {'Неделя': 'W', 'Месяц': 'M', 'Квартал': 'Q', 'Скользящее окно': None}
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            frequency = st.radio("Группировка:", list(frequencies), horizontal=True)
+        with col2:
+            window_days = st.number_input(
+                "Окно, дней:",
+                min_value=1,
+                max_value=3650,
+                value=7,
+                disabled=frequency != 'Скользящее окно'
+            )
 
-        # Упрощаем отображение для лучшей читаемости
-        display_columns = [('Дата', ''), ('Филиал', '')]
-        for stage in stages[:3]:
-            display_columns.append((stage, 'Кол-во'))
-            display_columns.append((stage, 'Тонн'))
+        # Периоды строятся внутри выбранного диапазона (для конкретной даты - внутри этого дня)
+        if selected_date_dt is not None:
+            periods_from = periods_to = selected_date_dt
+        else:
+            periods_from, periods_to = date_from, date_to
+        if frequencies[frequency] is None:
+            period_dates, period_values, period_rows = rolling_funnels(
+                cube, int(window_days), branch=branch_filter, date_from=periods_from, date_to=periods_to
+            )
+        else:
+            period_dates, period_values, period_rows = resample_funnels(
+                cube, frequencies[frequency], branch=branch_filter, date_from=periods_from, date_to=periods_to
+            )
+
+        period_metric_values = period_values[:, :, metric_idx]
+        periods_df = pd.DataFrame(period_metric_values, columns=stages)
+        periods_df.insert(0, 'Период', np.datetime_as_string(period_dates, unit='D'))
+        periods_df['Итоговая конверсия, %'] = total_conversion(period_metric_values).round(1)
+        periods_df['Строк'] = period_rows
+
+        if periods_df.empty:
+            st.info("Нет данных за выбранный период")
+        else:
+            st.dataframe(periods_df, use_container_width=True, hide_index=True)
+        profile.lap('periods')
 
-        preview_df = df[display_columns].head(20)
+    # Динамика воронки: ряды по префиксным суммам куба за все даты хранятся в сессии;
+    # после дозагрузки файлов пересчитываются только периоды с первой новой даты
+    if show_trend:
+        st.markdown("---")
+        st.subheader(f"📈 Динамика воронки - {metric}")
 
-        # Преобразуем для лучшего отображения
-        preview_display = preview_df.copy()
-        preview_display[('Дата', '')] = preview_display[('Дата', '')].dt.strftime('%Y-%m-%d')
+        trend_frequencies = {'По дням': 'D', 'По неделям': 'W', 'По месяцам': 'M'}
+        trend_frequency = trend_frequencies[st.radio("Шаг:", list(trend_frequencies), horizontal=True)]
 
-        # Округляем числа для читаемости
-        for col in preview_display.columns:
-            if col[1] in ['Кол-во', 'Тонн']:
-                preview_display[col] = preview_display[col].apply(
-                    lambda x: f"{x:.1f}" if isinstance(x, (int, float)) else x
+        dataset = st.session_state['dataset']
+        trend_cache = st.session_state.setdefault('trend', {})
+        cached = trend_cache.get((trend_frequency, branch_filter))
+        if cached is not None and cached['key'] == dataset['lease'].key:
+            trend = cached['series']
+        else:
+            incremental = cached is not None and dataset['appended'].get('previous') == cached['key']
+            trend = trend_series(
+                cube, trend_frequency, branch=branch_filter,
+                previous=cached['series'] if incremental else None,
+                changed_from=dataset['appended']['changed_from'] if incremental else None
+            )
+            trend_cache[(trend_frequency, branch_filter)] = {'key': dataset['lease'].key, 'series': trend}
+        trend_dates, trend_values, _ = trend
+
+        # Для диапазона дат показываются периоды, начинающиеся внутри него
+        if period_option == 'Диапазон дат':
+            first_period = period_starts(np.array([date_from], dtype='datetime64[D]'), trend_frequency)[0]
+            shown = (trend_dates >= first_period) & (trend_dates <= np.datetime64(date_to, 'D'))
+            trend_dates, trend_values = trend_dates[shown], trend_values[shown]
+        trend_volumes = trend_values[:, :, metric_idx]
+
+        if len(trend_dates) == 0:
+            st.info("Нет данных за выбранный период")
+        else:
+            trend_colors = tuple(color_options[selected_color])
+            st.markdown("**Объем по этапам**")
+            st.plotly_chart(
+                build_trend_figure(trend_dates, trend_volumes, tuple(stages), metric, trend_colors, TREND_MAX_POINTS),
+                use_container_width=True
+            )
+            if len(stages) > 1:
+                st.markdown("**Конверсия между этапами, %**")
+                transitions = tuple(f"{stages[i]} → {stages[i + 1]}" for i in range(len(stages) - 1))
+                st.plotly_chart(
+                    build_trend_figure(
+                        trend_dates, conversion_rates(trend_volumes), transitions, "%", trend_colors, TREND_MAX_POINTS
+                    ),
+                    use_container_width=True
+                )
+            if len(trend_dates) > TREND_MAX_POINTS:
+                st.caption(
+                    f"Периодов: {len(trend_dates)}; на графике не больше {TREND_MAX_POINTS} точек на линию "
+                    f"(минимумы и максимумы каждого отрезка)"
                 )
+        profile.lap('trend')
+
+    # Конверсия по всем филиалам сразу (одна операция над кубом вместо перебора филиалов)
+    if show_branch_conversion:
+        st.markdown("---")
+        st.subheader(f"🔥 Конверсия по филиалам - {metric}")
+
+        transitions = [f"{stages[i]} → {stages[i + 1]}" for i in range(len(stages) - 1)]
 
-        st.dataframe(preview_display, use_container_width=True)
+        heatmap_mode = st.radio(
+            "Разрез тепловой карты:",
+            ['Филиалы × переходы', 'Филиалы × даты (итоговая конверсия)'],
+            horizontal=True
+        )
+
+        # Таблица по филиалам за выбранный период: объем первого этапа, переходы и итоговая конверсия
+        branch_values, branch_rates, branch_totals = branch_conversion(
+            cube, metric, date=selected_date_dt, date_from=date_from, date_to=date_to
+        )
+        conversion_table = pd.DataFrame(branch_rates.round(1), columns=transitions)
+        conversion_table.insert(0, 'Филиал', cube.branches)
+        conversion_table.insert(1, stages[0], branch_values[:, 0])
+        conversion_table['Итоговая конверсия'] = branch_totals.round(1)
+
+        sort_column = st.selectbox(
+            "Сортировать по:",
+            ['Итоговая конверсия'] + transitions + [stages[0]],
+            help="По возрастанию: худшие филиалы сверху"
+        )
+        conversion_table = conversion_table.sort_values(sort_column, kind='stable').reset_index(drop=True)
+
+        if heatmap_mode == 'Филиалы × переходы':
+            heatmap_z = conversion_table[transitions + ['Итоговая конверсия']].to_numpy()
+            heatmap_x = transitions + ['Итоговая конверсия']
+            heatmap_y = conversion_table['Филиал'].tolist()
+        else:
+            # Итоговая конверсия по каждой дате; ячейки без исходных строк не закрашиваются
+            if selected_date_dt is not None:
+                range_lo, range_hi = date_range_positions(cube, selected_date_dt, selected_date_dt)
+            else:
+                range_lo, range_hi = date_range_positions(cube, date_from, date_to)
+            _, total_matrix = conversion_matrix(cube, metric)
+            total_matrix = np.where(cube.rows > 0, total_matrix.round(1), np.nan)[range_lo:range_hi]
+            order = [cube.branch_index[branch] for branch in conversion_table['Филиал']]
+            heatmap_z = total_matrix[:, order].T
+            heatmap_x = [str(date) for date in np.datetime_as_string(cube.dates[range_lo:range_hi], unit='D')]
+            heatmap_y = conversion_table['Филиал'].tolist()
+
+        fig_heatmap = go.Figure(go.Heatmap(
+            z=heatmap_z,
+            x=heatmap_x,
+            y=heatmap_y,
+            colorscale='RdYlGn',
+            zmin=0,
+            zmax=100,
+            colorbar=dict(title="%"),
+            hovertemplate="%{y}<br>%{x}: %{z:.1f}%<extra></extra>"
+        ))
+        fig_heatmap.update_layout(LIGHT_LAYOUT)
+        fig_heatmap.update_layout(
+            height=max(400, 22 * len(heatmap_y) + 150),
+            margin=dict(t=40, l=200, r=40, b=80),
+            yaxis=dict(autorange="reversed")
+        )
+        st.plotly_chart(fig_heatmap, use_container_width=True)
+
+        st.dataframe(conversion_table, use_container_width=True, hide_index=True)
+        profile.lap('branch_conversion')
+
+    # Сравнение филиалов: воронки набора филиалов одной выборкой из куба
+    if show_comparison:
+        st.markdown("---")
+        st.subheader(f"🏢 Сравнение филиалов - {metric}")
 
-        if len(df) > 20:
-            st.caption(f"Показано 20 из {len(df)} записей. Загрузите полные данные для детального анализа.")
+        col1, col2, col3 = st.columns([3, 1, 1])
+        with col1:
+            compared_branches = st.multiselect(
+                "Филиалы:", cube.branches,
+                help="Если ничего не выбрано, берутся филиалы с наибольшим объемом первого этапа"
+            )
+        with col2:
+            top_branches = st.number_input(
+                "Топ по первому этапу:", min_value=1, max_value=max(len(cube.branches), 1),
+                value=min(12, max(len(cube.branches), 1)), step=1, disabled=bool(compared_branches)
+            )
+        with col3:
+            comparison_mode = st.radio("Вид:", ['Малые воронки', 'Наложенные'])
+
+        comparison_names, comparison_values = compare_branches(
+            cube, metric,
+            branches=compared_branches or None,
+            top=None if compared_branches else int(top_branches),
+            date=selected_date_dt, date_from=date_from, date_to=date_to
+        )
+        comparison_values = np.asarray(comparison_values, dtype=np.float64)
+        if normalize_values:
+            # Доля от первого этапа своего филиала: сравнивается форма воронок, а не объем
+            first = comparison_values[:, :1]
+            comparison_values = np.divide(
+                comparison_values * 100, first, out=np.zeros_like(comparison_values), where=first > 0
+            )
+
+        if comparison_names:
+            fig_comparison = build_comparison_figure(
+                tuple(stages),
+                tuple(comparison_names),
+                tuple(comparison_values.ravel().tolist()),
+                f"{metric}, % от первого этапа" if normalize_values else metric,
+                comparison_mode,
+                tuple(color_options[selected_color]),
+                f"Сравнение филиалов - {period_label}"
+            )
+            st.plotly_chart(fig_comparison, use_container_width=True)
+
+            comparison_table = pd.DataFrame(comparison_values.round(1), columns=stages)
+            comparison_table.insert(0, 'Филиал', comparison_names)
+            comparison_table['Итоговая конверсия, %'] = total_conversion(comparison_values).round(1)
+            st.dataframe(comparison_table, use_container_width=True, hide_index=True)
+        else:
+            st.info("Нет филиалов для сравнения")
+        profile.lap('branch_comparison')
+
+    # Прогноз этапов на следующий период: одна модель сразу для всех филиалов по рядам из куба
+    if show_forecast:
+        st.markdown("---")
+        st.subheader(f"🔮 Прогноз на следующий период - {metric}")
+
+        col1, col2 = st.columns([1, 3])
+        with col1:
+            forecast_frequencies = {'Неделя': 'W', 'Месяц': 'M', 'Квартал': 'Q'}
+            forecast_frequency = forecast_frequencies[
+                st.radio("Период:", list(forecast_frequencies), index=1, horizontal=True)
+            ]
+        with col2:
+            forecast_targets = st.multiselect("Прогнозируемые этапы:", stages, default=stages[-2:])
+
+        forecast = None
+        if not forecast_targets:
+            st.info("Выберите этапы для прогноза")
+        else:
+            try:
+                forecast = forecast_cached(
+                    st.session_state['dataset']['lease'].key, metric, forecast_frequency,
+                    tuple(forecast_targets), cube
+                )
+            except ValueError as e:
+                st.info(str(e))
+
+        if forecast is not None:
+            target_label = pd.Timestamp(forecast.target_start).strftime('%Y-%m-%d')
+            b = cube.branch_index[branch_filter] if branch_filter is not None else None
+            # Для всех филиалов - сумма прогнозов филиалов
+            history = forecast.history[:, b] if b is not None else forecast.history.sum(axis=1)
+            predicted = forecast.forecast[b] if b is not None else forecast.forecast.sum(axis=0)
+
+            forecast_cols = st.columns(len(forecast.targets))
+            for i, target in enumerate(forecast.targets):
+                with forecast_cols[i]:
+                    st.metric(
+                        f"{target}, период с {target_label}",
+                        f"{predicted[i]:.1f}",
+                        f"{predicted[i] - history[-1, i]:+.1f} к прошлому периоду"
+                    )
+            st.plotly_chart(
+                build_forecast_figure(
+                    forecast.starts, history, forecast.target_start, predicted,
+                    tuple(forecast.targets), metric, tuple(color_options[selected_color])
+                ),
+                use_container_width=True
+            )
+            st.caption(
+                "Ошибка модели на последнем полном периоде (прогноз без него, все филиалы): "
+                + ", ".join(f"{target} {wape:.1f}%" for target, wape in zip(forecast.targets, forecast.wape))
+                + ". Неполный текущий период в обучение не входит."
+            )
+
+            forecast_table = pd.DataFrame({'Филиал': forecast.branches})
+            for i, target in enumerate(forecast.targets):
+                forecast_table[f'{target}: последний период'] = forecast.history[-1, :, i].round(1)
+                forecast_table[f'{target}: прогноз'] = forecast.forecast[:, i].round(1)
+            st.dataframe(forecast_table, use_container_width=True, hide_index=True)
+        profile.lap('forecast')
+
+    # Проверка данных выполнена при загрузке: здесь только сводка и строки выбранной проверки
+    if show_quality:
+        st.markdown("---")
+        st.subheader("🩺 Качество данных")
+
+        quality_counts = quality.counts
+        quality_cols = st.columns(len(QUALITY_CHECKS))
+        for i, (check, title) in enumerate(QUALITY_CHECKS.items()):
+            with quality_cols[i]:
+                st.metric(title, quality_counts[check])
+        st.caption(
+            "Строки без даты или филиала не входят в воронки, в том числе в итоги «Все филиалы» и «За весь период». "
+            "Нечисловые ячейки при загрузке приводятся к 0. Строки с одной датой и филиалом в воронке суммируются "
+            f"(пар дата+филиал с повторами: {quality.duplicate_groups}). Немонотонная воронка - строка, где этап "
+            f"больше предыдущего. Дни-выбросы - дни, когда этап «{stages[0]}» филиала далек от медианы его дней: "
+            f"модифицированная z-оценка по MAD больше {quality.threshold:g}."
+        )
+
+        quality_summary = branch_summary(table, cube, quality)
+        if quality_summary.empty:
+            st.success("✅ Проблем в данных не найдено")
+        else:
+            st.dataframe(quality_summary, use_container_width=True)
+
+            col1, col2 = st.columns(2)
+            with col1:
+                quality_check = st.selectbox(
+                    "Проверка:", [check for check in QUALITY_CHECKS if quality_counts[check]],
+                    format_func=QUALITY_CHECKS.get
+                )
+            with col2:
+                quality_branch = st.selectbox("Филиал:", ['Все филиалы'] + list(quality_summary.index))
+            quality_branch = quality_branch if quality_branch != 'Все филиалы' else None
+
+            if quality_check == 'outliers':
+                quality_frame = outliers_frame(cube, quality, quality_branch)
+                n_found = len(quality_frame)
+                quality_frame = quality_frame.head(QUALITY_PREVIEW_ROWS)
+            else:
+                quality_frame, n_found = issue_rows_frame(
+                    table, quality, quality_check, quality_branch, limit=QUALITY_PREVIEW_ROWS
+                )
+                if quality_check == 'non_monotone':
+                    st.dataframe(non_monotone_frame(table, quality), use_container_width=True)
+            st.dataframe(quality_frame, use_container_width=True, hide_index=True)
+            st.caption(f"Показано {len(quality_frame)} из {n_found}")
+        profile.lap('quality')
+
+    # Показ исходных данных если выбран
+    if show_table:
+        st.markdown("---")
+        st.subheader("📄 Исходные данные")
+
+        # Просмотр постранично: фильтр и сортировка считаются по компактным массивам таблицы,
+        # форматируется только видимая страница
+        col1, col2, col3, col4 = st.columns([2, 2, 1, 1])
+        with col1:
+            browse_filtered = st.checkbox("Только выбранные период и филиал", value=False)
+        with col2:
+            sort_options = ['Строка', 'Дата', 'Филиал'] + [(stage, m) for stage in stages for m in cube.metrics]
+            sort_column = st.selectbox(
+                "Сортировать по:", sort_options,
+                format_func=lambda option: option if isinstance(option, str) else f"{option[0]}, {option[1]}"
+            )
+        with col3:
+            sort_descending = st.checkbox("По убыванию", value=False)
+        with col4:
+            page_size = st.selectbox("Строк на странице:", [20, 50, 100, 500])
+        browse_stages = st.multiselect("Этапы:", stages, default=stages)
+
+        if browse_filtered:
+            if period_option == 'Конкретная дата':
+                browse_from = browse_to = selected_date
+            else:
+                browse_from, browse_to = date_from, date_to
+            browse_filter = (browse_from, browse_to, branch_filter)
+        else:
+            browse_filter = (None, None, None)
+
+        # Порядок строк сохраняется в сессии: смена страницы не пересчитывает фильтр и сортировку
+        browse_key = (
+            str(st.session_state['dataset']['fingerprints']),
+            tuple(str(value) for value in browse_filter), str(sort_column), sort_descending
+        )
+        browse = st.session_state.get('browse')
+        if browse is None or browse['key'] != browse_key:
+            rows = table_rows(table, *browse_filter)
+            if sort_column != 'Строка':
+                rows = sort_rows(table, rows, sort_column, descending=sort_descending)
+            elif sort_descending:
+                rows = rows[::-1]
+            browse = {'key': browse_key, 'rows': rows}
+            st.session_state['browse'] = browse
+        rows = browse['rows']
+
+        n_pages = max(-(-len(rows) // page_size), 1)
+        page = st.number_input("Страница:", min_value=1, max_value=n_pages, value=1, step=1)
+        page_rows = rows[(page - 1) * page_size:page * page_size]
+
+        st.dataframe(table_page_frame(table, page_rows, browse_stages), use_container_width=True, hide_index=True)
+        st.caption(
+            f"Строки {(page - 1) * page_size + 1 if len(page_rows) else 0}–{(page - 1) * page_size + len(page_rows)} "
+            f"из {len(rows)} (всего записей: {len(table)}), страница {page} из {n_pages}"
+        )
+        profile.lap('raw_data')
 
     # Инструкция
     with st.expander("ℹ️ Инструкция по использованию"):
@@ -632,9 +1394,25 @@ if uploaded_file is not None and df is not None:
         ### Формат файла:
         Файл должен содержать столбцы:
         - Дата, Филиал
-        - Для каждого этапа: Кол-во и Тонн
-        - Этапы: Холодный, Встреча, КП, Согласование, Договор, Поставка
+        - Для каждого этапа: Кол-во и Тонн (и другие метрики, если они есть в заголовке)
+        - Этапы и метрики читаются из двух строк заголовков или из файла схемы (JSON)
         """)
 
 else:
-    st.info("👈 Пожалуйста, загрузите Excel-файл через боковую панель для начала анализа")
\ No newline at end of file
+    st.info("👈 Пожалуйста, загрузите Excel-файл через боковую панель для начала анализа")
+
+# Панель отладки: время и память по фазам этого перезапуска, запись в журнал и textfile Prometheus
+if profile.enabled:
+    profile.lap('instructions')
+    total_seconds = profile.finish()
+    with st.sidebar:
+        with st.expander("⏱️ Замеры перезапуска", expanded=True):
+            st.dataframe(pd.DataFrame(profile.rows()), hide_index=True, use_container_width=True)
+            st.caption(f"Весь перезапуск: {total_seconds * 1000:.0f} мс")
+        try:
+            if DEFAULT_LOG_PATH:
+                profile.append_log(DEFAULT_LOG_PATH, rows=len(table if in_memory else store), files=len(sources))
+            if DEFAULT_TEXTFILE_PATH:
+                profile.write_textfile(DEFAULT_TEXTFILE_PATH)
+        except OSError as e:
+            st.warning(f"⚠️ Не удалось записать замеры: {str(e)}")
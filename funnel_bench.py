@@ -0,0 +1,414 @@
+import argparse
+import ast
+import dataclasses
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from funnel_cache import DiskCache
+from funnel_core import (
+    build_cube, default_agg_workers, cube_lookup, range_lookup, conversion_rates, total_conversion, conversion_matrix, funnel_chunks,
+    build_row_index, table_rows
+)
+from funnel_export import write_export
+from funnel_io import read_table, content_key, load_cached, store_dataset, table_differences
+from funnel_quality import validate
+from funnel_schema import STAGES, METRICS
+
+# Лист Excel вмещает 1 048 576 строк, из них две - заголовки; более крупные наборы пишутся в CSV
+EXCEL_MAX_ROWS = 1048576 - 2
+
+# Книги до стольких строк читаются еще и через pandas: сравнение режимов и проверка, что таблицы совпадают
+PANDAS_MAX_ROWS = 100000
+
+DEFAULT_SIZES = [10000, 1000000, 10000000]
+DEFAULT_WORK_DIR = os.path.join(tempfile.gettempdir(), 'sales_funnel_bench')
+
+# Бюджет холодного старта приложения в секундах и скрипт приложения. 2 с - замер (около 1.3 с: python -X importtime,
+# импорты верхнего уровня app_funnel, из них streamlit и pandas ~1 с) с запасом 50%; 0 - без проверки
+DEFAULT_STARTUP_BUDGET = float(os.environ.get('FUNNEL_STARTUP_BUDGET', 2.0))
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_funnel.py')
+
+
+# Синтетические значения: первый этап - от 50 до 100, каждый следующий - 40-90% предыдущего.
+# Первая метрика - целые количества, остальные - количества, умноженные на коэффициент метрики.
+def synthetic_values(n_rows, n_stages, n_metrics, seed=1):
+    rng = np.random.default_rng(seed)
+    counts = np.empty((n_rows, n_stages))
+    counts[:, 0] = rng.integers(50, 101, n_rows)
+    for s in range(1, n_stages):
+        counts[:, s] = np.floor(counts[:, s - 1] * rng.uniform(0.4, 0.9, n_rows))
+    factors = np.concatenate([[1.0], 1.5 * 10.0 ** np.arange(n_metrics - 1)])
+    values = np.round(counts[:, :, None] * factors, 1)
+    values[:, :, 0] = counts
+    return values.reshape(n_rows, n_stages * n_metrics)
+
+
+# Две строки заголовков в формате файла: этапы (объединенные ячейки - пустые) и метрики
+def synthetic_header(stages, metrics):
+    stage_row = ['Дата', 'Филиал']
+    metric_row = ['', '']
+    for stage in stages:
+        stage_row += [stage] + [None] * (len(metrics) - 1)
+        metric_row += list(metrics)
+    return stage_row, metric_row
+
+
+def synthetic_stages(n_stages):
+    return STAGES[:n_stages] + [f'Этап_{i}' for i in range(len(STAGES), n_stages)]
+
+
+def synthetic_metrics(n_metrics):
+    return METRICS[:n_metrics] + [f'Метрика_{i}' for i in range(len(METRICS), n_metrics)]
+
+
+# Синтетический файл: n_dates дней подряд × n_branches филиалов, строки по датам.
+# xlsx пишется, если строки помещаются на лист Excel (или формат задан явно), иначе CSV.
+def generate_workbook(path, n_dates, n_branches, n_stages=6, n_metrics=2, seed=1, chunk_rows=2 ** 18):
+    stages, metrics = synthetic_stages(n_stages), synthetic_metrics(n_metrics)
+    stage_row, metric_row = synthetic_header(stages, metrics)
+    n_rows = n_dates * n_branches
+    first_day = np.datetime64('2024-01-01')
+    branch_names = np.array([f'Филиал {b}' for b in range(n_branches)], dtype=object)
+
+    if path.lower().endswith('.xlsx'):
+        if n_rows > EXCEL_MAX_ROWS:
+            raise ValueError(f"{n_rows} строк не помещаются на лист Excel (максимум {EXCEL_MAX_ROWS})")
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(stage_row)
+        ws.append(metric_row)
+    else:
+        f = open(path, 'w', encoding='utf-8', newline='')
+        pd.DataFrame([stage_row, metric_row]).to_csv(f, header=False, index=False)
+
+    try:
+        # Генерация блоками: память не зависит от размера файла
+        for start in range(0, n_rows, chunk_rows):
+            rows = np.arange(start, min(start + chunk_rows, n_rows))
+            days = first_day + rows // n_branches
+            values = synthetic_values(len(rows), n_stages, n_metrics, seed=seed + start)
+            if path.lower().endswith('.xlsx'):
+                dates = pd.to_datetime(days).to_pydatetime()
+                branches = branch_names[rows % n_branches]
+                for date, branch, row_values in zip(dates, branches, values.tolist()):
+                    ws.append([date, branch] + row_values)
+            else:
+                chunk = pd.DataFrame(values)
+                chunk.insert(0, 'branch', branch_names[rows % n_branches])
+                chunk.insert(0, 'date', np.datetime_as_string(days, unit='D'))
+                chunk.to_csv(f, header=False, index=False)
+    finally:
+        if path.lower().endswith('.xlsx'):
+            wb.save(path)
+        else:
+            f.close()
+    return path
+
+
+# Копия книги с размером листа (<dimension>): openpyxl в режиме write_only его не пишет, а книги из Excel
+# содержат, и потоковое чтение сразу выделяет массивы по нему. Лист копируется потоком, без разбора XML.
+def add_sheet_dimension(path, target, n_rows, n_columns):
+    from openpyxl.utils import get_column_letter
+
+    dimension = f'<dimension ref="A1:{get_column_letter(n_columns)}{n_rows}"/>'.encode()
+    with zipfile.ZipFile(path) as source, zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as result:
+        for item in source.infolist():
+            with source.open(item) as f, result.open(item.filename, 'w', force_zip64=True) as out:
+                if item.filename == 'xl/worksheets/sheet1.xml':
+                    # Элемент идет сразу после sheetPr, перед sheetViews - в начале листа
+                    out.write(f.read(2 ** 12).replace(b'<sheetViews>', dimension + b'<sheetViews>', 1))
+                shutil.copyfileobj(f, out, 2 ** 20)
+    return target
+
+
+# Время одного вызова: минимум по повторам, число вызовов в повторе подбирается до ~0.2 с
+def measure_time(function, repeat=3, min_seconds=0.2):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds or number >= 10 ** 6:
+            break
+        number *= 10
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+
+# Пиковая память одного вызова по tracemalloc (NumPy сообщает о своих выделениях), МБ
+def measure_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def run_step(name, function, results, repeat, memory, once=False):
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    if not once:
+        seconds = min(seconds, measure_time(function, repeat=repeat))
+    results[name] = {'seconds': seconds}
+    if memory:
+        results[name]['peak_mb'] = round(measure_memory(function), 3)
+    print(f"  {name}: {seconds:.6f} с", file=sys.stderr)
+    return value
+
+
+# Замеры для одного размера: разбор, куб, кэш, воронки, конверсия и выгрузка CSV
+def bench_size(n_rows, n_branches, n_stages, n_metrics, file_format, work_dir, repeat, memory, agg_workers=None):
+    n_dates = max(1, -(-n_rows // n_branches))
+    if file_format == 'auto':
+        file_format = 'xlsx' if n_dates * n_branches <= EXCEL_MAX_ROWS else 'csv'
+    path = os.path.join(work_dir, f'funnel_{n_dates}x{n_branches}x{n_stages}x{n_metrics}.{file_format}')
+    if not os.path.exists(path):
+        print(f"Генерация {path}", file=sys.stderr)
+        generate_workbook(path + '.tmp.' + file_format, n_dates, n_branches, n_stages, n_metrics)
+        os.replace(path + '.tmp.' + file_format, path)
+
+    print(f"{n_dates * n_branches} строк ({path})", file=sys.stderr)
+    steps = {}
+    # Разбор большого файла выполняется один раз: повторы заняли бы минуты
+    table = run_step('ingest', lambda: read_table(path), steps, repeat, memory, once=True)
+    if file_format == 'xlsx':
+        # Та же книга с размером листа, как у обычных файлов Excel: массивы выделяются один раз, без роста
+        sized_path = path[:-len('.xlsx')] + '_sized.xlsx'
+        if not os.path.exists(sized_path):
+            add_sheet_dimension(path, sized_path + '.tmp.xlsx', n_dates * n_branches + 2, 2 + n_stages * n_metrics)
+            os.replace(sized_path + '.tmp.xlsx', sized_path)
+        run_step('ingest_sized', lambda: read_table(sized_path), steps, repeat, memory, once=True)
+    reader_differences = []
+    if file_format == 'xlsx' and n_dates * n_branches <= PANDAS_MAX_ROWS:
+        # Оба режима чтения делят одну запись кэша, поэтому их таблицы должны совпадать
+        pandas_table = run_step(
+            'ingest_pandas', lambda: read_table(path, streaming=False), steps, repeat, memory, once=True
+        )
+        reader_differences = table_differences(table, pandas_table)
+    cube = run_step('build_cube', lambda: build_cube(table, workers=agg_workers), steps, repeat, memory, once=True)
+
+    # Постоянный кэш: запись разобранного файла и повторное открытие через mmap (вместе с хэшем файла)
+    with tempfile.TemporaryDirectory(dir=work_dir) as cache_dir:
+        cache = DiskCache(cache_dir, max_bytes=2 ** 40)
+        key = content_key(path)
+        run_step(
+            'cache_store', lambda: store_dataset(cache, f'{key}-{uuid.uuid4().hex}', table, cube),
+            steps, repeat, memory, once=True
+        )
+        store_dataset(cache, key, table, cube)
+        run_step('cache_load', lambda: load_cached(cache, content_key(path)), steps, repeat, memory)
+
+    metric = cube.metrics[0]
+    date = cube.dates[len(cube.dates) // 2]
+    branch = cube.branches[len(cube.branches) // 2]
+    run_step('funnel_whole_period', lambda: cube_lookup(cube), steps, repeat, memory)
+    run_step('funnel_single_date', lambda: cube_lookup(cube, date=date), steps, repeat, memory)
+    run_step('funnel_single_branch', lambda: cube_lookup(cube, branch=branch), steps, repeat, memory)
+    run_step('funnel_date_range', lambda: range_lookup(cube, cube.dates[0], date), steps, repeat, memory)
+
+    # Исходные строки филиала за диапазон дат (просмотр и выгрузка) по индексу строк
+    row_index = run_step('row_index', lambda: build_row_index(table), steps, repeat, memory, once=True)
+    indexed = dataclasses.replace(table, row_index=row_index)
+    run_step('rows_branch_range', lambda: table_rows(indexed, cube.dates[0], date, branch), steps, repeat, memory)
+
+    # Проверка данных при загрузке (с готовым индексом строк, как в приложении)
+    run_step('validate', lambda: validate(indexed, cube, workers=agg_workers), steps, repeat, memory, once=True)
+
+    values, _ = cube_lookup(cube)
+    run_step('conversion', lambda: (conversion_rates(values.T), total_conversion(values.T)), steps, repeat, memory)
+    run_step('conversion_matrix', lambda: conversion_matrix(cube, metric), steps, repeat, memory)
+
+    export_path = os.path.join(work_dir, 'export.csv')
+    run_step(
+        'csv_export', lambda: write_export(funnel_chunks(cube, totals=True), export_path, 'csv'),
+        steps, repeat, memory, once=True
+    )
+    os.remove(export_path)
+
+    return {
+        'rows': len(table),
+        'dates': n_dates,
+        'branches': n_branches,
+        'stages': n_stages,
+        'metrics': n_metrics,
+        'format': file_format,
+        'file_mb': round(os.path.getsize(path) / 2 ** 20, 3),
+        'table_mb': round(table.nbytes / 2 ** 20, 3),
+        'cube_mb': round(cube.nbytes / 2 ** 20, 3),
+        'reader_differences': reader_differences,
+        # Доля проверки данных во времени загрузки (разбор и куб)
+        'validate_share': round(
+            steps['validate']['seconds'] / (steps['ingest']['seconds'] + steps['build_cube']['seconds']), 4
+        ),
+        'steps': steps,
+    }
+
+
+# Модули, которые приложение импортирует при запуске (импорты верхнего уровня скрипта)
+def app_imports(path=APP_PATH):
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+# Холодный старт: импорт модулей приложения в новом процессе под python -X importtime.
+# Время процесса - минимум по повторам; imports - совокупное время импорта каждого модуля верхнего уровня
+# (вместе с тем, что он импортирует сам), от самых долгих к быстрым.
+def startup_profile(repeat=3, path=APP_PATH):
+    code = '; '.join(f'import {module}' for module in app_imports(path))
+    best = None
+    for _ in range(repeat):
+        # Процесс запускается в каталоге приложения: модули funnel_* берутся рядом со скриптом
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+            cwd=os.path.dirname(path), check=True
+        )
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best[0]:
+            best = (seconds, completed.stderr)
+
+    seconds, log = best
+    imports = {}
+    for line in log.splitlines():
+        # import time: собственное время, мкс | совокупное, мкс | модуль (вложенные - с отступом)
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        if len(name) - len(name.lstrip()) == 1:
+            imports[name.strip()] = int(parts[1]) / 1e6
+    print(f"Холодный старт: {seconds:.3f} с", file=sys.stderr)
+    for name, module_seconds in sorted(imports.items(), key=lambda item: -item[1])[:5]:
+        print(f"  {name}: {module_seconds:.3f} с", file=sys.stderr)
+    return {
+        'seconds': seconds,
+        'imports': dict(sorted(imports.items(), key=lambda item: -item[1])),
+    }
+
+
+# Шаги, ставшие медленнее базового замера больше чем на tolerance (доля)
+def regressions(result, baseline, tolerance):
+    found = []
+    base_startup, startup = baseline.get('startup'), result.get('startup')
+    if base_startup and startup and startup['seconds'] > base_startup['seconds'] * (1 + tolerance):
+        found.append(f"холодный старт: {base_startup['seconds']:.3f} с -> {startup['seconds']:.3f} с")
+    base_runs = {run['rows']: run for run in baseline.get('results', [])}
+    for run in result['results']:
+        base_run = base_runs.get(run['rows'])
+        if base_run is None:
+            continue
+        for name, step in run['steps'].items():
+            base_step = base_run['steps'].get(name)
+            if base_step and step['seconds'] > base_step['seconds'] * (1 + tolerance):
+                found.append(f"{run['rows']} строк, {name}: {base_step['seconds']:.6f} с -> {step['seconds']:.6f} с")
+    return found
+
+
+def write_json(result, path):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    os.replace(path + '.tmp', path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Замеры времени и памяти разбора и расчета воронок на синтетических данных"
+    )
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="размеры наборов в строках (по умолчанию 10k, 1M, 10M)")
+    parser.add_argument('--branches', type=int, default=200, help="число филиалов")
+    parser.add_argument('--stages', type=int, default=len(STAGES), help="число этапов воронки")
+    parser.add_argument('--metrics', type=int, default=len(METRICS), help="число метрик на этап")
+    parser.add_argument('--format', choices=['auto', 'xlsx', 'csv'], default='auto',
+                        help="формат файлов (auto - xlsx, пока строки помещаются на лист Excel)")
+    parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR, help="каталог для сгенерированных файлов")
+    parser.add_argument('--repeat', type=int, default=3, help="число повторов быстрых шагов")
+    parser.add_argument('--no-memory', action='store_true', help="не замерять пиковую память (tracemalloc)")
+    parser.add_argument('--agg-workers', type=int, default=None,
+                        help="число потоков для построения агрегатов (по умолчанию FUNNEL_AGG_WORKERS или число ядер)")
+    parser.add_argument('--startup-only', action='store_true',
+                        help="только замер холодного старта приложения (импорт модулей), без наборов данных")
+    parser.add_argument('--startup-budget', type=float, default=DEFAULT_STARTUP_BUDGET,
+                        help="бюджет холодного старта в секундах: при превышении код возврата 1 "
+                             "(по умолчанию FUNNEL_STARTUP_BUDGET или 2; 0 - без проверки)")
+    parser.add_argument('-o', '--output', help="JSON с результатом (по умолчанию - стандартный вывод)")
+    parser.add_argument('--baseline', help="JSON предыдущего замера: шаги, ставшие медленнее, считаются регрессией")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="допустимое замедление относительно базового замера (доля, по умолчанию 0.25)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    result = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'agg_workers': args.agg_workers or default_agg_workers(),
+        'startup': startup_profile(args.repeat),
+        'results': [],
+    }
+    for n_rows in [] if args.startup_only else args.rows:
+        result['results'].append(bench_size(
+            n_rows, args.branches, args.stages, args.metrics, args.format, args.work_dir, args.repeat,
+            not args.no_memory, args.agg_workers
+        ))
+        # Файл результата переписывается после каждого размера: замеры сохраняются, даже если
+        # следующий размер не поместится в память
+        if args.output:
+            write_json(result, args.output)
+    if args.output:
+        write_json(result, args.output)
+    else:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    found = []
+    if args.startup_budget and result['startup']['seconds'] > args.startup_budget:
+        found.append(f"холодный старт {result['startup']['seconds']:.3f} с больше бюджета {args.startup_budget:.3f} с")
+    for run in result['results']:
+        if run['reader_differences']:
+            differences = ', '.join(run['reader_differences'])
+            found.append(f"{run['rows']} строк: потоковое чтение и pandas расходятся ({differences})")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            found += regressions(result, json.load(f), args.tolerance)
+    for line in found:
+        print(f"Регрессия: {line}", file=sys.stderr)
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+# Версия формата записей: при изменении состава массивов старые записи игнорируются
+FORMAT_VERSION = 8
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'FUNNEL_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'sales_funnel')
+)
+DEFAULT_MAX_BYTES = int(float(os.environ.get('FUNNEL_CACHE_MAX_MB', '2048')) * 2 ** 20)
+
+
+# Постоянный кэш разобранных таблиц: каталог на запись, по файлу .npy на массив + meta.json.
+# Массивы открываются через mmap, поэтому повторная загрузка не читает файл целиком.
+class DiskCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key_for(data):
+        # Ключ - хэш содержимого файла и версия формата
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        return f'v{FORMAT_VERSION}-{digest}'
+
+    @staticmethod
+    def key_for_stream(stream, chunk_size=2 ** 20):
+        # То же, но файл читается блоками и не держится в памяти целиком
+        digest = hashlib.blake2b(digest_size=20)
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+        return f'v{FORMAT_VERSION}-{digest.hexdigest()}'
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        path = self._entry_path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                entry = json.load(f)
+            arrays = {
+                name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                for name in entry['arrays']
+            }
+            # Время модификации meta.json служит отметкой последнего использования для LRU
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays, entry['meta']
+
+    def store(self, key, arrays, meta):
+        final_path = self._entry_path(key)
+        tmp_path = os.path.join(self.directory, f'.tmp-{uuid.uuid4().hex}')
+        try:
+            os.makedirs(tmp_path)
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f'{name}.npy'), np.ascontiguousarray(array))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump({'arrays': list(arrays), 'meta': meta}, f, ensure_ascii=False)
+
+            # Атомарная публикация записи; при гонке с другим процессом оставляем уже записанную
+            try:
+                os.rename(tmp_path, final_path)
+            except OSError:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                if not os.path.isdir(final_path):
+                    return False
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return False
+
+        self.evict(keep=key)
+        return True
+
+    def entries(self):
+        # (ключ, размер в байтах, время последнего использования) по всем записям
+        result = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return result
+        for name in names:
+            path = self._entry_path(name)
+            if name.startswith('.tmp-') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                last_used = os.stat(os.path.join(path, 'meta.json')).st_mtime
+            except OSError:
+                continue
+            result.append((name, size, last_used))
+        return result
+
+    def evict(self, keep=None):
+        # Удаляем давно не использованные записи, пока кэш не уложится в лимит
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+
+from funnel_core import funnel_chunks
+from funnel_export import EXPORT_FORMATS, write_csv, write_export
+from funnel_io import load_merged, directory_sources, add_load_arguments, load_options
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Воронки продаж по всем сочетаниям дата × филиал из файла Excel/CSV"
+    )
+    parser.add_argument('sources', nargs='+',
+                        help="файлы .xlsx/.csv в формате приложения (две строки заголовков) или каталоги с ними")
+    parser.add_argument('-o', '--output', help="файл с результатом (по умолчанию - CSV в стандартный вывод)")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv',
+                        help="формат файла результата: csv, parquet (нужен pyarrow) или xlsx")
+    parser.add_argument('--gzip', action='store_true', help="сжать результат gzip (CSV) или внутри Parquet")
+    parser.add_argument('--totals', action='store_true',
+                        help="добавить итоги за весь период по филиалам и по всем филиалам по датам")
+    add_load_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.format != 'csv' and not args.output:
+        print(f"Для формата {args.format} нужен файл результата (-o)", file=sys.stderr)
+        return 2
+    sources = []
+    for source in args.sources:
+        sources += directory_sources(source) if os.path.isdir(source) else [source]
+    if not sources:
+        print("Нет файлов для обработки", file=sys.stderr)
+        return 1
+
+    table, cube = load_merged(sources, **load_options(args))
+
+    # Воронки пишутся блоками по датам: весь результат в памяти не собирается
+    chunks = funnel_chunks(cube, totals=args.totals)
+    if not args.output:
+        write_csv(chunks, sys.stdout)
+        return 0
+    n_rows = write_export(chunks, args.output, args.format, compress=args.gzip)
+    print(f"Записано строк: {n_rows} ({len(table)} строк исходных данных) -> {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,722 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+# День без даты в int32-смещениях от 1970-01-01
+NO_DAY = np.iinfo(np.int32).min
+
+# Меньше стольких строк на поток таблица не делится: накладные расходы больше выигрыша
+MIN_PART_ROWS = 2 ** 18
+
+
+# Потоки для построения агрегатов: FUNNEL_AGG_WORKERS или число ядер
+def default_agg_workers():
+    return int(os.environ.get('FUNNEL_AGG_WORKERS', 0)) or os.cpu_count() or 1
+
+
+# Задачи в пуле потоков (или по очереди при одном потоке). Подходит для операций NumPy,
+# которые отпускают GIL на время основного цикла (np.bincount, np.cumsum)
+def run_parallel(func, tasks, workers):
+    tasks = list(tasks)
+    if workers <= 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+    with ThreadPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        return list(pool.map(func, tasks))
+
+
+# Даты (datetime64) в int32-смещения в днях; NaT -> NO_DAY
+def dates_to_days(dates):
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    days = dates.astype('datetime64[D]').astype(np.int64)
+    days[np.isnat(dates)] = NO_DAY
+    return days.astype(np.int32)
+
+
+# Обратное преобразование: int32-смещения в datetime64[ns], NO_DAY -> NaT
+def days_to_dates(days):
+    dates = np.asarray(days).astype('datetime64[D]').astype('datetime64[ns]')
+    dates[np.asarray(days) == NO_DAY] = np.datetime64('NaT')
+    return dates
+
+
+# Самый узкий тип кодов филиалов: int16, если филиалов меньше 32767, иначе int32
+def branch_code_dtype(n_branches):
+    return np.int16 if n_branches < np.iinfo(np.int16).max else np.int32
+
+
+# Значения одной метрики (строки, этапы) в компактном типе:
+# int32, если все значения целые и помещаются в int32 (количества), иначе float32 (тоннаж, выручка)
+def compact_metric(values):
+    values = np.asarray(values, dtype=np.float32)
+    limit = np.iinfo(np.int32).max
+    if values.size and np.array_equal(values, np.rint(values)) and np.abs(values).max() < limit:
+        return np.ascontiguousarray(values, dtype=np.int32)
+    return np.ascontiguousarray(values)
+
+
+# Разобранная таблица в компактных массивах: строка файла = (день, филиал, значения этапов по метрикам)
+@dataclass(slots=True)
+class FunnelTable:
+    days: np.ndarray          # int32, дни от 1970-01-01 (NO_DAY для пустых дат)
+    branch_codes: np.ndarray  # int16/int32, индекс в branch_names (-1 - филиал не указан)
+    branch_names: list        # филиалы в порядке первого появления в файле
+    stages: list              # этапы воронки в порядке следования
+    metrics: list             # метрики (Кол-во, Тонн и дополнительные из схемы)
+    values: list              # по массиву (строки, этапы) на метрику, int32 или float32
+    coerced: object = None    # int64 (ячейки, 3): строка, этап, метрика нечисловых ячеек, приведенных к 0 (None - не отмечались)
+    row_index: object = None  # RowIndex для выборок строк без полного прохода (build_row_index)
+
+    def __len__(self):
+        return len(self.days)
+
+    # (этап, метрика) для столбцов в порядке «этап за этапом»
+    @property
+    def columns(self):
+        return [(stage, metric) for stage in self.stages for metric in self.metrics]
+
+    # Объем массивов таблицы (вместе с отметками нечисловых ячеек и индексом строк) в байтах
+    @property
+    def nbytes(self):
+        nbytes = self.days.nbytes + self.branch_codes.nbytes + sum(values.nbytes for values in self.values)
+        nbytes += self.coerced.nbytes if self.coerced is not None else 0
+        return nbytes + (self.row_index.nbytes if self.row_index is not None else 0)
+
+    # Строки таблицы (по умолчанию все) с мультииндексом столбцов, как в исходном формате файла
+    def to_frame(self, rows=slice(None)):
+        days = self.days[rows]
+        columns = {('Дата', ''): days_to_dates(days)}
+        columns[('Филиал', '')] = pd.Categorical.from_codes(self.branch_codes[rows], categories=self.branch_names)
+        for s, stage in enumerate(self.stages):
+            for m, metric in enumerate(self.metrics):
+                columns[(stage, metric)] = self.values[m][rows, s].astype(np.float32)
+        return pd.DataFrame(columns, index=pd.RangeIndex(len(days)))
+
+
+# Индекс строк таблицы: строки упорядочены по филиалу, внутри филиала - по дате (при равных датах -
+# в порядке файла). Строки филиала - отрезок rows[offsets[c]:offsets[c + 1]] (строки без филиала -
+# последний отрезок), строки диапазона дат внутри отрезка находятся двоичным поиском по days.
+@dataclass(slots=True)
+class RowIndex:
+    rows: np.ndarray     # int32/int64, номера строк таблицы
+    days: np.ndarray     # int32, даты строк в порядке rows
+    offsets: np.ndarray  # int64, границы отрезков филиалов, длина - филиалы + 2
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.days.nbytes + self.offsets.nbytes
+
+
+# Индекс строк по таблице: одна сортировка при загрузке вместо полного прохода на каждую выборку
+def build_row_index(table):
+    n_branches = len(table.branch_names)
+    codes = table.branch_codes.astype(np.int64)
+    codes[codes < 0] = n_branches
+    rows = np.lexsort((table.days, codes))
+    if len(rows) < 2 ** 31:
+        rows = rows.astype(np.int32)
+    offsets = np.zeros(n_branches + 2, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n_branches + 1), out=offsets[1:])
+    return RowIndex(rows=rows, days=table.days[rows], offsets=offsets)
+
+
+# Границы [lo, hi] в днях от 1970-01-01 для диапазона дат включительно - общие для таблицы в памяти
+# и блочного хранилища. Строки без даты (NO_DAY) не входят ни в один диапазон, в том числе во «весь период»:
+# как и в кубе агрегатов, их показывает только проверка данных.
+def day_bounds(date_from=None, date_to=None):
+    lo = NO_DAY + 1 if date_from is None else int(np.datetime64(pd.Timestamp(date_from), 'D').astype(np.int64))
+    hi = np.iinfo(np.int32).max if date_to is None else int(np.datetime64(pd.Timestamp(date_to), 'D').astype(np.int64))
+    return lo, hi
+
+
+# Предрассчитанный куб агрегатов: даты × филиалы × этапы × метрика
+@dataclass(slots=True)
+class FunnelCube:
+    dates: np.ndarray       # отсортированные уникальные даты, datetime64[ns]
+    branches: list          # отсортированные филиалы
+    branch_index: dict      # филиал -> позиция на оси филиалов
+    stages: list            # этапы воронки в порядке следования
+    metrics: list           # метрики в порядке схемы ('Кол-во', 'Тонн', ...)
+    values: np.ndarray      # суммы, форма (даты, филиалы, этапы, метрики)
+    cumsum: np.ndarray      # префиксные суммы по датам, форма (даты + 1, филиалы, этапы, метрики)
+    cumsum_all: np.ndarray  # префиксные суммы по датам для всех филиалов, форма (даты + 1, этапы, метрики)
+    rows: np.ndarray        # количество исходных строк, форма (даты, филиалы)
+    rows_cumsum: np.ndarray # префиксные суммы количества строк, форма (даты + 1, филиалы)
+
+    # Объем массивов куба в байтах
+    @property
+    def nbytes(self):
+        arrays = (self.dates, self.values, self.cumsum, self.cumsum_all, self.rows, self.rows_cumsum)
+        return sum(array.nbytes for array in arrays)
+
+
+# Куб агрегатов по таблице; workers - число потоков (по умолчанию default_agg_workers())
+def build_cube(table, workers=None):
+    workers = workers or default_agg_workers()
+    stages, metrics = list(table.stages), list(table.metrics)
+
+    # Коды дат в отсортированном порядке (NO_DAY - наименьшее значение, становится кодом -1);
+    # коды филиалов перенумеровываются по алфавиту
+    date_idx, days = pd.factorize(table.days, sort=True)
+    if len(days) and days[0] == NO_DAY:
+        date_idx -= 1
+        days = days[1:]
+    dates = days_to_dates(days)
+    branches = sorted(table.branch_names)
+    rank = np.empty(len(table.branch_names) + 1, dtype=np.int64)
+    rank[np.argsort(table.branch_names, kind='stable')] = np.arange(len(branches))
+    rank[-1] = -1
+    branch_idx = rank[table.branch_codes]
+    n_dates, n_branches = len(dates), len(branches)
+
+    # Строки без даты или филиала (код -1) в агрегаты не попадают: они уходят в лишнюю ячейку n_cells,
+    # которая затем отбрасывается, - столбцы значений не копируются ради фильтра
+    n_cells = n_dates * n_branches
+    flat_idx = np.where((date_idx >= 0) & (branch_idx >= 0), date_idx * n_branches + branch_idx, n_cells)
+
+    # Одна группировка bincount на каждую ячейку «этап × метрика» и часть строк. Части считаются
+    # в пуле потоков (np.bincount отпускает GIL, таблица не копируется в процессы).
+    # Строки делятся на части, только если ячеек меньше, чем потоков.
+    # Все части складываются в один общий куб под блокировкой: сверх самого куба память - по одному
+    # столбцу bincount (n_cells float64) на работающий поток, а не копия куба на каждую часть.
+    n_columns = len(stages) * len(metrics)
+    n_parts = max(min(-(-workers // max(n_columns, 1)), len(flat_idx) // MIN_PART_ROWS), 1)
+    bounds = np.linspace(0, len(flat_idx), n_parts + 1).astype(np.int64)
+    values = np.zeros((n_cells, len(stages), len(metrics)))
+    rows = np.zeros(n_cells, dtype=np.int64)
+    lock = threading.Lock()
+
+    def aggregate(task):
+        p, s, m = task
+        part = slice(bounds[p], bounds[p + 1])
+        if s is None:
+            column = np.bincount(flat_idx[part], minlength=n_cells + 1)[:n_cells]
+            with lock:
+                rows[:] += column
+        else:
+            column = np.bincount(flat_idx[part], weights=table.values[m][part, s], minlength=n_cells + 1)[:n_cells]
+            with lock:
+                values[:, s, m] += column
+
+    tasks = [(p, s, m) for p in range(n_parts) for m in range(len(metrics)) for s in range(len(stages))]
+    run_parallel(aggregate, tasks + [(p, None, None) for p in range(n_parts)], workers)
+    values = values.reshape(n_dates, n_branches, len(stages), len(metrics))
+    rows = rows.reshape(n_dates, n_branches)
+
+    # Префиксные суммы по датам: сумма за [i, j) = cumsum[j] - cumsum[i].
+    # Филиалы независимы, поэтому большой куб накапливается полосами филиалов в тех же потоках.
+    cumsum = np.zeros((n_dates + 1,) + values.shape[1:])
+    n_strips = min(workers, n_branches) if values.size >= MIN_PART_ROWS else 1
+    strips = np.linspace(0, n_branches, max(n_strips, 1) + 1).astype(np.int64)
+
+    def accumulate(i):
+        strip = slice(strips[i], strips[i + 1])
+        np.cumsum(values[:, strip], axis=0, out=cumsum[1:, strip])
+
+    run_parallel(accumulate, range(len(strips) - 1), workers)
+    cumsum_all = cumsum.sum(axis=1)
+    rows_cumsum = np.zeros((n_dates + 1, n_branches), dtype=np.int64)
+    np.cumsum(rows, axis=0, out=rows_cumsum[1:])
+
+    return FunnelCube(
+        dates=dates,
+        branches=branches,
+        branch_index={branch: b for b, branch in enumerate(branches)},
+        stages=stages,
+        metrics=metrics,
+        values=values,
+        cumsum=cumsum,
+        cumsum_all=cumsum_all,
+        rows=rows,
+        rows_cumsum=rows_cumsum,
+    )
+
+
+# Объединение таблиц нескольких файлов: общий список филиалов, этапов и метрик, строки подряд
+def merge_tables(tables):
+    if len(tables) == 1:
+        return tables[0]
+
+    stages = list(dict.fromkeys(stage for table in tables for stage in table.stages))
+    metrics = list(dict.fromkeys(metric for table in tables for metric in table.metrics))
+    branch_names = list(dict.fromkeys(name for table in tables for name in table.branch_names))
+    stage_index = {stage: s for s, stage in enumerate(stages)}
+    metric_index = {metric: m for m, metric in enumerate(metrics)}
+    branch_index = {name: code for code, name in enumerate(branch_names)}
+
+    n_rows = sum(len(table) for table in tables)
+    days = np.concatenate([table.days for table in tables])
+    branch_codes = np.empty(n_rows, dtype=branch_code_dtype(len(branch_names)))
+
+    # Метрика остается целочисленной, только если она целочисленная во всех таблицах
+    values = []
+    for metric in metrics:
+        dtypes = [table.values[table.metrics.index(metric)].dtype for table in tables if metric in table.metrics]
+        dtype = np.int32 if all(dtype == np.int32 for dtype in dtypes) else np.float32
+        values.append(np.zeros((n_rows, len(stages)), dtype=dtype))
+
+    # Нечисловые ячейки переносятся со сдвигом строк, если они отмечены во всех таблицах
+    coerced = [] if all(table.coerced is not None for table in tables) else None
+
+    start = 0
+    for table in tables:
+        end = start + len(table)
+        # Перекодировка филиалов таблицы в общий словарь (последний элемент - для кода -1)
+        remap = np.array([branch_index[name] for name in table.branch_names] + [-1], dtype=branch_codes.dtype)
+        branch_codes[start:end] = remap[table.branch_codes]
+        stage_positions = np.array([stage_index[stage] for stage in table.stages], dtype=np.int64)
+        for metric, metric_values in zip(table.metrics, table.values):
+            values[metric_index[metric]][start:end, stage_positions] = metric_values
+        if coerced is not None:
+            metric_positions = np.array([metric_index[metric] for metric in table.metrics], dtype=np.int64)
+            cells = table.coerced
+            coerced.append(np.column_stack(
+                [cells[:, 0] + start, stage_positions[cells[:, 1]], metric_positions[cells[:, 2]]]
+            ).astype(np.int64))
+        start = end
+
+    return FunnelTable(
+        days=days,
+        branch_codes=branch_codes,
+        branch_names=branch_names,
+        stages=stages,
+        metrics=metrics,
+        values=values,
+        coerced=np.concatenate(coerced) if coerced is not None else None,
+    )
+
+
+# Добавление куба нового файла к существующему. Префиксные суммы до первой даты нового файла
+# переносятся без пересчета, досчитывается только хвост оси дат.
+def merge_cubes(base, addition):
+    dates = np.union1d(base.dates, addition.dates)
+    branches = sorted(set(base.branches) | set(addition.branches))
+    stages = base.stages + [stage for stage in addition.stages if stage not in base.stages]
+    metrics = base.metrics + [metric for metric in addition.metrics if metric not in base.metrics]
+    branch_index = {branch: b for b, branch in enumerate(branches)}
+
+    def positions(cube):
+        return (
+            np.searchsorted(dates, cube.dates),
+            np.array([branch_index[branch] for branch in cube.branches], dtype=np.int64),
+            np.array([stages.index(stage) for stage in cube.stages], dtype=np.int64),
+            np.array([metrics.index(metric) for metric in cube.metrics], dtype=np.int64),
+        )
+
+    base_d, base_b, base_s, base_m = positions(base)
+    add_d, add_b, add_s, add_m = positions(addition)
+
+    values = np.zeros((len(dates), len(branches), len(stages), len(metrics)))
+    rows = np.zeros((len(dates), len(branches)), dtype=np.int64)
+    values[np.ix_(base_d, base_b, base_s, base_m)] = base.values
+    rows[np.ix_(base_d, base_b)] = base.rows
+    values[np.ix_(add_d, add_b, add_s, add_m)] += addition.values
+    rows[np.ix_(add_d, add_b)] += addition.rows
+
+    # Все даты до первой даты нового файла - даты base, их префиксные суммы не меняются
+    first = int(add_d[0]) if len(add_d) else len(dates)
+    kept = np.arange(first + 1)
+    cumsum = np.zeros((len(dates) + 1,) + values.shape[1:])
+    cumsum_all = np.zeros((len(dates) + 1,) + values.shape[2:])
+    rows_cumsum = np.zeros((len(dates) + 1, len(branches)), dtype=np.int64)
+    cumsum[np.ix_(kept, base_b, base_s, base_m)] = base.cumsum[:first + 1]
+    cumsum_all[np.ix_(kept, base_s, base_m)] = base.cumsum_all[:first + 1]
+    rows_cumsum[np.ix_(kept, base_b)] = base.rows_cumsum[:first + 1]
+
+    np.cumsum(values[first:], axis=0, out=cumsum[first + 1:])
+    cumsum[first + 1:] += cumsum[first]
+    np.cumsum(values[first:].sum(axis=1), axis=0, out=cumsum_all[first + 1:])
+    cumsum_all[first + 1:] += cumsum_all[first]
+    np.cumsum(rows[first:], axis=0, out=rows_cumsum[first + 1:])
+    rows_cumsum[first + 1:] += rows_cumsum[first]
+
+    return FunnelCube(
+        dates=dates,
+        branches=branches,
+        branch_index=branch_index,
+        stages=stages,
+        metrics=metrics,
+        values=values,
+        cumsum=cumsum,
+        cumsum_all=cumsum_all,
+        rows=rows,
+        rows_cumsum=rows_cumsum,
+    )
+
+
+# Позиция даты на оси куба двоичным поиском; None, если такой даты в данных нет
+def date_position(cube, date):
+    date = np.datetime64(pd.Timestamp(date), 'ns')
+    d = int(np.searchsorted(cube.dates, date))
+    if d == len(cube.dates) or cube.dates[d] != date:
+        return None
+    return d
+
+
+def cube_lookup(cube, date=None, branch=None):
+    # Значения по всем этапам и метрикам (этапы × метрики) и число исходных строк в срезе
+    b = cube.branch_index.get(branch)
+    if branch is not None and b is None:
+        return np.zeros(cube.cumsum_all.shape[1:]), 0
+
+    if date is None:
+        if branch is None:
+            return cube.cumsum_all[-1], int(cube.rows.sum())
+        return cube.cumsum[-1, b], int(cube.rows[:, b].sum())
+
+    d = date_position(cube, date)
+    if d is None:
+        return np.zeros(cube.cumsum_all.shape[1:]), 0
+    if branch is None:
+        return cube.cumsum_all[d + 1] - cube.cumsum_all[d], int(cube.rows[d].sum())
+    return cube.values[d, b], int(cube.rows[d, b])
+
+
+# Позиции [lo, hi) на оси дат для диапазона date_from..date_to включительно (None - без границы)
+def date_range_positions(cube, date_from=None, date_to=None):
+    lo = 0
+    hi = len(cube.dates)
+    if date_from is not None:
+        lo = int(np.searchsorted(cube.dates, np.datetime64(pd.Timestamp(date_from), 'ns'), side='left'))
+    if date_to is not None:
+        # Граница включает весь день date_to
+        end = np.datetime64(pd.Timestamp(date_to).normalize() + pd.Timedelta(days=1), 'ns')
+        hi = int(np.searchsorted(cube.dates, end, side='left'))
+    return lo, max(lo, hi)
+
+
+# Префиксные суммы значений и количества строк для одного филиала или для всех (branch=None)
+def prefix_sums(cube, branch=None):
+    if branch is None:
+        return cube.cumsum_all, cube.rows_cumsum.sum(axis=1)
+    b = cube.branch_index.get(branch)
+    if b is None:
+        return np.zeros_like(cube.cumsum_all), np.zeros(len(cube.rows_cumsum), dtype=np.int64)
+    return cube.cumsum[:, b], cube.rows_cumsum[:, b]
+
+
+# Срез за произвольный диапазон дат: разность двух префиксных сумм, стоимость не зависит от длины диапазона
+def range_lookup(cube, date_from=None, date_to=None, branch=None):
+    lo, hi = date_range_positions(cube, date_from, date_to)
+    b = cube.branch_index.get(branch)
+    if branch is not None and b is None:
+        return np.zeros(cube.cumsum_all.shape[1:]), 0
+    if branch is None:
+        rows = cube.rows_cumsum[hi].sum() - cube.rows_cumsum[lo].sum()
+        return cube.cumsum_all[hi] - cube.cumsum_all[lo], int(rows)
+    return cube.cumsum[hi, b] - cube.cumsum[lo, b], int(cube.rows_cumsum[hi, b] - cube.rows_cumsum[lo, b])
+
+
+# Начала календарных периодов для дат: 'D' - день, 'W' - неделя с понедельника, 'M' - месяц, 'Q' - квартал
+def period_starts(dates, freq):
+    days = dates.astype('datetime64[D]')
+    if freq == 'D':
+        return days
+    if freq == 'W':
+        # 1970-01-01 - четверг, поэтому (день + 3) % 7 - число дней от понедельника
+        return days - (days.astype(np.int64) + 3) % 7
+    months = days.astype('datetime64[M]')
+    if freq == 'M':
+        return months.astype('datetime64[D]')
+    if freq == 'Q':
+        month_numbers = months.astype(np.int64)
+        return (month_numbers - month_numbers % 3).astype('datetime64[M]').astype('datetime64[D]')
+    raise ValueError(f"Неизвестная частота: {freq}")
+
+
+# Воронки по календарным периодам внутри диапазона дат:
+# начала периодов, значения (периоды, этапы, метрики) и количество строк по периодам
+def resample_funnels(cube, freq, branch=None, date_from=None, date_to=None):
+    lo, hi = date_range_positions(cube, date_from, date_to)
+    starts = period_starts(cube.dates[lo:hi], freq)
+
+    # Даты отсортированы, поэтому каждый период - непрерывный отрезок оси дат
+    breaks = np.flatnonzero(starts[1:] != starts[:-1]) + 1
+    period_lo = lo + np.concatenate([[0], breaks]).astype(np.int64) if hi > lo else np.zeros(0, dtype=np.int64)
+    period_hi = np.append(period_lo[1:], hi) if hi > lo else np.zeros(0, dtype=np.int64)
+
+    cumsum, rows_cumsum = prefix_sums(cube, branch)
+    return (
+        starts[period_lo - lo],
+        cumsum[period_hi] - cumsum[period_lo],
+        rows_cumsum[period_hi] - rows_cumsum[period_lo],
+    )
+
+
+# Скользящая воронка за window_days календарных дней, заканчивающихся каждой датой диапазона
+def rolling_funnels(cube, window_days, branch=None, date_from=None, date_to=None):
+    lo, hi = date_range_positions(cube, date_from, date_to)
+    ends = np.arange(lo, hi) + 1
+    window_start = cube.dates[lo:hi] - np.timedelta64(window_days - 1, 'D')
+    starts = np.searchsorted(cube.dates, window_start, side='left')
+
+    cumsum, rows_cumsum = prefix_sums(cube, branch)
+    return (
+        cube.dates[lo:hi].astype('datetime64[D]'),
+        cumsum[ends] - cumsum[starts],
+        rows_cumsum[ends] - rows_cumsum[starts],
+    )
+
+
+# Ряды воронки по периодам за все даты: начала периодов, значения (периоды, этапы, метрики), строки.
+# previous - ряды того же филиала и частоты до добавления файлов, changed_from - первая дата добавленных данных:
+# периоды раньше нее берутся из previous (их префиксные суммы не изменились), пересчитывается только хвост.
+def trend_series(cube, freq, branch=None, previous=None, changed_from=None):
+    if previous is None or changed_from is None:
+        return resample_funnels(cube, freq, branch=branch)
+    first = period_starts(np.array([changed_from], dtype='datetime64[ns]'), freq)[0]
+    kept = previous[0] < first
+    starts, values, rows = resample_funnels(cube, freq, branch=branch, date_from=first)
+    return (
+        np.concatenate([previous[0][kept], starts]),
+        np.concatenate([previous[1][kept], values]),
+        np.concatenate([previous[2][kept], rows]),
+    )
+
+
+# Прореживание ряда для графика: отрезки поровну, в каждом - точки минимума и максимума
+# (пики и провалы сохраняются). Возвращает отсортированные номера точек: не больше max_points, но не меньше двух.
+def downsample_minmax(values, max_points):
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    bucket = -(-n // max(max_points // 2, 1))
+    n_buckets = -(-n // bucket)
+    padded = np.full(n_buckets * bucket, np.inf)
+    padded[:n] = values
+    low = padded.reshape(n_buckets, bucket).argmin(axis=1)
+    padded[n:] = -np.inf
+    high = padded.reshape(n_buckets, bucket).argmax(axis=1)
+    offsets = np.arange(n_buckets) * bucket
+    return np.unique(np.concatenate([offsets + low, offsets + high]))
+
+
+# Воронка по одной метрике: значения этапов для даты/филиала (None - все даты/все филиалы)
+def compute_funnel(cube, metric, date=None, branch=None):
+    values, _ = cube_lookup(cube, date=date, branch=branch)
+    return np.asarray(values[:, cube.metrics.index(metric)], dtype=np.float64)
+
+
+# Конверсия между соседними этапами в процентах по последней оси; при нулевом знаменателе - 0%
+def conversion_rates(values):
+    values = np.asarray(values, dtype=np.float64)
+    previous, following = values[..., :-1], values[..., 1:]
+    rates = np.zeros(following.shape)
+    np.divide(following, previous, out=rates, where=previous > 0)
+    return rates * 100
+
+
+# Итоговая конверсия от первого этапа к последнему в процентах; при нулевом первом этапе - 0%
+def total_conversion(values):
+    values = np.asarray(values, dtype=np.float64)
+    first, last = values[..., 0], values[..., -1]
+    rates = np.zeros(np.shape(first))
+    np.divide(last, first, out=rates, where=first > 0)
+    return rates * 100
+
+
+# Конверсия для всех дат и филиалов одной операцией над кубом:
+# переходы между этапами (даты, филиалы, этапы - 1) и итоговая (даты, филиалы)
+def conversion_matrix(cube, metric):
+    values = cube.values[..., cube.metrics.index(metric)]
+    return conversion_rates(values), total_conversion(values)
+
+
+# Воронки всех филиалов по одной метрике за диапазон дат (по умолчанию весь период) или за одну дату:
+# значения (филиалы, этапы) - разность префиксных сумм, без прохода по филиалам
+def branch_values(cube, metric, date=None, date_from=None, date_to=None):
+    m = cube.metrics.index(metric)
+    if date is None:
+        lo, hi = date_range_positions(cube, date_from, date_to)
+        return cube.cumsum[hi, :, :, m] - cube.cumsum[lo, :, :, m]
+    d = date_position(cube, date)
+    return cube.values[d, :, :, m] if d is not None else np.zeros(cube.values.shape[1:3])
+
+
+# Воронки и конверсия всех филиалов: значения (филиалы, этапы), переходы (филиалы, этапы - 1), итоговая (филиалы)
+def branch_conversion(cube, metric, date=None, date_from=None, date_to=None):
+    values = branch_values(cube, metric, date=date, date_from=date_from, date_to=date_to)
+    return values, conversion_rates(values), total_conversion(values)
+
+
+# Воронки набора филиалов для сравнения: названия и значения (филиалы, этапы) одной выборкой.
+# branches - список филиалов (None - все); top - оставить top филиалов с наибольшим первым этапом
+def compare_branches(cube, metric, branches=None, top=None, date=None, date_from=None, date_to=None):
+    values = branch_values(cube, metric, date=date, date_from=date_from, date_to=date_to)
+    if branches is None:
+        positions = np.arange(len(cube.branches))
+    else:
+        positions = np.array([cube.branch_index[b] for b in branches if b in cube.branch_index], dtype=np.int64)
+    if top is not None:
+        order = np.argsort(-values[positions, 0], kind='stable')
+        positions = positions[order[:top]]
+    return [cube.branches[b] for b in positions], values[positions]
+
+
+# Сводные показатели воронки для блока «Статистика»
+def funnel_stats(values, days_count=None):
+    values = np.asarray(values, dtype=np.float64)
+    stats = {
+        'initial': float(values[0]),
+        'final': float(values[-1]),
+        'conversion': float(total_conversion(values)),
+        'losses': float(values[0] - values[-1]),
+    }
+    if days_count:
+        stats['per_day'] = float(values[-1] / days_count)
+    return stats
+
+
+# Номера строк таблицы (в порядке файла) в диапазоне дат (включительно) и по филиалу.
+# С индексом строк - двоичный поиск по отрезкам филиалов, без него - одна маска по компактным массивам.
+def table_rows(table, date_from=None, date_to=None, branch=None):
+    if branch is None and date_from is None and date_to is None:
+        return np.flatnonzero(table.days != NO_DAY)
+    code = table.branch_names.index(branch) if branch in table.branch_names else -2
+    if branch is not None and code < 0:
+        return np.zeros(0, dtype=np.int64)
+    lo, hi = day_bounds(date_from, date_to)
+
+    index = table.row_index
+    if index is None:
+        mask = (table.days >= lo) & (table.days <= hi)
+        if branch is not None:
+            mask &= table.branch_codes == code
+        return np.flatnonzero(mask)
+
+    # Границы в типе дат индекса: иначе searchsorted приводит к int64 копию каждого отрезка
+    lo, hi = np.int32(lo), np.int32(hi)
+    codes = range(len(index.offsets) - 1) if branch is None else [code]
+    parts = []
+    for c in codes:
+        start, stop = int(index.offsets[c]), int(index.offsets[c + 1])
+        days = index.days[start:stop]
+        parts.append(index.rows[start + int(np.searchsorted(days, lo, side='left')):start + int(np.searchsorted(days, hi, side='right'))])
+    return np.sort(np.concatenate(parts)).astype(np.int64)
+
+
+# Строки rows, упорядоченные по столбцу 'Дата', 'Филиал' (по алфавиту) или (этап, метрика).
+# Сортировка устойчивая: равные значения остаются в порядке файла и при обратном порядке.
+def sort_rows(table, rows, column, descending=False):
+    if column == 'Дата':
+        key = table.days[rows].astype(np.int64)
+    elif column == 'Филиал':
+        rank = np.empty(len(table.branch_names) + 1, dtype=np.int64)
+        rank[np.argsort(table.branch_names, kind='stable')] = np.arange(len(table.branch_names))
+        rank[-1] = -1
+        key = rank[table.branch_codes[rows]]
+    else:
+        stage, metric = column
+        key = table.values[table.metrics.index(metric)][rows, table.stages.index(stage)].astype(np.float64)
+    return rows[np.argsort(-key if descending else key, kind='stable')]
+
+
+# Страница строк для просмотра: форматируются только переданные строки, векторно по столбцам.
+# Целые метрики выводятся как есть, дробные - с одним знаком после запятой.
+def table_page_frame(table, rows, stages=None):
+    days = table.days[rows]
+    dates = np.datetime_as_string(days.astype('datetime64[D]'), unit='D')
+    dates[days == NO_DAY] = ''
+    names = np.asarray(table.branch_names + [''], dtype=object)
+    columns = {'Строка': rows + 1, 'Дата': dates, 'Филиал': names[table.branch_codes[rows]]}
+    for stage in stages if stages is not None else table.stages:
+        s = table.stages.index(stage)
+        for m, metric in enumerate(table.metrics):
+            values = table.values[m][rows, s]
+            if np.issubdtype(values.dtype, np.integer):
+                columns[f'{stage}, {metric}'] = values.astype(str)
+            else:
+                columns[f'{stage}, {metric}'] = np.char.mod('%.1f', values)
+    return pd.DataFrame(columns)
+
+
+# Массивы куба для постоянного кэша (имена с префиксом cube_) и обратное восстановление
+def cube_to_arrays(cube):
+    arrays = {
+        'cube_dates': cube.dates,
+        'cube_values': cube.values,
+        'cube_cumsum': cube.cumsum,
+        'cube_cumsum_all': cube.cumsum_all,
+        'cube_rows': cube.rows,
+        'cube_rows_cumsum': cube.rows_cumsum,
+    }
+    meta = {'branches': cube.branches, 'stages': cube.stages, 'metrics': cube.metrics}
+    return arrays, meta
+
+
+def cube_from_arrays(arrays, meta):
+    return FunnelCube(
+        dates=arrays['cube_dates'],
+        branches=meta['branches'],
+        branch_index={branch: b for b, branch in enumerate(meta['branches'])},
+        stages=meta['stages'],
+        metrics=meta['metrics'],
+        values=arrays['cube_values'],
+        cumsum=arrays['cube_cumsum'],
+        cumsum_all=arrays['cube_cumsum_all'],
+        rows=arrays['cube_rows'],
+        rows_cumsum=arrays['cube_rows_cumsum'],
+    )
+
+
+# Таблица воронок для набора строк: значения (строки, этапы, метрики), подписи дат и филиалов.
+# Конверсия считается сразу для всех строк по оси этапов.
+def funnel_rows_frame(cube, values, date_labels, branch_labels):
+    columns = {'Дата': date_labels, 'Филиал': branch_labels}
+    for m, metric in enumerate(cube.metrics):
+        for s, stage in enumerate(cube.stages):
+            columns[f'{stage}, {metric}'] = values[:, s, m]
+        rates = conversion_rates(values[:, :, m])
+        for s in range(len(cube.stages) - 1):
+            columns[f'{cube.stages[s]} → {cube.stages[s + 1]}, {metric}, %'] = rates[:, s].round(1)
+        columns[f'Итоговая конверсия, {metric}, %'] = total_conversion(values[:, :, m]).round(1)
+    return pd.DataFrame(columns)
+
+
+# Воронки по всем сочетаниям дата × филиал блоками по chunk_rows сочетаний (по целым датам):
+# память не зависит от длины периода. Пустые сочетания (нет строк в файле) пропускаются;
+# totals добавляет последним блоком итоги за весь период и по всем филиалам.
+def funnel_chunks(cube, totals=False, chunk_rows=2 ** 16):
+    n_dates, n_branches, n_stages, n_metrics = cube.values.shape
+    branches = np.asarray(cube.branches, dtype=object)
+    date_strings = np.datetime_as_string(cube.dates, unit='D').astype(object)
+    step = max(1, chunk_rows // max(n_branches, 1))
+
+    for lo in range(0, n_dates, step):
+        hi = min(lo + step, n_dates)
+        present = cube.rows[lo:hi].ravel() > 0
+        if not present.any():
+            continue
+        values = cube.values[lo:hi].reshape(-1, n_stages, n_metrics)[present]
+        date_labels = np.repeat(date_strings[lo:hi], n_branches)[present]
+        branch_labels = np.tile(branches, hi - lo)[present]
+        yield funnel_rows_frame(cube, values, date_labels, branch_labels)
+
+    if totals:
+        # Итоги берутся из префиксных сумм: по филиалам за весь период, по датам для всех филиалов, общий итог
+        per_date = cube.cumsum_all[1:] - cube.cumsum_all[:-1]
+        values = np.concatenate([cube.cumsum[-1], per_date, cube.cumsum_all[-1:]])
+        date_labels = np.concatenate([
+            np.full(n_branches, 'Весь период', dtype=object),
+            date_strings,
+            np.array(['Весь период'], dtype=object),
+        ])
+        branch_labels = np.concatenate([
+            branches,
+            np.full(n_dates, 'Все филиалы', dtype=object),
+            np.array(['Все филиалы'], dtype=object),
+        ])
+        yield funnel_rows_frame(cube, values, date_labels, branch_labels)
+
+
+# Воронки по всем сочетаниям дата × филиал одной таблицей (для больших наборов - funnel_chunks)
+def funnel_frame(cube, totals=False):
+    frames = list(funnel_chunks(cube, totals=totals))
+    if not frames:
+        empty = np.zeros((0,) + cube.values.shape[2:])
+        return funnel_rows_frame(cube, empty, np.zeros(0, dtype=object), np.zeros(0, dtype=object))
+    return pd.concat(frames, ignore_index=True)
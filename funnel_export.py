@@ -0,0 +1,125 @@
+import gzip
+import os
+
+import pandas as pd
+
+from funnel_core import days_to_dates, table_rows
+
+# Форматы выгрузки: расширение файла и MIME-тип
+EXPORT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+# Строк данных на листе Excel (одна строка - заголовок); длинная выгрузка продолжается на следующем листе
+EXCEL_SHEET_ROWS = 1048576 - 1
+
+
+# Исходные строки таблицы блоками по chunk_rows с плоскими именами столбцов «этап, метрика»,
+# с фильтром по диапазону дат (включительно) и филиалу
+def raw_chunks(table, date_from=None, date_to=None, branch=None, chunk_rows=2 ** 16):
+    rows = table_rows(table, date_from, date_to, branch)
+
+    for start in range(0, len(rows), chunk_rows):
+        index = rows[start:start + chunk_rows]
+        columns = {
+            'Дата': days_to_dates(table.days[index]),
+            'Филиал': pd.Categorical.from_codes(table.branch_codes[index], categories=table.branch_names),
+        }
+        for s, stage in enumerate(table.stages):
+            for m, metric in enumerate(table.metrics):
+                columns[f'{stage}, {metric}'] = table.values[m][index, s]
+        yield pd.DataFrame(columns)
+
+
+# CSV блоками: заголовок пишется только с первым блоком; compress - gzip.
+# output - путь или текстовый поток. Возвращает число записанных строк.
+def write_csv(chunks, output, compress=False):
+    n_rows = 0
+    if isinstance(output, (str, os.PathLike)):
+        f = gzip.open(output, 'wt', encoding='utf-8', newline='') if compress else \
+            open(output, 'w', encoding='utf-8', newline='')
+    else:
+        f = output
+    try:
+        for chunk in chunks:
+            chunk.to_csv(f, header=n_rows == 0, index=False)
+            n_rows += len(chunk)
+    finally:
+        if f is not output:
+            f.close()
+    return n_rows
+
+
+# Parquet по группе строк на блок (pyarrow - необязательная зависимость); compress - gzip вместо snappy
+def write_parquet(chunks, path, compress=False):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Для выгрузки в Parquet нужен пакет pyarrow (pip install pyarrow)") from None
+
+    n_rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            batch = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema, compression='gzip' if compress else 'snappy')
+            writer.write_table(batch.cast(writer.schema))
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError("Нет данных для выгрузки")
+    return n_rows
+
+
+# Excel в режиме write_only (строки не держатся в памяти); сжатие не применяется - xlsx уже zip
+def write_xlsx(chunks, path):
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = None
+    sheet_rows = n_rows = 0
+    for chunk in chunks:
+        header = list(chunk.columns)
+        for row in chunk.itertuples(index=False, name=None):
+            if ws is None or sheet_rows == EXCEL_SHEET_ROWS:
+                ws = wb.create_sheet(f'Лист{len(wb.worksheets) + 1}')
+                ws.append(header)
+                sheet_rows = 0
+            ws.append(row)
+            sheet_rows += 1
+        n_rows += len(chunk)
+    if ws is None:
+        raise ValueError("Нет данных для выгрузки")
+    wb.save(path)
+    return n_rows
+
+
+# Запись блоков в файл выбранного формата; возвращает число строк
+def write_export(chunks, path, file_format='csv', compress=False):
+    if file_format == 'csv':
+        return write_csv(chunks, path, compress=compress)
+    if file_format == 'parquet':
+        return write_parquet(chunks, path, compress=compress)
+    if file_format == 'xlsx':
+        if compress:
+            raise ValueError("Файл xlsx уже сжат, gzip для него не применяется")
+        return write_xlsx(chunks, path)
+    raise ValueError(f"Неизвестный формат выгрузки: {file_format}")
+
+
+# Имя файла выгрузки с расширением формата (и .gz для сжатого CSV)
+def export_file_name(stem, file_format, compress=False):
+    name = stem + EXPORT_FORMATS[file_format][0]
+    return name + '.gz' if compress and file_format == 'csv' else name
+
+
+def export_mime(file_format, compress=False):
+    if compress and file_format == 'csv':
+        return 'application/gzip'
+    return EXPORT_FORMATS[file_format][1]
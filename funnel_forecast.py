@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from funnel_core import period_starts
+
+# Длина шага прогноза: неделя, месяц, квартал
+FORECAST_FREQS = ('W', 'M', 'Q')
+
+
+# Прогноз этапов воронки на следующий период по всем филиалам
+@dataclass(slots=True)
+class FunnelForecast:
+    branches: list            # филиалы (ось филиалов куба)
+    targets: list             # прогнозируемые этапы
+    starts: np.ndarray        # начала полных периодов истории, datetime64[D]
+    history: np.ndarray       # фактические значения этапов-целей, форма (периоды, филиалы, цели)
+    target_start: np.datetime64  # начало прогнозируемого периода
+    forecast: np.ndarray      # прогноз, форма (филиалы, цели)
+    backtest: np.ndarray      # прогноз последнего полного периода по модели без него, форма (филиалы, цели)
+    wape: np.ndarray          # ошибка backtest по всем филиалам: сумма |ошибок| / сумма факта, %, форма (цели,)
+
+
+# Начало периода, следующего за start
+def _next_start(starts, freq):
+    if freq == 'W':
+        return starts + np.timedelta64(7, 'D')
+    step = 1 if freq == 'M' else 3
+    return (starts.astype('datetime64[M]') + step).astype('datetime64[D]')
+
+
+# Сплошная сетка периодов от первой до последней даты (периоды без данных - нули)
+# и значения одной метрики по периодам, филиалам и этапам - разностями префиксных сумм куба
+def period_values(cube, metric, freq):
+    m = cube.metrics.index(metric)
+    days = cube.dates.astype('datetime64[D]')
+    first, last = period_starts(days[[0, -1]], freq)
+    if freq == 'W':
+        starts = np.arange(first, last + np.timedelta64(1, 'D'), 7)
+    else:
+        months = np.arange(first.astype('datetime64[M]'), last.astype('datetime64[M]') + 1, 1 if freq == 'M' else 3)
+        starts = months.astype('datetime64[D]')
+
+    bounds = np.searchsorted(days, np.append(starts, _next_start(starts[-1], freq)), side='left')
+    cumsum = cube.cumsum[:, :, :, m]
+    values = cumsum[bounds[1:]] - cumsum[bounds[:-1]]
+
+    # Последний период неполный, если данные закончились раньше его последнего дня
+    complete = days[-1] == _next_start(starts[-1], freq) - np.timedelta64(1, 'D')
+    return starts, values, complete
+
+
+# Признаки и цели для шага «период t -> t + 1»: значения всех этапов за lags последних периодов и 1
+def _design(values, targets, lags):
+    n_periods = values.shape[0]
+    features = [values[lags - 1 - lag:n_periods - 1 - lag] for lag in range(lags)]
+    x = np.concatenate(features + [np.ones(features[0].shape[:2] + (1,))], axis=2)
+    y = values[lags:, :, targets]
+    # (филиалы, наблюдения, признаки) и (филиалы, наблюдения, цели)
+    return x.transpose(1, 0, 2), y.transpose(1, 0, 2)
+
+
+def _last_features(values, lags):
+    features = [values[-1 - lag] for lag in range(lags)]
+    return np.concatenate(features + [np.ones((values.shape[1], 1))], axis=1)
+
+
+# Гребневая регрессия сразу для всех филиалов: веса филиала стягиваются к общей модели по всем филиалам,
+# поэтому короткая история одного филиала не дает переобучения. Одна батчевая операция solve, без цикла.
+def _fit(x, y, ridge):
+    n_features = x.shape[2]
+    eye = np.eye(n_features) * ridge
+    pooled_x, pooled_y = x.reshape(-1, n_features), y.reshape(-1, y.shape[2])
+    pooled = np.linalg.solve(pooled_x.T @ pooled_x + eye, pooled_x.T @ pooled_y)
+
+    xtx = np.einsum('bnk,bnj->bkj', x, x) + eye
+    xty = np.einsum('bnk,bnt->bkt', x, y) + ridge * pooled
+    return np.linalg.solve(xtx, xty)
+
+
+def _predict(weights, features):
+    return np.maximum(np.einsum('bk,bkt->bt', features, weights), 0)
+
+
+# Прогноз этапов targets (по умолчанию - двух последних) на период после последнего полного
+# по значениям всех этапов за lags предыдущих периодов. Модель учится на history последних полных периодах;
+# значения каждого филиала нормируются на его средний первый этап, чтобы филиалы разного размера были сравнимы.
+def forecast_branches(cube, metric, freq='M', targets=None, lags=2, history=104, ridge=1.0):
+    if freq not in FORECAST_FREQS:
+        raise ValueError(f"Неизвестная частота прогноза: {freq}")
+    if not len(cube.dates):
+        raise ValueError("Нет данных для прогноза")
+    targets = list(targets) if targets else cube.stages[-2:]
+    target_positions = [cube.stages.index(stage) for stage in targets]
+
+    starts, values, complete = period_values(cube, metric, freq)
+    if not complete:
+        starts, values = starts[:-1], values[:-1]
+    starts, values = starts[-history:], values[-history:].astype(np.float64)
+    # Для обучения и проверки нужны хотя бы два шага после lags периодов признаков
+    if len(starts) < lags + 2:
+        raise ValueError(f"Мало истории для прогноза: полных периодов {len(starts)}, нужно не меньше {lags + 2}")
+
+    scale = values[:, :, 0].mean(axis=0) + 1.0
+    scaled = values / scale[None, :, None]
+
+    x, y = _design(scaled, target_positions, lags)
+    weights = _fit(x, y, ridge)
+    forecast = _predict(weights, _last_features(scaled, lags)) * scale[:, None]
+
+    # Проверка на последнем полном периоде: модель без него прогнозирует его значения
+    check_weights = _fit(x[:, :-1], y[:, :-1], ridge)
+    backtest = _predict(check_weights, _last_features(scaled[:-1], lags)) * scale[:, None]
+    actual = values[-1][:, target_positions]
+    wape = np.zeros(len(targets))
+    total = actual.sum(axis=0)
+    np.divide(np.abs(backtest - actual).sum(axis=0), total, out=wape, where=total > 0)
+
+    return FunnelForecast(
+        branches=list(cube.branches),
+        targets=targets,
+        starts=starts,
+        history=values[:, :, target_positions],
+        target_start=_next_start(starts[-1], freq),
+        forecast=forecast,
+        backtest=backtest,
+        wape=wape * 100,
+    )
@@ -0,0 +1,614 @@
+import csv
+import io
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from funnel_cache import DiskCache
+from funnel_core import (
+    NO_DAY, FunnelTable, build_cube, cube_to_arrays, cube_from_arrays, dates_to_days, branch_code_dtype,
+    compact_metric, default_agg_workers, merge_tables, merge_cubes
+)
+from funnel_schema import add_schema_argument, load_schema, schema_from_header
+
+
+# 1970-01-01 в порядковых днях datetime
+EPOCH_ORDINAL = 719163
+
+# Строк между отметками хода разбора (и проверками отмены) при загрузке с LoadProgress
+PROGRESS_ROWS = 2 ** 16
+
+
+# Загрузка отменена через LoadProgress.cancel()
+class LoadCancelled(Exception):
+    pass
+
+
+# Ход загрузки в фоновом потоке: поток пополняет счетчики, интерфейс читает их.
+# cancel() прерывает разбор исключением LoadCancelled на ближайшей отметке хода.
+class LoadProgress:
+    def __init__(self, n_files=0):
+        self.n_files = n_files
+        self.files_done = 0
+        self.rows = 0
+        self.current = ''    # файл, который сейчас разбирается
+        self._file_rows = 0  # строки текущего файла, отмеченные по ходу разбора
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise LoadCancelled("Загрузка отменена")
+
+    def add_rows(self, n):
+        self.rows += n
+        self._file_rows += n
+        self.check()
+
+    # Файл готов: счетчик строк уточняется по итоговому числу строк файла
+    # (разбор в дочернем процессе, из кэша или через pandas не отмечает строки по ходу)
+    def file_done(self, n_rows):
+        self.rows += n_rows - self._file_rows
+        self._file_rows = 0
+        self.files_done += 1
+        self.check()
+
+
+# Результат разбора в компактную таблицу: значения раскладываются по схеме,
+# каждая метрика хранится в int32 (целые количества) или float32.
+# coerced - пары (строка, столбец значений файла) нечисловых ячеек; столбцы переводятся в этап и метрику схемы,
+# ячейки лишних столбцов файла отбрасываются вместе со столбцами.
+def compact_table(days, branch_codes, branch_names, schema, values, coerced=None):
+    n_columns = min(len(schema), values.shape[1])
+    values = schema.layout(values)
+    cells = np.asarray(coerced if coerced is not None else [], dtype=np.int64).reshape(-1, 2)
+    cells = cells[cells[:, 1] < n_columns]
+    # Порядок по строкам, затем по столбцам - один и тот же при потоковом чтении и через pandas
+    cells = cells[np.lexsort((cells[:, 1], cells[:, 0]))]
+    return FunnelTable(
+        days=days,
+        branch_codes=branch_codes.astype(branch_code_dtype(len(branch_names))),
+        branch_names=list(branch_names),
+        stages=schema.stages,
+        metrics=schema.metrics,
+        values=[compact_metric(values[:, :, m]) for m in range(len(schema.metrics))],
+        coerced=np.column_stack(
+            [cells[:, 0], schema.stage_positions[cells[:, 1]], schema.metric_positions[cells[:, 1]]]
+        ).astype(np.int64),
+    )
+
+
+# Следующая непустая строка листа; None - строки закончились (полностью пустые строки пропускаются)
+def _next_data_row(rows):
+    for row in rows:
+        if any(cell is not None for cell in row):
+            return row
+    return None
+
+
+# Заполнение массивов строками листа с позиции start, пока массивы не заполнятся или строки не закончатся;
+# возвращает число заполненных строк. branch_names (филиал -> код) пополняется по ходу чтения,
+# в coerced добавляются (строка, столбец) нечисловых ячеек.
+def _fill_rows(rows, days, branch_codes, values, branch_names, coerced, start=0):
+    n_values = values.shape[1]
+    n = start
+    while n < len(days):
+        row = _next_data_row(rows)
+        if row is None:
+            break
+
+        date = pd.Timestamp(row[0]) if row[0] is not None else pd.NaT
+        days[n] = date.toordinal() - EPOCH_ORDINAL if date is not pd.NaT else NO_DAY
+
+        # Пустой филиал - код -1, как pd.factorize в table_from_frame: такие строки не попадают в агрегаты
+        if len(row) > 1 and row[1] is not None:
+            branch_codes[n] = branch_names.setdefault(str(row[1]), len(branch_names))
+        else:
+            branch_codes[n] = -1
+
+        # Нечисловые ячейки приводятся к 0, как pd.to_numeric(errors='coerce') + fillna(0)
+        for j, cell in enumerate(row[2:2 + n_values]):
+            if cell is None:
+                value = 0.0
+            elif isinstance(cell, (int, float)):
+                value = cell
+            else:
+                try:
+                    value = float(cell)
+                except (TypeError, ValueError):
+                    value = 0.0
+                    coerced.append((n, j))
+            values[n, j] = value if value == value else 0.0
+        n += 1
+    return n
+
+
+# Первый лист книги: итератор строк данных, число столбцов значений и схема (из заголовков, если не задана)
+def _open_sheet(wb, schema):
+    ws = wb.worksheets[0]
+    rows = ws.iter_rows(values_only=True)
+
+    # Первые 2 строки - это заголовки
+    header = [next(rows, ()), next(rows, ())]
+    n_values = max(ws.max_column or 0, *(len(row) for row in header)) - 2
+    if schema is None:
+        schema = schema_from_header(header[0][2:], header[1][2:], n_values)
+    return ws, rows, n_values, schema
+
+
+# _fill_rows отрезками по PROGRESS_ROWS строк с отметкой хода разбора после каждого отрезка
+def _fill_rows_reporting(rows, days, branch_codes, values, branch_names, coerced, start, progress):
+    if progress is None:
+        return _fill_rows(rows, days, branch_codes, values, branch_names, coerced, start=start)
+    n = start
+    while n < len(days):
+        stop = min(n + PROGRESS_ROWS, len(days))
+        filled = _fill_rows(rows, days[:stop], branch_codes[:stop], values[:stop], branch_names, coerced, start=n)
+        progress.add_rows(filled - n)
+        n = filled
+        if n < stop:
+            break
+    return n
+
+
+# Потоковое чтение листа сразу в типизированные массивы, без DataFrame с object-столбцами.
+# Без явной схемы этапы и метрики берутся из двух строк заголовков.
+def read_excel_streaming(source, schema=None, progress=None):
+    # openpyxl импортируется при первом чтении Excel, а не при запуске приложения
+    from openpyxl import load_workbook
+
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        ws, rows, n_values, schema = _open_sheet(wb, schema)
+
+        # Предварительное выделение массивов по размеру листа (если он указан в файле)
+        capacity = max(ws.max_row - 2, 1) if ws.max_row else 1024
+        days = np.full(capacity, NO_DAY, dtype=np.int32)
+        branch_codes = np.zeros(capacity, dtype=np.int32)
+        values = np.zeros((capacity, n_values), dtype=np.float32)
+        branch_names = {}
+        coerced = []
+
+        n = _fill_rows_reporting(rows, days, branch_codes, values, branch_names, coerced, 0, progress)
+        while n == capacity:
+            # Массивы заполнены: растут, только если за ними есть еще строка данных. При верном размере листа
+            # лист кончается ровно здесь, и массивы не копируются
+            row = _next_data_row(rows)
+            if row is None:
+                break
+            rows = itertools.chain([row], rows)
+            # Лист оказался длиннее заявленного - удваиваем массивы
+            capacity *= 2
+            days = np.resize(days, capacity)
+            branch_codes = np.resize(branch_codes, capacity)
+            values = np.resize(values, (capacity, n_values))
+            values[n:] = 0
+            n = _fill_rows_reporting(rows, days, branch_codes, values, branch_names, coerced, n, progress)
+    finally:
+        wb.close()
+
+    return compact_table(days[:n], branch_codes[:n], branch_names, schema, values[:n], coerced)
+
+
+# Лист Excel блоками по chunk_rows строк: в памяти одновременно только один блок.
+# Коды филиалов сквозные для всего файла.
+def iter_excel_tables(source, schema=None, chunk_rows=2 ** 20):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        _, rows, n_values, schema = _open_sheet(wb, schema)
+        branch_names = {}
+        while True:
+            days = np.full(chunk_rows, NO_DAY, dtype=np.int32)
+            branch_codes = np.zeros(chunk_rows, dtype=np.int32)
+            values = np.zeros((chunk_rows, n_values), dtype=np.float32)
+            coerced = []
+            n = _fill_rows(rows, days, branch_codes, values, branch_names, coerced)
+            if n:
+                yield compact_table(days[:n], branch_codes[:n], branch_names, schema, values[:n], coerced)
+            if n < chunk_rows:
+                break
+    finally:
+        wb.close()
+
+
+# Разбор таблицы pandas в типизированные массивы: header - две строки заголовков, df - строки данных
+def table_from_frame(header, df, schema=None):
+    if schema is None:
+        header = [list(row)[2:] for row in header] + [[], []]
+        schema = schema_from_header(header[0], header[1], df.shape[1] - 2)
+
+    # Полностью пустые строки отбрасываются, как при потоковом чтении (_next_data_row): оба режима дают
+    # одну и ту же таблицу, поэтому запись кэша у них общая
+    filled = df.notna().any(axis=1).to_numpy()
+    if not filled.all():
+        df = df[filled]
+
+    # Нечисловые значения приводятся к 0 сразу для всего блока значений
+    raw = df.iloc[:, 2:]
+    numeric = raw.apply(pd.to_numeric, errors='coerce')
+    values = numeric.fillna(0).to_numpy(dtype=np.float32)
+
+    # Приведенные ячейки - непустые, но не ставшие числом; в числовых столбцах таких нет
+    coerced = [np.zeros((0, 2), dtype=np.int64)]
+    for j in range(raw.shape[1]):
+        if not pd.api.types.is_numeric_dtype(raw.dtypes.iloc[j]):
+            rows = np.flatnonzero(numeric.iloc[:, j].isna().to_numpy() & raw.iloc[:, j].notna().to_numpy())
+            coerced.append(np.column_stack([rows, np.full(len(rows), j)]))
+
+    branch_codes, branch_names = pd.factorize(df.iloc[:, 1])
+    return compact_table(
+        dates_to_days(pd.to_datetime(df.iloc[:, 0]).to_numpy(dtype='datetime64[ns]')),
+        branch_codes,
+        [str(branch) for branch in branch_names],
+        schema,
+        values,
+        np.concatenate(coerced),
+    )
+
+
+# Разбор «сырой» таблицы pandas, в которой первые 2 строки - это заголовки
+def table_from_raw_frame(df, schema=None):
+    return table_from_frame(df.iloc[:2].to_numpy(dtype=object), df.iloc[2:], schema)
+
+
+# Чтение Excel через pandas: разбор в DataFrame, затем приведение к тем же типизированным массивам
+def read_excel_pandas(source, schema=None):
+    return table_from_raw_frame(pd.read_excel(source, header=None), schema)
+
+
+# CSV в том же формате: две строки заголовков, дата, филиал, столбцы значений по этапам.
+# Заголовки читаются отдельно, поэтому pandas сразу разбирает столбцы значений как числа,
+# а не как object вперемешку со строками заголовков.
+def read_csv(source, schema=None, progress=None):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding='utf-8-sig', newline='') as f:
+            return _read_csv_text(f, schema, progress)
+    text = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')
+    try:
+        return _read_csv_text(text, schema, progress)
+    finally:
+        # Загруженный файл остается открытым
+        text.detach()
+
+
+def _read_csv_text(f, schema, progress=None):
+    reader = csv.reader(f)
+    header = [next(reader, []), next(reader, [])]
+    if progress is not None:
+        # Блоками по PROGRESS_ROWS строк с отметкой хода после каждого блока; пустой файл - ниже
+        tables = []
+        for table in _csv_chunk_tables(f, header, schema, PROGRESS_ROWS):
+            tables.append(table)
+            progress.add_rows(len(table))
+        if tables:
+            return merge_tables(tables)
+    try:
+        df = pd.read_csv(f, header=None, dtype={1: str})
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame(columns=range(max(len(header[0]), len(header[1]), 2)))
+    return table_from_frame(header, df, schema)
+
+
+# CSV блоками по chunk_rows строк; коды филиалов в каждом блоке свои
+def iter_csv_tables(source, schema=None, chunk_rows=2 ** 20):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding='utf-8-sig', newline='') as f:
+            yield from _iter_csv_text(f, schema, chunk_rows)
+        return
+    text = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')
+    try:
+        yield from _iter_csv_text(text, schema, chunk_rows)
+    finally:
+        text.detach()
+
+
+def _iter_csv_text(f, schema, chunk_rows):
+    reader = csv.reader(f)
+    header = [next(reader, []), next(reader, [])]
+    yield from _csv_chunk_tables(f, header, schema, chunk_rows)
+
+
+def _csv_chunk_tables(f, header, schema, chunk_rows):
+    try:
+        chunks = pd.read_csv(f, header=None, dtype={1: str}, chunksize=chunk_rows)
+    except pd.errors.EmptyDataError:
+        return
+    with chunks:
+        for df in chunks:
+            # Схема из заголовков определяется один раз - по первому блоку
+            if schema is None:
+                schema = schema_from_header(header[0][2:], header[1][2:], df.shape[1] - 2)
+            yield table_from_frame(header, df, schema)
+
+
+def source_name(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    return getattr(source, 'name', '') or ''
+
+
+# Ключ постоянного кэша по содержимому файла (путь, загруженный файл Streamlit или поток)
+def content_key(source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return DiskCache.key_for_stream(f)
+    if hasattr(source, 'getbuffer'):
+        return DiskCache.key_for(source.getbuffer())
+    position = source.tell()
+    key = DiskCache.key_for_stream(source)
+    source.seek(position)
+    return key
+
+
+# Ключ записи кэша: содержимое файла и, если схема задана явно, ее ключ. Режим чтения в ключ не входит:
+# потоковое чтение и pandas дают одинаковые таблицы (см. table_differences)
+def dataset_key(source, schema=None):
+    key = content_key(source)
+    return key if schema is None else f'{key}-{schema.key()}'
+
+
+# Расхождения двух таблиц одного файла по полям (пустой список - таблицы совпадают).
+# Коды филиалов сравниваются через названия: порядок кодов у разных способов чтения может различаться.
+def table_differences(a, b):
+    found = []
+    if len(a) != len(b):
+        return [f"строк: {len(a)} и {len(b)}"]
+    if a.stages != b.stages or a.metrics != b.metrics:
+        found.append("этапы или метрики")
+    if not np.array_equal(a.days, b.days):
+        found.append("даты")
+    names_a = np.asarray(list(a.branch_names) + [None], dtype=object)[a.branch_codes]
+    names_b = np.asarray(list(b.branch_names) + [None], dtype=object)[b.branch_codes]
+    if not np.array_equal(names_a, names_b):
+        found.append("филиалы")
+    if len(a.values) != len(b.values) or any(
+        x.dtype != y.dtype or not np.array_equal(x, y) for x, y in zip(a.values, b.values)
+    ):
+        found.append("значения")
+    if (a.coerced is None) != (b.coerced is None) or (
+        a.coerced is not None and not np.array_equal(a.coerced, b.coerced)
+    ):
+        found.append("нечисловые ячейки")
+    return found
+
+
+def read_table(source, streaming=True, schema=None, progress=None):
+    if source_name(source).lower().endswith('.csv'):
+        return read_csv(source, schema, progress)
+    if streaming:
+        return read_excel_streaming(source, schema, progress)
+    return read_excel_pandas(source, schema)
+
+
+# Файл блоками типизированных таблиц (Excel читается только потоково)
+def iter_tables(source, schema=None, chunk_rows=2 ** 20):
+    if source_name(source).lower().endswith('.csv'):
+        return iter_csv_tables(source, schema, chunk_rows)
+    return iter_excel_tables(source, schema, chunk_rows)
+
+
+def load_cached(cache, key):
+    cached = cache.load(key)
+    if cached is None:
+        return None
+    arrays, meta = cached
+    table = FunnelTable(
+        days=arrays['days'],
+        branch_codes=arrays['branch_codes'],
+        branch_names=meta['branch_names'],
+        stages=meta['stages'],
+        metrics=meta['metrics'],
+        values=[arrays[f'values_{m}'] for m in range(len(meta['metrics']))],
+        coerced=arrays['coerced'],
+    )
+    return table, cube_from_arrays(arrays, meta)
+
+
+def store_dataset(cache, key, table, cube):
+    cube_arrays, cube_meta = cube_to_arrays(cube)
+    return cache.store(
+        key,
+        {
+            'days': table.days,
+            'branch_codes': table.branch_codes,
+            **{f'values_{m}': values for m, values in enumerate(table.values)},
+            'coerced': table.coerced,
+            **cube_arrays,
+        },
+        {'branch_names': table.branch_names, **cube_meta},
+    )
+
+
+# Таблица и куб агрегатов для файла; при переданном cache повторный разбор не выполняется.
+# key - уже посчитанный dataset_key (без него файл хэшируется здесь); progress - LoadProgress для отметок
+# хода разбора и отмены.
+def load_dataset(source, streaming=True, cache=None, schema=None, agg_workers=None, progress=None, key=None):
+    if cache is None:
+        key = None
+    elif key is None:
+        key = dataset_key(source, schema)
+    if key is not None:
+        cached = load_cached(cache, key)
+        if cached is not None:
+            return cached
+
+    table = read_table(source, streaming=streaming, schema=schema, progress=progress)
+    if progress is not None:
+        progress.check()
+    cube = build_cube(table, workers=agg_workers)
+
+    if key is not None:
+        store_dataset(cache, key, table, cube)
+    return table, cube
+
+
+# Файлы .xlsx/.csv каталога в порядке имен (временные файлы Excel ~$... пропускаются)
+def directory_sources(directory):
+    names = sorted(
+        name for name in os.listdir(directory)
+        if name.lower().endswith(('.xlsx', '.csv')) and not name.startswith('~$')
+    )
+    return [os.path.join(directory, name) for name in names]
+
+
+# Отпечаток файла без чтения содержимого: путь, размер и время изменения или id загрузки Streamlit
+def source_fingerprint(source):
+    if isinstance(source, (str, os.PathLike)):
+        stat = os.stat(source)
+        return (os.fspath(source), stat.st_size, stat.st_mtime_ns)
+    return (source_name(source), getattr(source, 'file_id', None), getattr(source, 'size', None))
+
+
+# Разбор в дочернем процессе. С кэшем результат записывается на диск и читается родителем через mmap,
+# без передачи массивов между процессами.
+# Ключ записи посчитан родителем и передается вместе с файлом: файл не хэшируется повторно.
+def _parse_in_worker(source, name, streaming, cache_dir, cache_max_bytes, schema, agg_workers, key):
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+        source.name = name
+    if cache_dir is None:
+        return load_dataset(source, streaming=streaming, schema=schema, agg_workers=agg_workers)
+
+    cache = DiskCache(cache_dir, cache_max_bytes)
+    table, cube = load_dataset(
+        source, streaming=streaming, cache=cache, schema=schema, agg_workers=agg_workers, key=key
+    )
+    if cache.load(key) is not None:
+        return None
+    return table, cube
+
+
+def default_workers():
+    return int(os.environ.get('FUNNEL_WORKERS', 0)) or os.cpu_count() or 1
+
+
+# Таблицы и кубы для списка файлов: найденные в кэше открываются сразу,
+# остальные разбираются параллельно в пуле процессов (по процессу на файл).
+# С progress отмечаются готовые файлы и строки; после отмены файлы, которые уже разбираются
+# в дочерних процессах, дорабатывают в фоне, а их результат отбрасывается.
+# keys - уже посчитанные dataset_key по источникам (например, ключи реестра), чтобы не хэшировать файлы еще раз
+def load_many(sources, streaming=True, cache=None, workers=None, schema=None, agg_workers=None, progress=None,
+              keys=None):
+    results = [None] * len(sources)
+    keys = list(keys) if keys is not None else [None] * len(sources)
+    missing = []
+    for i, source in enumerate(sources):
+        if cache is not None:
+            if keys[i] is None:
+                keys[i] = dataset_key(source, schema)
+            results[i] = load_cached(cache, keys[i])
+        if results[i] is None:
+            missing.append(i)
+        elif progress is not None:
+            progress.file_done(len(results[i][0]))
+
+    workers = min(workers or default_workers(), len(missing))
+    if workers <= 1:
+        for i in missing:
+            if progress is not None:
+                progress.current = source_name(sources[i])
+            results[i] = load_dataset(
+                sources[i], streaming=streaming, cache=cache, schema=schema, agg_workers=agg_workers,
+                progress=progress, key=keys[i]
+            )
+            if progress is not None:
+                progress.file_done(len(results[i][0]))
+        return results
+
+    # Потоки агрегации делятся между процессами, чтобы не занять больше ядер, чем задано
+    agg_workers_per_process = max((agg_workers or default_agg_workers()) // workers, 1)
+
+    # spawn вместо fork: родитель (Streamlit) многопоточный
+    context = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    cancelled = False
+    try:
+        futures = {}
+        for i in missing:
+            source = sources[i]
+            if not isinstance(source, (str, os.PathLike)):
+                source = bytes(source.getbuffer()) if hasattr(source, 'getbuffer') else source.read()
+            futures[pool.submit(
+                _parse_in_worker,
+                source,
+                source_name(sources[i]),
+                streaming,
+                cache.directory if cache is not None else None,
+                cache.max_bytes if cache is not None else None,
+                schema,
+                agg_workers_per_process,
+                keys[i],
+            )] = i
+
+        pending = set(futures)
+        while pending:
+            # Без progress ждем без таймаута; с ним - короткими интервалами, чтобы заметить отмену
+            done, pending = wait(pending, timeout=0.2 if progress is not None else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                results[i] = future.result() or load_cached(cache, keys[i])
+                if progress is not None:
+                    progress.file_done(len(results[i][0]))
+            if progress is not None:
+                progress.check()
+    except LoadCancelled:
+        cancelled = True
+        raise
+    finally:
+        pool.shutdown(wait=not cancelled, cancel_futures=cancelled)
+    return results
+
+
+# Файлы, объединенные в одну таблицу и куб: общий путь приложения, сервиса и утилит командной строки.
+# base - уже загруженные (таблица, куб), к которым дописываются sources: при добавлении файлов
+# разбираются только новые. Остальные параметры - как у load_many.
+def load_merged(sources, streaming=True, cache=None, workers=None, schema=None, agg_workers=None, progress=None,
+                keys=None, base=None):
+    parts = load_many(sources, streaming=streaming, cache=cache, workers=workers, schema=schema,
+                      agg_workers=agg_workers, progress=progress, keys=keys)
+    if base is not None:
+        parts = [base] + parts
+    if progress is not None:
+        progress.current = 'объединение с загруженными данными' if base is not None else 'объединение файлов'
+    table = merge_tables([part_table for part_table, _ in parts])
+    cube = parts[0][1]
+    for _, part_cube in parts[1:]:
+        if progress is not None:
+            progress.check()
+        cube = merge_cubes(cube, part_cube)
+    return table, cube
+
+
+# Параметры загрузки командной строки - общие для funnel_cli, funnel_quality и funnel_server
+def add_load_arguments(parser):
+    parser.add_argument('--pandas', action='store_true', help="читать Excel через pandas вместо потокового чтения")
+    parser.add_argument('--no-cache', action='store_true', help="не использовать постоянный кэш разобранных файлов")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="число процессов для разбора файлов (по умолчанию FUNNEL_WORKERS или число ядер)")
+    parser.add_argument('--agg-workers', type=int, default=None,
+                        help="число потоков для построения агрегатов (по умолчанию FUNNEL_AGG_WORKERS или число ядер)")
+    add_schema_argument(parser)
+
+
+# Аргументы load_merged (и FunnelService) из параметров add_load_arguments
+def load_options(args):
+    return dict(
+        streaming=not args.pandas,
+        cache=None if args.no_cache else DiskCache(),
+        workers=args.workers,
+        schema=load_schema(args.schema) if args.schema else None,
+        agg_workers=args.agg_workers,
+    )
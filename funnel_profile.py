@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+import weakref
+from datetime import datetime
+
+# Режим замеров включается флажком в сайдбаре; FUNNEL_PROFILE=1 включает его по умолчанию
+DEFAULT_ENABLED = os.environ.get('FUNNEL_PROFILE', '') not in ('', '0')
+# Журнал замеров (JSON по строке на перезапуск) и textfile для node_exporter (Prometheus)
+DEFAULT_LOG_PATH = os.environ.get('FUNNEL_PROFILE_LOG') or None
+DEFAULT_TEXTFILE_PATH = os.environ.get('FUNNEL_PROFILE_TEXTFILE') or None
+
+# tracemalloc общий на процесс: включен, пока идет хотя бы один замер в какой-либо сессии
+_lock = threading.Lock()
+_active = 0
+_started_tracing = False
+
+# Накопленные значения для счетчиков Prometheus: фаза -> (число перезапусков, сумма секунд)
+_totals = {}
+
+
+def _start_tracing():
+    global _active, _started_tracing
+    with _lock:
+        if _active == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _active += 1
+
+
+def _stop_tracing():
+    global _active, _started_tracing
+    with _lock:
+        _active -= 1
+        if _active == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+# Замеры одного перезапуска скрипта по фазам. lap(name) закрывает фазу, начатую предыдущим lap
+# (или созданием объекта): время фазы и прирост пиковой памяти относительно ее начала.
+# При выключенном режиме lap ничего не делает.
+class RerunProfile:
+    def __init__(self, enabled=DEFAULT_ENABLED):
+        self.enabled = enabled
+        self.phases = []  # (фаза, секунды, пиковая память в байтах)
+        self.started = time.perf_counter()
+        self.finished = False
+        if enabled:
+            _start_tracing()
+            # Если перезапуск прерван (st.stop, исключение), трассировка отключается при удалении объекта
+            self._stop_tracing = weakref.finalize(self, _stop_tracing)
+            tracemalloc.reset_peak()
+            self._memory_start = tracemalloc.get_traced_memory()[0]
+        self._phase_start = time.perf_counter()
+
+    def lap(self, name):
+        if not self.enabled or self.finished:
+            return
+        seconds = time.perf_counter() - self._phase_start
+        current, peak = tracemalloc.get_traced_memory()
+        self.phases.append((name, seconds, max(peak - self._memory_start, 0)))
+        tracemalloc.reset_peak()
+        self._memory_start = current
+        self._phase_start = time.perf_counter()
+
+    # Завершение перезапуска: возвращает общее время; повторный вызов ничего не меняет
+    def finish(self):
+        if self.enabled and not self.finished:
+            self.finished = True
+            self._stop_tracing()
+            with _lock:
+                for name, seconds, _ in self.phases:
+                    count, total = _totals.get(name, (0, 0.0))
+                    _totals[name] = (count + 1, total + seconds)
+        return time.perf_counter() - self.started
+
+    def total_seconds(self):
+        return sum(seconds for _, seconds, _ in self.phases)
+
+    # Строки для таблицы в панели отладки
+    def rows(self):
+        total = self.total_seconds() or 1.0
+        return [
+            {
+                'Фаза': name,
+                'Время, мс': round(seconds * 1000, 2),
+                'Доля, %': round(seconds / total * 100, 1),
+                'Пик памяти, МБ': round(peak / 2 ** 20, 2),
+            }
+            for name, seconds, peak in self.phases
+        ]
+
+    # Запись перезапуска в журнал (JSON Lines)
+    def append_log(self, path, **fields):
+        record = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            **fields,
+            'total_seconds': round(self.total_seconds(), 6),
+            'phases': {
+                name: {'seconds': round(seconds, 6), 'peak_bytes': peak}
+                for name, seconds, peak in self.phases
+            },
+        }
+        with _lock, open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    # Textfile для node_exporter: последние значения фаз и накопленные счетчики процесса.
+    # Файл подменяется атомарно, чтобы экспортер не прочитал его наполовину записанным.
+    def write_textfile(self, path):
+        lines = [
+            '# HELP sales_funnel_phase_seconds Duration of the phase in the last rerun.',
+            '# TYPE sales_funnel_phase_seconds gauge',
+        ]
+        lines += [f'sales_funnel_phase_seconds{{phase="{name}"}} {seconds:.6f}' for name, seconds, _ in self.phases]
+        lines += [
+            '# HELP sales_funnel_phase_peak_bytes Peak traced memory growth during the phase in the last rerun.',
+            '# TYPE sales_funnel_phase_peak_bytes gauge',
+        ]
+        lines += [f'sales_funnel_phase_peak_bytes{{phase="{name}"}} {peak}' for name, _, peak in self.phases]
+        with _lock:
+            totals = dict(_totals)
+        lines += [
+            '# HELP sales_funnel_phase_seconds_total Total time spent in the phase by this process.',
+            '# TYPE sales_funnel_phase_seconds_total counter',
+        ]
+        lines += [f'sales_funnel_phase_seconds_total{{phase="{name}"}} {total:.6f}' for name, (_, total) in totals.items()]
+        lines += [
+            '# HELP sales_funnel_phase_runs_total Number of reruns that went through the phase.',
+            '# TYPE sales_funnel_phase_runs_total counter',
+        ]
+        lines += [f'sales_funnel_phase_runs_total{{phase="{name}"}} {count}' for name, (count, _) in totals.items()]
+
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
@@ -0,0 +1,318 @@
+import argparse
+import os
+import sys
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from funnel_core import NO_DAY, build_row_index, table_page_frame, run_parallel, default_agg_workers
+from funnel_io import load_merged, directory_sources, add_load_arguments, load_options
+
+# Порог выброса - модифицированная z-оценка 0.6745 * (x - медиана) / MAD по дням филиала
+DEFAULT_OUTLIER_THRESHOLD = float(os.environ.get('FUNNEL_OUTLIER_THRESHOLD', 3.5))
+
+# Меньше стольких дней с данными у филиала - выбросы по нему не ищутся
+OUTLIER_MIN_DAYS = 8
+
+# Строк в отрезке проверки воронки: временные маски остаются в кэше процессора
+CHECK_CHUNK_ROWS = 2 ** 16
+
+# Ячеек куба в полосе филиалов при поиске выбросов: временные копии не растут с размером куба
+OUTLIER_STRIP_CELLS = 2 ** 22
+
+# Строки без филиала в сводке и при выборе филиала
+NO_BRANCH = '(без филиала)'
+
+# Проверки и их названия в отчете
+QUALITY_CHECKS = {
+    'unassigned': 'Строки без даты/филиала',
+    'coerced': 'Нечисловые ячейки',
+    'duplicates': 'Повторы дата+филиал',
+    'non_monotone': 'Немонотонная воронка',
+    'outliers': 'Дни-выбросы',
+}
+
+
+# Результат проверки набора: номера строк таблицы и позиции в кубе для каждой проверки
+@dataclass(slots=True)
+class QualityReport:
+    unassigned_rows: np.ndarray      # int64, строки без даты или филиала: в куб (и в итоги по всем филиалам) не входят
+    coerced: np.ndarray              # int64 (ячейки, 3): строка, этап, метрика ячеек, приведенных к 0 (None - не отмечались)
+    duplicate_rows: np.ndarray       # int64, все строки пар дата+филиал, встречающихся больше одного раза
+    duplicate_groups: int            # число таких пар
+    non_monotone_rows: np.ndarray    # int64, строки, где этап больше предыдущего хотя бы по одной метрике
+    non_monotone_counts: np.ndarray  # int64 (переходы этапов, метрики): строк с нарушением на переходе
+    outliers: np.ndarray             # int64 (выбросы, 3): позиции даты, филиала и метрики в кубе
+    outlier_scores: np.ndarray       # модифицированная z-оценка первого этапа в каждом выбросе
+    outlier_medians: np.ndarray      # медиана первого этапа по дням филиала для этой метрики
+    threshold: float
+
+    # Число дней-выбросов: пары (дата, филиал), выпадающие хотя бы по одной метрике
+    @property
+    def outlier_days(self):
+        return len(np.unique(self.outliers[:, :2], axis=0))
+
+    # Число находок по каждой проверке
+    @property
+    def counts(self):
+        return {
+            'unassigned': len(self.unassigned_rows),
+            'coerced': len(self.coerced) if self.coerced is not None else 0,
+            'duplicates': len(self.duplicate_rows),
+            'non_monotone': len(self.non_monotone_rows),
+            'outliers': self.outlier_days,
+        }
+
+    @property
+    def nbytes(self):
+        arrays = [self.unassigned_rows, self.duplicate_rows, self.non_monotone_rows, self.non_monotone_counts,
+                  self.outliers, self.outlier_scores, self.outlier_medians]
+        if self.coerced is not None:
+            arrays.append(self.coerced)
+        return sum(array.nbytes for array in arrays)
+
+
+# Строки без даты (NO_DAY) или без филиала (код -1). build_cube их отбрасывает: они не входят ни в воронки,
+# ни в итоги «Все филиалы» и «За весь период», поэтому отчет показывает, сколько их и какие это строки.
+def unassigned_rows(table):
+    return np.flatnonzero((table.days == NO_DAY) | (table.branch_codes < 0)).astype(np.int64)
+
+
+# Строки с повторяющейся парой дата+филиал: в индексе строк они стоят подряд, поэтому хватает
+# сравнения соседей. Строки без даты или филиала в агрегаты не попадают и повторами не считаются.
+def duplicate_rows(table):
+    index = table.row_index if table.row_index is not None else build_row_index(table)
+    same = (index.days[1:] == index.days[:-1]) & (index.days[1:] != NO_DAY)
+    # Пары на границе отрезков филиалов и внутри отрезка строк без филиала (последнего)
+    starts = index.offsets[1:-1]
+    same[starts[(starts > 0) & (starts <= len(same))] - 1] = False
+    same[index.offsets[-2]:] = False
+
+    marked = np.zeros(len(index.rows), dtype=bool)
+    marked[:-1] |= same
+    marked[1:] |= same
+    return np.sort(index.rows[marked]).astype(np.int64)
+
+
+# Строки, где значение этапа больше, чем у предыдущего этапа, и число таких строк по переходам и метрикам.
+# Таблица проверяется отрезками по CHECK_CHUNK_ROWS строк сравнением соседних столбцов этапов
+# (по столбцу за раз: свертка .any(axis=1) по нескольким столбцам в несколько раз медленнее).
+def non_monotone_rows(table):
+    n_stages = len(table.stages)
+    counts = np.zeros((max(n_stages - 1, 0), len(table.metrics)), dtype=np.int64)
+    parts = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(table), CHECK_CHUNK_ROWS):
+        part = slice(start, start + CHECK_CHUNK_ROWS)
+        broken = np.zeros(len(table.days[part]), dtype=bool)
+        for m, values in enumerate(table.values):
+            chunk = values[part]
+            for s in range(n_stages - 1):
+                increase = chunk[:, s + 1] > chunk[:, s]
+                counts[s, m] += np.count_nonzero(increase)
+                broken |= increase
+        parts.append(start + np.flatnonzero(broken))
+    return np.concatenate(parts), counts
+
+
+# Медиана по последней оси отсортированных рядов, у которых наблюдаемых значений n_observed
+# (ненаблюдаемые - NaN - при сортировке уходят в конец ряда)
+def _sorted_median(ordered, n_observed):
+    n_observed = np.broadcast_to(n_observed, ordered.shape[:-1])[..., None]
+    lo = np.take_along_axis(ordered, (n_observed - 1) // 2, axis=-1)
+    hi = np.take_along_axis(ordered, n_observed // 2, axis=-1)
+    return (lo + hi) / 2
+
+
+# Дни-выбросы по кубу: объем первого этапа (входящий поток дня) каждого филиала по каждой метрике
+# сравнивается с медианой и MAD по дням, в которые у филиала есть строки. Если MAD = 0 (больше половины
+# дней одинаковы), разброс берется по среднему отклонению. Последующие этапы ограничены первым
+# и проверяются на монотонность построчно, а ряды малых чисел поздних этапов дают MAD в одну-две сделки.
+# Куб обрабатывается полосами филиалов: ряды полосы копируются в float32 подряд по датам и сортируются целиком,
+# медиана берется по числу наблюдаемых дней ряда - без прохода по рядам в Python.
+def outlier_cells(cube, threshold=DEFAULT_OUTLIER_THRESHOLD, workers=None):
+    observed = cube.rows > 0
+    n_observed = observed.sum(axis=0)
+    branches = np.flatnonzero(n_observed >= OUTLIER_MIN_DAYS)
+    width = max(OUTLIER_STRIP_CELLS // max(len(cube.dates) * len(cube.metrics), 1), 1)
+    strips = [branches[i:i + width] for i in range(0, len(branches), width)]
+
+    def find(strip):
+        # Ряды (филиалы, метрики, даты); ненаблюдаемые дни - NaN
+        series = np.moveaxis(cube.values[:, strip, 0], 0, -1).astype(np.float32)
+        hidden = ~observed[:, strip].T[:, None, :]
+        if hidden.any():
+            series[np.broadcast_to(hidden, series.shape)] = np.nan
+        counts = n_observed[strip][:, None]
+        median = _sorted_median(np.sort(series, axis=-1), counts)
+        spread = series - median
+        np.abs(spread, out=spread)
+        scale = _sorted_median(np.sort(spread, axis=-1), counts) / 0.6745
+        zero = scale[..., 0] == 0
+        if zero.any():
+            # Среднее отклонение - только для рядов с MAD = 0
+            n_zero = np.broadcast_to(counts, zero.shape)[zero][:, None]
+            scale[zero] = np.nansum(spread[zero], axis=-1, keepdims=True) / n_zero * 1.253314
+        # Сравнение |x - медиана| > порог * разброс без деления всего ряда; ряды без разброса не проверяются,
+        # NaN (ненаблюдаемые дни) в сравнении дает False
+        limit = np.where(scale > 0, scale * threshold, np.inf)
+        flagged = np.nonzero(spread > limit)
+        series_median, series_scale = median[flagged[:2]][:, 0], scale[flagged[:2]][:, 0]
+        scores = (series[flagged] - series_median) / series_scale
+        cells = np.column_stack([flagged[2], strip[flagged[0]], flagged[1]]).astype(np.int64)
+        return cells, scores.astype(np.float64), series_median.astype(np.float64)
+
+    found = run_parallel(find, strips, workers or default_agg_workers())
+    if not found:
+        return np.zeros((0, 3), dtype=np.int64), np.zeros(0), np.zeros(0)
+    return tuple(np.concatenate(parts) for parts in zip(*found))
+
+
+# Проверка набора после разбора: все проверки - операции над массивами таблицы и куба
+def validate(table, cube, threshold=DEFAULT_OUTLIER_THRESHOLD, workers=None):
+    duplicates = duplicate_rows(table)
+    non_monotone, non_monotone_counts = non_monotone_rows(table)
+    outliers, scores, medians = outlier_cells(cube, threshold, workers)
+    return QualityReport(
+        unassigned_rows=unassigned_rows(table),
+        coerced=table.coerced,
+        duplicate_rows=duplicates,
+        duplicate_groups=int(np.count_nonzero(cube.rows > 1)),
+        non_monotone_rows=non_monotone,
+        non_monotone_counts=non_monotone_counts,
+        outliers=outliers,
+        outlier_scores=scores,
+        outlier_medians=medians,
+        threshold=threshold,
+    )
+
+
+# Число находок по филиалам: строки по кодам филиалов таблицы, дни-выбросы по оси филиалов куба.
+# Только филиалы с находками, по убыванию общего числа.
+def branch_summary(table, cube, report):
+    n_codes = len(table.branch_names) + 1
+    names = table.branch_names + [NO_BRANCH]
+
+    def by_branch(rows):
+        return np.bincount(table.branch_codes[rows].astype(np.int64) % n_codes, minlength=n_codes)
+
+    coerced = report.coerced[:, 0] if report.coerced is not None else np.zeros(0, dtype=np.int64)
+    days = np.unique(report.outliers[:, :2], axis=0)
+    outlier_days = pd.Series(np.bincount(days[:, 1], minlength=len(cube.branches)), index=cube.branches)
+    summary = pd.DataFrame({
+        QUALITY_CHECKS['unassigned']: by_branch(report.unassigned_rows),
+        QUALITY_CHECKS['coerced']: by_branch(coerced),
+        QUALITY_CHECKS['duplicates']: by_branch(report.duplicate_rows),
+        QUALITY_CHECKS['non_monotone']: by_branch(report.non_monotone_rows),
+        QUALITY_CHECKS['outliers']: outlier_days.reindex(names, fill_value=0).to_numpy(),
+    }, index=pd.Index(names, name='Филиал'))
+    summary = summary[summary.sum(axis=1) > 0]
+    return summary.loc[summary.sum(axis=1).sort_values(ascending=False, kind='stable').index]
+
+
+# Маска строк rows, относящихся к филиалу branch (None - все строки, NO_BRANCH - строки без филиала)
+def _branch_mask(table, rows, branch):
+    if branch is None:
+        return np.ones(len(rows), dtype=bool)
+    if branch == NO_BRANCH:
+        code = -1
+    else:
+        code = table.branch_names.index(branch) if branch in table.branch_names else -2
+    return table.branch_codes[rows] == code
+
+
+# Строки проверки check ('unassigned', 'coerced', 'duplicates', 'non_monotone') для просмотра: первые limit строк
+# (по филиалу branch, если задан) в формате просмотра исходных данных и общее число найденных строк.
+# Для нечисловых ячеек добавляется столбец с этапом и метрикой ячейки.
+def issue_rows_frame(table, report, check, branch=None, limit=1000):
+    if check == 'coerced':
+        cells = report.coerced if report.coerced is not None else np.zeros((0, 3), dtype=np.int64)
+        cells = cells[_branch_mask(table, cells[:, 0], branch)]
+        frame = table_page_frame(table, cells[:limit, 0])
+        stages = np.asarray(table.stages, dtype=object)[cells[:limit, 1]]
+        metrics = np.asarray(table.metrics, dtype=object)[cells[:limit, 2]]
+        frame.insert(3, 'Ячейка', [f'{stage}, {metric}' for stage, metric in zip(stages, metrics)])
+        return frame, len(cells)
+    rows = {
+        'unassigned': report.unassigned_rows,
+        'duplicates': report.duplicate_rows,
+        'non_monotone': report.non_monotone_rows,
+    }[check]
+    rows = rows[_branch_mask(table, rows, branch)]
+    return table_page_frame(table, rows[:limit]), len(rows)
+
+
+# Выбросы по убыванию |оценки|: дата, филиал, метрика, объем первого этапа, медиана по дням филиала и оценка
+def outliers_frame(cube, report, branch=None):
+    cells, scores, medians = report.outliers, report.outlier_scores, report.outlier_medians
+    if branch is not None:
+        keep = cells[:, 1] == cube.branch_index.get(branch, -1)
+        cells, scores, medians = cells[keep], scores[keep], medians[keep]
+    order = np.argsort(-np.abs(scores), kind='stable')
+    cells, scores, medians = cells[order], scores[order], medians[order]
+    return pd.DataFrame({
+        'Дата': np.datetime_as_string(cube.dates[cells[:, 0]].astype('datetime64[D]'), unit='D'),
+        'Филиал': np.asarray(cube.branches, dtype=object)[cells[:, 1]],
+        'Метрика': np.asarray(cube.metrics, dtype=object)[cells[:, 2]],
+        cube.stages[0]: cube.values[cells[:, 0], cells[:, 1], 0, cells[:, 2]],
+        'Медиана': medians,
+        'Оценка': scores.round(1),
+    })
+
+
+# Нарушения монотонности по переходам этапов: строк с ростом на переходе для каждой метрики
+def non_monotone_frame(table, report):
+    transitions = [f'{table.stages[s]} → {table.stages[s + 1]}' for s in range(len(table.stages) - 1)]
+    return pd.DataFrame(report.non_monotone_counts, index=pd.Index(transitions, name='Переход'), columns=table.metrics)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Проверка данных воронки: строки без даты/филиала, нечисловые ячейки, повторы дата+филиал, "
+                    "немонотонные воронки, дни-выбросы"
+    )
+    parser.add_argument('sources', nargs='+',
+                        help="файлы .xlsx/.csv в формате приложения (две строки заголовков) или каталоги с ними")
+    parser.add_argument('--details', choices=list(QUALITY_CHECKS),
+                        help="вывести найденные строки (или ячейки-выбросы) одной проверки вместо сводки по филиалам")
+    parser.add_argument('--branch', help="только этот филиал (для --details)")
+    parser.add_argument('--limit', type=int, default=1000, help="строк в выводе --details (по умолчанию 1000)")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_OUTLIER_THRESHOLD,
+                        help="порог модифицированной z-оценки для выбросов (по умолчанию FUNNEL_OUTLIER_THRESHOLD или 3.5)")
+    add_load_arguments(parser)
+    return parser.parse_args(argv)
+
+
+# Сводка по филиалам (или строки одной проверки) - CSV в стандартный вывод, итоги - в stderr.
+# Код выхода 1, если найдено хоть что-то: проверку можно ставить перед загрузкой выгрузок.
+def main(argv=None):
+    args = parse_args(argv)
+    sources = []
+    for source in args.sources:
+        sources += directory_sources(source) if os.path.isdir(source) else [source]
+    if not sources:
+        print("Нет файлов для обработки", file=sys.stderr)
+        return 2
+
+    table, cube = load_merged(sources, **load_options(args))
+    report = validate(table, cube, args.threshold)
+
+    if args.details == 'outliers':
+        outliers_frame(cube, report, args.branch).head(args.limit).to_csv(sys.stdout, index=False)
+    elif args.details:
+        frame, _ = issue_rows_frame(table, report, args.details, args.branch, args.limit)
+        frame.to_csv(sys.stdout, index=False)
+    else:
+        branch_summary(table, cube, report).to_csv(sys.stdout)
+
+    counts = report.counts
+    print(
+        f"Строк: {len(table)}; " + ', '.join(f"{QUALITY_CHECKS[check].lower()}: {n}" for check, n in counts.items())
+        + f" (пар дата+филиал с повторами: {report.duplicate_groups})",
+        file=sys.stderr
+    )
+    return 1 if any(counts.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
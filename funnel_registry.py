@@ -0,0 +1,111 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+# Лимит памяти общего реестра наборов данных; наборы, которыми пользуются сессии, не вытесняются
+DEFAULT_MAX_BYTES = int(float(os.environ.get('FUNNEL_REGISTRY_MAX_MB', '4096')) * 2 ** 20)
+
+
+@dataclass
+class _Entry:
+    table: object
+    cube: object
+    quality: object
+    nbytes: int
+    refs: int = 0
+
+
+# Массивы набора только для чтения: одна копия раздается всем сессиям, и случайная запись
+# в одной сессии не может изменить данные другой
+def _freeze(table, cube, quality):
+    arrays = [table.days, table.branch_codes, *table.values, table.coerced]
+    arrays += [cube.dates, cube.values, cube.cumsum, cube.cumsum_all, cube.rows, cube.rows_cumsum]
+    if table.row_index is not None:
+        arrays += [table.row_index.rows, table.row_index.days, table.row_index.offsets]
+    if quality is not None:
+        arrays += [quality.unassigned_rows, quality.duplicate_rows, quality.non_monotone_rows,
+                   quality.non_monotone_counts, quality.outliers, quality.outlier_scores, quality.outlier_medians]
+    for array in arrays:
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+
+
+# Набор данных, выданный сессии. Пока объект жив, набор не вытесняется из реестра;
+# release() или удаление объекта (конец сессии) снимает ссылку.
+class DatasetLease:
+    def __init__(self, registry, key, table, cube, quality=None):
+        self.key = key
+        self.table = table
+        self.cube = cube
+        self.quality = quality
+        self._release = weakref.finalize(self, registry._release, key)
+
+    def release(self):
+        self._release()
+
+
+# Общий на процесс реестр разобранных наборов: по одной копии таблицы и куба на ключ содержимого.
+# Наборы без ссылок вытесняются в порядке давности использования, когда сумма объемов превышает лимит.
+class DatasetRegistry:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # ключ -> _Entry, от давно использованных к недавним
+        self._loading = {}             # ключ -> threading.Event, пока набор загружается
+
+    # Набор по ключу; если его нет, loader() возвращает (table, cube, quality) - отчет проверки может быть None.
+    # Одновременные запросы одного ключа из разных сессий ждут одну загрузку, а не разбирают файл каждая.
+    def lease(self, key, loader):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    self._entries.move_to_end(key)
+                    return DatasetLease(self, key, entry.table, entry.cube, entry.quality)
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Если загрузка в другой сессии завершится ошибкой, следующий проход попробует сам
+            loading.wait()
+
+        try:
+            table, cube, quality = loader()
+            _freeze(table, cube, quality)
+            nbytes = table.nbytes + cube.nbytes + (quality.nbytes if quality is not None else 0)
+            with self._lock:
+                self._entries[key] = _Entry(table, cube, quality, nbytes, refs=1)
+                self._evict()
+            return DatasetLease(self, key, table, cube, quality)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refs -= 1
+                self._evict()
+
+    # Вызывается под блокировкой
+    def _evict(self):
+        total = sum(entry.nbytes for entry in self._entries.values())
+        for key, entry in list(self._entries.items()):
+            if total <= self.max_bytes:
+                break
+            if entry.refs == 0:
+                del self._entries[key]
+                total -= entry.nbytes
+
+    # Число наборов, их общий объем в байтах и число выданных ссылок
+    def stats(self):
+        with self._lock:
+            entries = list(self._entries.values())
+        return len(entries), sum(entry.nbytes for entry in entries), sum(entry.refs for entry in entries)
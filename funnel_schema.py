@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+# Этапы и метрики исходного формата файла: используются, если заголовки пусты и схема не задана
+STAGES = ['Холодный', 'Встреча', 'КП', 'Согласование', 'Договор', 'Поставка']
+METRICS = ['Кол-во', 'Тонн']
+
+# Файл схемы по умолчанию (JSON); без него схема читается из двух строк заголовков
+DEFAULT_SCHEMA_PATH = os.environ.get('FUNNEL_SCHEMA') or None
+
+
+# Схема столбцов значений: этапы и метрики воронки в порядке следования
+# и позиция каждого столбца файла (после даты и филиала) на осях этапов и метрик
+@dataclass
+class FunnelSchema:
+    stages: list
+    metrics: list
+    stage_positions: np.ndarray   # int64, этап каждого столбца значений
+    metric_positions: np.ndarray  # int64, метрика каждого столбца значений
+
+    def __len__(self):
+        return len(self.stage_positions)
+
+    # (этап, метрика) для каждого столбца значений
+    @property
+    def columns(self):
+        return [(self.stages[s], self.metrics[m]) for s, m in zip(self.stage_positions, self.metric_positions)]
+
+    # Ключ схемы для постоянного кэша: при другой схеме тот же файл разбирается заново
+    def key(self):
+        data = json.dumps(
+            [self.stages, self.metrics, self.stage_positions.tolist(), self.metric_positions.tolist()],
+            ensure_ascii=False
+        ).encode('utf-8')
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+    # Столбцы идут сплошной сеткой «этап за этапом, внутри этапа - все метрики»
+    def is_grid(self):
+        n_stages, n_metrics = len(self.stages), len(self.metrics)
+        positions = np.arange(n_stages * n_metrics)
+        return (
+            len(self) == n_stages * n_metrics
+            and np.array_equal(self.stage_positions, positions // n_metrics)
+            and np.array_equal(self.metric_positions, positions % n_metrics)
+        )
+
+    # Значения строк файла (строки, столбцы) в раскладке (строки, этапы, метрики).
+    # Лишние столбцы файла отбрасываются, отсутствующие дают нули.
+    def layout(self, flat):
+        n_rows = flat.shape[0]
+        n_columns = min(len(self), flat.shape[1])
+        shape = (n_rows, len(self.stages), len(self.metrics))
+        if n_columns == len(self) and self.is_grid():
+            return flat[:, :n_columns].reshape(shape)
+
+        values = np.zeros(shape, dtype=flat.dtype)
+        stage_positions = self.stage_positions[:n_columns]
+        metric_positions = self.metric_positions[:n_columns]
+        cells = stage_positions * len(self.metrics) + metric_positions
+        if len(np.unique(cells)) == n_columns:
+            values[:, stage_positions, metric_positions] = flat[:, :n_columns]
+        else:
+            # Повторяющиеся пары (этап, метрика) складываются
+            np.add.at(values, (slice(None), stage_positions, metric_positions), flat[:, :n_columns])
+        return values
+
+
+# Схема-сетка: для каждого этапа подряд все метрики
+def grid_schema(stages, metrics):
+    positions = np.arange(len(stages) * len(metrics))
+    return FunnelSchema(
+        stages=list(stages),
+        metrics=list(metrics),
+        stage_positions=positions // len(metrics),
+        metric_positions=positions % len(metrics),
+    )
+
+
+# Схема исходного формата: пары (Кол-во, Тонн) по этапам, этапы сверх известных - Этап_N
+def default_schema(n_columns):
+    n_stages = -(-n_columns // len(METRICS))
+    stages = STAGES[:n_stages] + [f'Этап_{i}' for i in range(len(STAGES), n_stages)]
+    schema = grid_schema(stages, METRICS)
+    schema.stage_positions = schema.stage_positions[:n_columns]
+    schema.metric_positions = schema.metric_positions[:n_columns]
+    return schema
+
+
+# Схема из двух строк заголовков (ячейки столбцов значений, без даты и филиала).
+# Объединенные ячейки этапа приходят пустыми и заполняются предыдущим названием;
+# пустые названия без предыдущего и пустые метрики берутся из формата по умолчанию.
+def schema_from_header(stage_row, metric_row, n_columns=0):
+    n_columns = max(len(stage_row), len(metric_row), n_columns)
+    fallback = default_schema(n_columns)
+
+    def names(row, fill_forward):
+        cells = pd.Series(list(row) + [None] * (n_columns - len(row)), dtype=object)
+        cells = cells.where(cells.notna(), None).map(lambda cell: str(cell).strip() if cell is not None else '')
+        cells = cells.mask(cells == '')
+        return cells.ffill() if fill_forward else cells
+
+    stage_names = names(stage_row, fill_forward=True)
+    metric_names = names(metric_row, fill_forward=False)
+    if stage_names.isna().all() and metric_names.isna().all():
+        return fallback
+
+    default_stages = np.asarray(fallback.stages, dtype=object)[fallback.stage_positions]
+    default_metrics = np.asarray(fallback.metrics, dtype=object)[fallback.metric_positions]
+    stage_names = stage_names.fillna(pd.Series(default_stages))
+    metric_names = metric_names.fillna(pd.Series(default_metrics))
+
+    # Этапы и метрики в порядке первого появления в заголовке
+    stage_positions, stages = pd.factorize(stage_names)
+    metric_positions, metrics = pd.factorize(metric_names)
+    return FunnelSchema(
+        stages=list(stages),
+        metrics=list(metrics),
+        stage_positions=stage_positions.astype(np.int64),
+        metric_positions=metric_positions.astype(np.int64),
+    )
+
+
+# Параметр --schema командной строки - общий для всех утилит
+def add_schema_argument(parser):
+    parser.add_argument('--schema', default=DEFAULT_SCHEMA_PATH,
+                        help="JSON со списком этапов и метрик (по умолчанию FUNNEL_SCHEMA; без него - из заголовков файла)")
+
+
+# Схема из JSON-файла: {"stages": [...], "metrics": [...]} - сетка «этап × метрика»;
+# необязательный "columns": [[этап, метрика], ...] задает произвольный порядок столбцов файла
+def load_schema(path):
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    stages = [str(stage) for stage in config['stages']]
+    metrics = [str(metric) for metric in config.get('metrics', METRICS)]
+    if 'columns' not in config:
+        return grid_schema(stages, metrics)
+
+    stage_index = {stage: s for s, stage in enumerate(stages)}
+    metric_index = {metric: m for m, metric in enumerate(metrics)}
+    try:
+        positions = np.array(
+            [(stage_index[str(stage)], metric_index[str(metric)]) for stage, metric in config['columns']],
+            dtype=np.int64
+        ).reshape(-1, 2)
+    except KeyError as e:
+        raise ValueError(f"Столбец схемы ссылается на неизвестный этап или метрику: {e}") from None
+    return FunnelSchema(
+        stages=stages,
+        metrics=metrics,
+        stage_positions=positions[:, 0],
+        metric_positions=positions[:, 1],
+    )
@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import traceback
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import pandas as pd
+
+from funnel_core import cube_lookup, range_lookup, conversion_rates, total_conversion, branch_conversion
+from funnel_io import load_merged, directory_sources, source_fingerprint, add_load_arguments, load_options
+
+# Адрес сервиса и число ответов в кэше результатов
+DEFAULT_HOST = os.environ.get('FUNNEL_SERVER_HOST', '127.0.0.1')
+DEFAULT_PORT = int(os.environ.get('FUNNEL_SERVER_PORT', 8080))
+DEFAULT_RESULT_CACHE = int(os.environ.get('FUNNEL_SERVER_CACHE', 4096))
+
+
+# Ошибка в параметрах запроса - ответ 400 с текстом ошибки
+class QueryError(ValueError):
+    pass
+
+
+# Набор еще не загружен - ответ 503
+class DatasetNotReady(RuntimeError):
+    pass
+
+
+# Загруженный набор: отпечатки файлов, таблица, куб и номер версии (меняется при каждой перезагрузке)
+@dataclass
+class _Dataset:
+    fingerprints: list
+    table: object
+    cube: object
+    version: int
+
+
+# Набор данных сервиса и ответы на запросы по кубу агрегатов. Загрузка - как в приложении: несколько
+# файлов и каталогов объединяются, при добавлении файлов разбираются только новые, остальные берутся
+# из постоянного кэша. load() выполняется вне цикла событий; запросы до ее окончания видят прежний набор.
+class FunnelService:
+    def __init__(self, paths, streaming=True, cache=None, schema=None, workers=None, agg_workers=None,
+                 result_cache=DEFAULT_RESULT_CACHE):
+        self.paths = list(paths)
+        self.streaming = streaming
+        self.cache = cache
+        self.schema = schema
+        self.workers = workers
+        self.agg_workers = agg_workers
+        self.dataset = None
+        self.error = None
+        # Ответы по (версия набора, путь, параметры) в порядке давности использования;
+        # обращения только из цикла событий, поэтому без блокировки
+        self.result_cache = result_cache
+        self._results = OrderedDict()
+
+    def sources(self):
+        sources = []
+        for path in self.paths:
+            sources += directory_sources(path) if os.path.isdir(path) else [path]
+        return sources
+
+    # Перезагрузка, если файлы изменились; возвращает True, если набор обновлен
+    def load(self):
+        sources = self.sources()
+        if not sources:
+            raise ValueError("Нет файлов для обработки")
+        fingerprints = [source_fingerprint(source) for source in sources]
+        current = self.dataset
+        if current is not None and current.fingerprints == fingerprints:
+            return False
+
+        options = dict(streaming=self.streaming, cache=self.cache, workers=self.workers, schema=self.schema,
+                       agg_workers=self.agg_workers)
+        if current is not None and fingerprints[:len(current.fingerprints)] == current.fingerprints:
+            # Файлы только добавились: разбираем новые и дописываем их к готовой таблице и кубу
+            table, cube = load_merged(sources[len(current.fingerprints):], base=(current.table, current.cube), **options)
+        else:
+            table, cube = load_merged(sources, **options)
+
+        # Набор подменяется одной ссылкой: запрос, уже взявший прежний набор, досчитывается по нему
+        self.dataset = _Dataset(fingerprints, table, cube, current.version + 1 if current is not None else 1)
+        return True
+
+    # Ответ (тело JSON) из кэша или расчет; ключ включает версию набора, поэтому после перезагрузки
+    # старые ответы не используются и вытесняются по давности
+    def answer(self, path, params):
+        dataset = self.dataset
+        if dataset is None:
+            raise DatasetNotReady("Данные еще загружаются")
+        key = (dataset.version, path, tuple(sorted(params.items())))
+        body = self._results.get(key)
+        if body is not None:
+            self._results.move_to_end(key)
+            return body
+
+        body = json.dumps(QUERIES[path](dataset, params), ensure_ascii=False).encode('utf-8')
+        self._results[key] = body
+        if len(self._results) > self.result_cache:
+            self._results.popitem(last=False)
+        return body
+
+
+def _metric(cube, params):
+    metric = params.get('metric', cube.metrics[0])
+    if metric not in cube.metrics:
+        raise QueryError(f"Неизвестная метрика: {metric}; есть {', '.join(cube.metrics)}")
+    return metric
+
+
+def _date(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return pd.Timestamp(value).normalize()
+    except ValueError:
+        raise QueryError(f"Неверная дата {name}={value}; нужен формат ГГГГ-ММ-ДД") from None
+
+
+# Период запроса: date - одна дата, from/to - диапазон включительно (без них - весь период)
+def _period(params):
+    date = _date(params, 'date')
+    date_from, date_to = _date(params, 'from'), _date(params, 'to')
+    if date is not None and (date_from is not None or date_to is not None):
+        raise QueryError("Задайте либо date, либо from/to")
+    return date, date_from, date_to
+
+
+def _iso(date):
+    return date.strftime('%Y-%m-%d') if date is not None else None
+
+
+# GET /funnel?metric=&branch=&date= или &from=&to= - воронка по срезу: значения этапов,
+# конверсия между соседними этапами и итоговая конверсия в процентах
+def query_funnel(dataset, params):
+    cube = dataset.cube
+    metric = _metric(cube, params)
+    branch = params.get('branch') or None
+    if branch is not None and branch not in cube.branch_index:
+        raise QueryError(f"Неизвестный филиал: {branch}")
+    date, date_from, date_to = _period(params)
+    if date is not None:
+        values, n_rows = cube_lookup(cube, date=date, branch=branch)
+    else:
+        values, n_rows = range_lookup(cube, date_from, date_to, branch=branch)
+    values = values[:, cube.metrics.index(metric)]
+    return {
+        'metric': metric,
+        'branch': branch,
+        'date': _iso(date),
+        'from': _iso(date_from),
+        'to': _iso(date_to),
+        'rows': n_rows,
+        'stages': cube.stages,
+        'values': values.tolist(),
+        'conversion': conversion_rates(values).round(2).tolist(),
+        'total_conversion': round(float(total_conversion(values)), 2),
+    }
+
+
+# GET /conversion?metric=&date= или &from=&to= - конверсия всех филиалов за период
+def query_conversion(dataset, params):
+    cube = dataset.cube
+    metric = _metric(cube, params)
+    date, date_from, date_to = _period(params)
+    values, rates, totals = branch_conversion(cube, metric, date=date, date_from=date_from, date_to=date_to)
+    return {
+        'metric': metric,
+        'date': _iso(date),
+        'from': _iso(date_from),
+        'to': _iso(date_to),
+        'stages': cube.stages,
+        'branches': cube.branches,
+        'values': values.tolist(),
+        'conversion': rates.round(2).tolist(),
+        'total_conversion': totals.round(2).tolist(),
+    }
+
+
+# GET /meta - оси набора: этапы, метрики, филиалы и диапазон дат
+def query_meta(dataset, params):
+    cube = dataset.cube
+    dates = cube.dates.astype('datetime64[D]')
+    return {
+        'version': dataset.version,
+        'rows': len(dataset.table),
+        'stages': cube.stages,
+        'metrics': cube.metrics,
+        'branches': cube.branches,
+        'date_from': str(dates[0]) if len(dates) else None,
+        'date_to': str(dates[-1]) if len(dates) else None,
+    }
+
+
+QUERIES = {'/funnel': query_funnel, '/conversion': query_conversion, '/meta': query_meta}
+
+
+# Приложение aiohttp (необязательная зависимость). Запросы считаются в цикле событий: это выборки
+# из префиксных сумм за микросекунды; разбор файлов при перезагрузке идет в отдельном потоке.
+def make_app(service, reload_interval=None):
+    try:
+        from aiohttp import web
+    except ImportError:
+        raise RuntimeError("Для сервиса запросов нужен пакет aiohttp (pip install aiohttp)") from None
+
+    reload_lock = asyncio.Lock()
+
+    async def reload():
+        # Одновременные перезагрузки не запускаются: вторая дожидается первой
+        async with reload_lock:
+            try:
+                changed = await asyncio.get_running_loop().run_in_executor(None, service.load)
+                service.error = None
+                return changed
+            except Exception as e:
+                service.error = str(e)
+                traceback.print_exc()
+                raise
+
+    async def handle_query(request):
+        try:
+            body = service.answer(request.path, dict(request.query))
+        except QueryError as e:
+            return web.json_response({'error': str(e)}, status=400, dumps=_dumps)
+        except DatasetNotReady as e:
+            return web.json_response({'error': service.error or str(e)}, status=503, dumps=_dumps)
+        return web.Response(body=body, content_type='application/json')
+
+    async def handle_reload(request):
+        try:
+            changed = await reload()
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500, dumps=_dumps)
+        return web.json_response({'reloaded': changed, 'version': service.dataset.version}, dumps=_dumps)
+
+    async def handle_health(request):
+        dataset = service.dataset
+        return web.json_response({
+            'status': 'ok' if dataset is not None else 'loading',
+            'version': dataset.version if dataset is not None else None,
+            'error': service.error,
+        }, dumps=_dumps)
+
+    async def reload_periodically():
+        while True:
+            try:
+                await reload()
+            except Exception:
+                # Ошибка уже выведена; сервис продолжает отвечать по прежнему набору
+                pass
+            if not reload_interval:
+                return
+            await asyncio.sleep(reload_interval)
+
+    # Первая загрузка в фоне: сервис сразу принимает соединения и до ее окончания отвечает 503
+    async def background(app):
+        task = asyncio.create_task(reload_periodically())
+        yield
+        task.cancel()
+
+    app = web.Application()
+    app.cleanup_ctx.append(background)
+    for path in QUERIES:
+        app.router.add_get(path, handle_query)
+    app.router.add_post('/reload', handle_reload)
+    app.router.add_get('/health', handle_health)
+    return app
+
+
+def _dumps(data):
+    return json.dumps(data, ensure_ascii=False)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="HTTP-сервис запросов воронки (JSON): /funnel, /conversion, /meta, /health, POST /reload"
+    )
+    parser.add_argument('sources', nargs='+',
+                        help="файлы .xlsx/.csv в формате приложения (две строки заголовков) или каталоги с ними")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="адрес (по умолчанию FUNNEL_SERVER_HOST или 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="порт (по умолчанию FUNNEL_SERVER_PORT или 8080)")
+    parser.add_argument('--reload-interval', type=float, default=None,
+                        help="проверять файлы на изменения раз в столько секунд (по умолчанию - только POST /reload)")
+    parser.add_argument('--result-cache', type=int, default=DEFAULT_RESULT_CACHE,
+                        help="ответов в кэше результатов (по умолчанию FUNNEL_SERVER_CACHE или 4096)")
+    add_load_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    service = FunnelService(args.sources, result_cache=args.result_cache, **load_options(args))
+    try:
+        app = make_app(service, reload_interval=args.reload_interval)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    from aiohttp import web
+    web.run_app(app, host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from funnel_core import (
+    NO_DAY, FunnelTable, branch_code_dtype, day_bounds, days_to_dates, conversion_rates, total_conversion
+)
+from funnel_io import iter_tables, directory_sources
+from funnel_schema import add_schema_argument, load_schema
+
+# Версия формата хранилища: хранилище другой версии нужно пересобрать
+STORE_VERSION = 2
+
+# Строк в блоке хранилища и каталог хранилища по умолчанию для приложения
+DEFAULT_CHUNK_ROWS = int(os.environ.get('FUNNEL_STORE_CHUNK_ROWS', 2 ** 20))
+DEFAULT_STORE_PATH = os.environ.get('FUNNEL_STORE') or None
+
+
+# Однократное преобразование файлов в блочное хранилище по столбцам.
+# Каталог хранилища: meta.json (этапы, метрики, филиалы, min/max даты и коды филиалов каждого блока)
+# и по подкаталогу на блок с days.npy, branch_codes.npy и values_{m}.npy.
+# В памяти одновременно только один блок исходного файла. Внутри блока строки упорядочены по дате
+# и филиалу, поэтому диапазон дат в блоке находится двоичным поиском.
+def convert_sources(sources, directory, schema=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    directory = os.path.abspath(directory)
+    tmp_path = f'{directory}.tmp-{uuid.uuid4().hex}'
+    os.makedirs(tmp_path)
+    try:
+        branch_index = {}
+        stages = metrics = None
+        chunks = []
+        chunk_days = []
+        for source in sources:
+            for table in iter_tables(source, schema, chunk_rows):
+                if stages is None:
+                    stages, metrics = list(table.stages), list(table.metrics)
+                elif (list(table.stages), list(table.metrics)) != (stages, metrics):
+                    raise ValueError("Этапы и метрики файлов не совпадают - задайте общую схему (--schema)")
+
+                # Коды филиалов сквозные для всего хранилища
+                remap = np.array(
+                    [branch_index.setdefault(name, len(branch_index)) for name in table.branch_names] + [-1],
+                    dtype=np.int32
+                )
+                codes = remap[table.branch_codes]
+                order = np.lexsort((codes, table.days))
+                days = table.days[order]
+
+                chunk_path = os.path.join(tmp_path, f'{len(chunks):06d}')
+                os.makedirs(chunk_path)
+                np.save(os.path.join(chunk_path, 'days.npy'), days)
+                np.save(os.path.join(chunk_path, 'branch_codes.npy'), codes[order])
+                for m, values in enumerate(table.values):
+                    np.save(os.path.join(chunk_path, f'values_{m}.npy'), values[order])
+                chunks.append({
+                    'rows': len(days),
+                    'day_min': int(days[0]),
+                    'day_max': int(days[-1]),
+                    # Точный набор кодов, а не min/max: коды идут в порядке появления, и диапазон
+                    # почти любого блока накрывал бы все филиалы
+                    'branches': np.unique(codes[codes >= 0]).tolist(),
+                })
+                chunk_days.append(np.unique(days))
+
+        if stages is None:
+            raise ValueError("Нет данных для хранилища")
+        days = np.unique(np.concatenate(chunk_days))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': STORE_VERSION,
+                'stages': stages,
+                'metrics': metrics,
+                'branch_names': list(branch_index),
+                'chunks': chunks,
+                'days': days[days != NO_DAY].tolist(),
+            }, f, ensure_ascii=False)
+
+        # Готовое хранилище подменяет старое целиком
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp_path, directory)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return FunnelStore(directory)
+
+
+# Ленивые запросы к хранилищу: по индексу блоков (min/max дат, набор филиалов) читаются только блоки, которые могут
+# содержать строки запроса, а из них - только даты, коды филиалов и столбцы нужных метрик (mmap).
+class FunnelStore:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Хранилище {directory} другой версии - пересоберите его")
+
+        self.directory = directory
+        self.stages = meta['stages']
+        self.metrics = meta['metrics']
+        self.branch_names = meta['branch_names']
+        self.branch_index = {branch: b for b, branch in enumerate(self.branch_names)}
+        self.days = np.array(meta['days'], dtype=np.int32)
+
+        # Индекс блоков
+        chunks = meta['chunks']
+        self.chunk_rows = np.array([chunk['rows'] for chunk in chunks], dtype=np.int64)
+        self.day_min = np.array([chunk['day_min'] for chunk in chunks], dtype=np.int64)
+        self.day_max = np.array([chunk['day_max'] for chunk in chunks], dtype=np.int64)
+        # Наличие филиалов в блоках: блоки × коды филиалов
+        self.chunk_branches = np.zeros((len(chunks), len(self.branch_names)), dtype=bool)
+        for i, chunk in enumerate(chunks):
+            self.chunk_branches[i, chunk['branches']] = True
+
+    def __len__(self):
+        return int(self.chunk_rows.sum())
+
+    # Даты с данными (datetime64[ns]) и филиалы по алфавиту - для выбора в интерфейсе
+    @property
+    def dates(self):
+        return days_to_dates(self.days)
+
+    @property
+    def branches(self):
+        return sorted(self.branch_names)
+
+    # Объем хранилища на диске в байтах
+    @property
+    def nbytes(self):
+        return sum(
+            entry.stat().st_size
+            for chunk in os.scandir(self.directory) if chunk.is_dir()
+            for entry in os.scandir(chunk.path)
+        )
+
+    def _column(self, chunk, name):
+        return np.load(os.path.join(self.directory, f'{chunk:06d}', f'{name}.npy'), mmap_mode='r')
+
+    # Номера блоков, которые по индексу могут содержать строки запроса
+    def chunks_for(self, date_from=None, date_to=None, branch=None):
+        lo, hi = day_bounds(date_from, date_to)
+        keep = (self.day_max >= lo) & (self.day_min <= hi)
+        if branch is not None:
+            code = self.branch_index.get(branch)
+            if code is None:
+                return np.zeros(0, dtype=np.int64)
+            keep &= self.chunk_branches[:, code]
+        return np.flatnonzero(keep)
+
+    # Строки блока, подходящие под запрос: отрезок дат двоичным поиском, затем маска по филиалу
+    def _chunk_rows(self, chunk, lo, hi, code):
+        days = self._column(chunk, 'days')
+        start = int(np.searchsorted(days, lo, side='left'))
+        stop = int(np.searchsorted(days, hi, side='right'))
+        if code is None:
+            return slice(start, stop), stop - start
+        rows = start + np.flatnonzero(self._column(chunk, 'branch_codes')[start:stop] == code)
+        return rows, len(rows)
+
+    # Воронка за диапазон дат (включительно) и по филиалу, как range_lookup по кубу:
+    # значения (этапы, метрики) и число исходных строк. metrics - только эти метрики (по умолчанию все).
+    def query(self, date_from=None, date_to=None, branch=None, metrics=None):
+        positions = range(len(self.metrics)) if metrics is None else [self.metrics.index(m) for m in metrics]
+        values = np.zeros((len(self.stages), len(positions)))
+        lo, hi = day_bounds(date_from, date_to)
+        code = self.branch_index.get(branch) if branch is not None else None
+        n_rows = 0
+        for chunk in self.chunks_for(date_from, date_to, branch):
+            rows, n = self._chunk_rows(chunk, lo, hi, code)
+            if n == 0:
+                continue
+            for i, m in enumerate(positions):
+                values[:, i] += self._column(chunk, f'values_{m}')[rows].sum(axis=0, dtype=np.float64)
+            n_rows += n
+        return values, n_rows
+
+    # Исходные строки запроса блоками-таблицами (по одному блоку хранилища на таблицу)
+    def table_chunks(self, date_from=None, date_to=None, branch=None):
+        lo, hi = day_bounds(date_from, date_to)
+        code = self.branch_index.get(branch) if branch is not None else None
+        for chunk in self.chunks_for(date_from, date_to, branch):
+            rows, n = self._chunk_rows(chunk, lo, hi, code)
+            if n == 0:
+                continue
+            yield FunnelTable(
+                days=np.asarray(self._column(chunk, 'days')[rows]),
+                branch_codes=self._column(chunk, 'branch_codes')[rows].astype(branch_code_dtype(len(self.branch_names))),
+                branch_names=self.branch_names,
+                stages=self.stages,
+                metrics=self.metrics,
+                values=[np.asarray(self._column(chunk, f'values_{m}')[rows]) for m in range(len(self.metrics))],
+            )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Блочное хранилище для данных больше оперативной памяти: сборка и запросы воронки"
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="преобразовать файлы .xlsx/.csv в хранилище")
+    build.add_argument('sources', nargs='+', help="файлы .xlsx/.csv в формате приложения или каталоги с ними")
+    build.add_argument('-o', '--output', required=True, help="каталог хранилища (заменяется целиком)")
+    add_schema_argument(build)
+    build.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS,
+                       help="строк в блоке (по умолчанию FUNNEL_STORE_CHUNK_ROWS или 1048576)")
+
+    query = commands.add_parser('query', help="воронка за период и по филиалу")
+    query.add_argument('store', help="каталог хранилища")
+    query.add_argument('--date-from', help="начало периода, ГГГГ-ММ-ДД")
+    query.add_argument('--date-to', help="конец периода включительно, ГГГГ-ММ-ДД")
+    query.add_argument('--branch', help="филиал (по умолчанию все)")
+    query.add_argument('--metric', help="метрика (по умолчанию все)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'build':
+        schema = load_schema(args.schema) if args.schema else None
+        sources = []
+        for source in args.sources:
+            sources += directory_sources(source) if os.path.isdir(source) else [source]
+        if not sources:
+            print("Нет файлов для обработки", file=sys.stderr)
+            return 1
+        store = convert_sources(sources, args.output, schema=schema, chunk_rows=args.chunk_rows)
+        print(
+            f"Хранилище {args.output}: строк {len(store)}, блоков {len(store.chunk_rows)}, "
+            f"филиалов {len(store.branch_names)}, {store.nbytes / 2 ** 20:.1f} МБ",
+            file=sys.stderr
+        )
+        return 0
+
+    store = FunnelStore(args.store)
+    metrics = [args.metric] if args.metric else store.metrics
+    chunks = store.chunks_for(args.date_from, args.date_to, args.branch)
+    values, n_rows = store.query(args.date_from, args.date_to, args.branch, metrics=metrics)
+    result = pd.DataFrame(values, index=store.stages, columns=metrics)
+    for i, metric in enumerate(metrics):
+        result[f'{metric}, конверсия %'] = np.concatenate([[100.0 if values[0, i] > 0 else 0.0], conversion_rates(values[:, i])]).round(1)
+    result.index.name = 'Этап'
+    result.to_csv(sys.stdout)
+    totals = ', '.join(f'{metric} {total_conversion(values[:, i]):.1f}%' for i, metric in enumerate(metrics))
+    print(
+        f"Строк: {n_rows}; прочитано блоков: {len(chunks)} из {len(store.chunk_rows)}; итоговая конверсия: {totals}",
+        file=sys.stderr
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())